@@ -0,0 +1,75 @@
+"""
+Incremental parsing of NDJSON message uploads.
+
+The request body is read chunk by chunk and split into lines, one JSON
+message per line. Each line is parsed and validated on its own by pydantic's
+JSON parser, and the messages are handed out in small batches, so the memory
+used stays the same whatever the size of the upload. Uploads breaking the
+size or message-count limits are stopped with a 413 as soon as the limit is
+crossed.
+"""
+
+from typing import AsyncIterator
+
+from fastapi import HTTPException
+from pydantic import ValidationError
+
+from api.schemas import Message
+
+
+def too_large(detail: str) -> HTTPException:
+    return HTTPException(status_code=413, detail=detail)
+
+async def message_batches(
+    chunks: AsyncIterator[bytes],
+    batch_size: int = 500,
+    max_bytes: int = 64 * 1024 * 1024,
+    max_messages: int = 100_000,
+    max_line_bytes: int = 1024 * 1024,
+) -> AsyncIterator[list[dict]]:
+    """Validated messages of an NDJSON body, in batches of up to `batch_size`."""
+    buffer = bytearray()
+    received = 0
+    line_number = 0
+    messages = 0
+    batch = []
+
+    def parse(line: bytes) -> None:
+        nonlocal line_number, messages
+        line_number += 1
+        if len(line) > max_line_bytes:
+            raise too_large(f"Line {line_number} is longer than {max_line_bytes} bytes.")
+        if not line.strip():
+            return
+        messages += 1
+        if messages > max_messages:
+            raise too_large(f"The upload has more than {max_messages} messages.")
+        try:
+            batch.append(Message.model_validate_json(line).model_dump())
+        except ValidationError as exc:
+            error = exc.errors()[0]
+            location = ".".join(str(part) for part in error["loc"])
+            raise HTTPException(
+                status_code=422,
+                detail=f"Line {line_number}: {location + ': ' if location else ''}{error['msg']}"
+            )
+
+    async for chunk in chunks:
+        received += len(chunk)
+        if received > max_bytes:
+            raise too_large(f"The upload is larger than {max_bytes} bytes.")
+        buffer += chunk
+        start = 0
+        while (end := buffer.find(b"\n", start)) != -1:
+            parse(bytes(buffer[start:end]))
+            start = end + 1
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        del buffer[:start]
+        # A line without its end yet can only grow
+        if len(buffer) > max_line_bytes:
+            raise too_large(f"Line {line_number + 1} is longer than {max_line_bytes} bytes.")
+    parse(bytes(buffer))
+    if batch:
+        yield batch
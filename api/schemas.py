@@ -1,5 +1,5 @@
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 
 class Message(BaseModel):
     conv_id: int
@@ -10,4 +10,10 @@ class ExtensionData(BaseModel):
     user_email: str
     num_mcq: int
     num_open: int
-    messages: List[Message]
\ No newline at end of file
+    messages: List[Message]
+
+class DigestMessages(BaseModel):
+    user_email: str
+    messages: List[Message]
+    num_mcq: Optional[int] = None
+    num_open: Optional[int] = None
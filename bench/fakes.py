@@ -0,0 +1,295 @@
+'''
+Local stand-ins for the upstream APIs, used by the benchmark.
+
+One FastAPI app serves an OpenAI-compatible chat completions endpoint (plain
+and streamed), the Google Forms endpoints used by the form generator and the
+Gmail send and batch endpoints. Latency (also per model), the share of
+malformed model outputs, of repeated questions and of rate-limited (429)
+completions are configurable. Completions report the prompt tokens a provider
+would serve from its prefix cache, and can be charged a prefill latency for
+the others. `GET /stats` reports the calls received.
+
+Run with `python -m bench.fakes --port 9100 --llm-latency 0.5 --malformed-rate 0.1`.
+'''
+
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+MCQ = {
+    "type": "mcq",
+    "level": "easy",
+    "task": "comprehension",
+    "question": "Which statement about the topic is correct?",
+    "options": {"A": "First", "B": "Second", "C": "Third", "D": "Fourth"},
+    "correct_answer": "A",
+    "explanation": "Because it was discussed in the conversation."
+}
+OPEN_ENDED = {
+    "type": "open-ended",
+    "level": "remember",
+    "question": "Explain the main idea of the conversation.",
+    "answer": "The main idea is the topic that was discussed."
+}
+
+WORDS = ("empire republic senate emperor legion province trade army reform citizen law road aqueduct "
+         "consul crisis dynasty border tax revolt culture harbor grain coin temple forum bridge").split()
+
+# Providers only cache prefixes of at least this many tokens
+CACHE_MIN_TOKENS = 1024
+
+app = FastAPI()
+app.state.llm_latency = 0.5
+app.state.google_latency = 0.1
+app.state.jitter = 0.2
+app.state.malformed_rate = 0.0
+app.state.rate_limit_rate = 0.0
+app.state.duplicate_rate = 0.0
+# Seconds per 1000 prompt tokens not served from the prefix cache
+app.state.prefill_latency = 0.0
+# (model, message prefix) pairs seen, for the emulated prefix cache
+app.state.prefixes = set()
+# Model name -> latency, overriding llm_latency
+app.state.model_latency = {}
+app.state.calls = Counter()
+
+
+async def delay(seconds: float) -> None:
+    jitter = seconds * app.state.jitter
+    await asyncio.sleep(max(0.0, random.uniform(seconds - jitter, seconds + jitter)))
+
+def requested_count(prompt: str, default: int = 1) -> int:
+    match = re.search(r"Generate exactly (\d+)", prompt)
+    return int(match.group(1)) if match else default
+
+def question_text() -> str:
+    """A random question, or with `duplicate_rate` the same one every time."""
+    if random.random() < app.state.duplicate_rate:
+        return MCQ["question"]
+    return f"How does the {' '.join(random.sample(WORDS, 5))} matter?"
+
+def malformed(item: dict) -> dict:
+    """A copy of `item` that fails validation: one key renamed."""
+    broken = dict(item)
+    key = random.choice(list(broken))
+    broken[f"{key}_"] = broken.pop(key)
+    return broken
+
+def text(message: dict) -> str:
+    """The text of a message, whose content may be a list of parts."""
+    content = message["content"]
+    if isinstance(content, list):
+        return "".join(part.get("text", "") for part in content)
+    return content
+
+def reply(messages: list) -> tuple[str, str]:
+    """Pick the answer from the system prompt and any trailing instructions. Returns (kind, content)."""
+    prompt = text(messages[0]) if messages and messages[0]["role"] == "system" else ""
+    if len(messages) > 2 and messages[-1]["role"] == "user":
+        prompt += "\n\n" + text(messages[-1])
+    bad = random.random() < app.state.malformed_rate
+    if "MCQ designer" in prompt:
+        if "JSON list" in prompt:
+            items = [dict(MCQ, question=question_text()) for _ in range(requested_count(prompt))]
+            if bad:
+                items[random.randrange(len(items))] = malformed(MCQ)
+            return "mcq_batch", json.dumps(items)
+        return "mcq", json.dumps(malformed(MCQ) if bad else dict(MCQ, question=question_text()))
+    if "open-ended questions" in prompt:
+        items = [dict(OPEN_ENDED, question=question_text()) for _ in range(requested_count(prompt))]
+        if bad:
+            items[random.randrange(len(items))] = malformed(OPEN_ENDED)
+        return "open_ended", json.dumps(items)
+    if "study notes" in prompt:
+        notes = text(messages[-1])[:400]
+        return "transcript_summary", json.dumps({"notes": notes} if bad else {"summary": notes})
+    return "quiz_title", json.dumps({"name": "Quiz"} if bad else {"title": "Benchmark Quiz"})
+
+def tokens(messages: list) -> int:
+    return sum(len(text(message)) for message in messages) // 4
+
+def cached_tokens(model: str, messages: list) -> int:
+    """
+    Prompt tokens a provider would serve from its prefix cache: those of the
+    longest message prefix sent before to the same model, if long enough.
+    """
+    prefixes = [(model, json.dumps([[m["role"], text(m)] for m in messages[:k]])) for k in range(1, len(messages))]
+    cached = 0
+    for k, prefix in enumerate(prefixes, start=1):
+        if prefix in app.state.prefixes:
+            cached = tokens(messages[:k])
+    app.state.prefixes.update(prefixes)
+    return cached if cached >= CACHE_MIN_TOKENS else 0
+
+def usage(messages: list, content: str, cached: int) -> dict:
+    prompt_tokens = tokens(messages)
+    completion_tokens = len(content) // 4
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens,
+        "prompt_tokens_details": {"cached_tokens": cached}
+    }
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    app.state.calls["llm"] += 1
+    app.state.calls[f"llm_model_{body['model']}"] += 1
+    if random.random() < app.state.rate_limit_rate:
+        app.state.calls["llm_rate_limited"] += 1
+        return JSONResponse(
+            {"error": {"message": "Rate limit exceeded", "code": 429}},
+            status_code=429,
+            headers={"Retry-After": "1"}
+        )
+    kind, content = reply(body["messages"])
+    app.state.calls[f"llm_{kind}"] += 1
+    cached = cached_tokens(body["model"], body["messages"])
+    app.state.calls["llm_prompt_tokens"] += tokens(body["messages"])
+    app.state.calls["llm_cached_tokens"] += cached
+    # Uncached prompt tokens have to be prefilled before the first token
+    prefill = (tokens(body["messages"]) - cached) / 1000 * app.state.prefill_latency
+    await delay(app.state.model_latency.get(body["model"], app.state.llm_latency) + prefill)
+
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    created = int(time.time())
+    if not body.get("stream"):
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": body["model"],
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }],
+            "usage": usage(body["messages"], content, cached)
+        }
+
+    def chunk(delta: dict, finish_reason=None, **extra) -> str:
+        data = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": body["model"],
+            "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}] if delta is not None else [],
+            **extra
+        }
+        return f"data: {json.dumps(data)}\n\n"
+
+    async def events():
+        yield chunk({"role": "assistant", "content": ""})
+        for i in range(0, len(content), 16):
+            yield chunk({"content": content[i:i + 16]})
+            await asyncio.sleep(0)
+        yield chunk({}, finish_reason="stop")
+        if body.get("stream_options", {}).get("include_usage"):
+            yield chunk(None, usage=usage(body["messages"], content, cached))
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+@app.post("/v1/forms")
+async def create_form():
+    app.state.calls["forms_create"] += 1
+    await delay(app.state.google_latency)
+    form_id = uuid.uuid4().hex
+    return {"formId": form_id, "responderUri": f"https://docs.google.com/forms/d/e/{form_id}/viewform"}
+
+@app.post("/v1/forms/{form_id}:batchUpdate")
+async def update_form(form_id: str, request: Request):
+    body = await request.json()
+    app.state.calls["forms_batch_update"] += 1
+    app.state.calls["forms_requests"] += len(body.get("requests", []))
+    await delay(app.state.google_latency)
+    return {"formId": form_id, "replies": [{} for _ in body.get("requests", [])]}
+
+@app.post("/gmail/v1/users/{user_id}/messages/send")
+async def send_email():
+    app.state.calls["gmail_send"] += 1
+    await delay(app.state.google_latency)
+    return {"id": uuid.uuid4().hex, "labelIds": ["SENT"]}
+
+@app.post("/batch/gmail/v1")
+async def send_email_batch(request: Request):
+    """Answer a multipart/mixed batch with one sent message per part."""
+    raw = await request.body()
+    header = f"Content-Type: {request.headers['content-type']}\r\n\r\n".encode()
+    batch = BytesParser(policy=HTTP).parsebytes(header + raw)
+    app.state.calls["gmail_batch"] += 1
+    await delay(app.state.google_latency)
+
+    boundary = uuid.uuid4().hex
+    parts = []
+    for part in batch.iter_parts():
+        app.state.calls["gmail_send"] += 1
+        content_id = part["Content-ID"].strip("<>")
+        payload = json.dumps({"id": uuid.uuid4().hex, "labelIds": ["SENT"]})
+        parts.append(
+            f"--{boundary}\r\n"
+            "Content-Type: application/http\r\n"
+            f"Content-ID: <response-{content_id}>\r\n\r\n"
+            "HTTP/1.1 200 OK\r\n"
+            "Content-Type: application/json; charset=UTF-8\r\n\r\n"
+            f"{payload}\r\n"
+        )
+    return Response(
+        "".join(parts) + f"--{boundary}--\r\n",
+        media_type=f"multipart/mixed; boundary={boundary}"
+    )
+
+
+@app.get("/stats")
+async def stats():
+    return JSONResponse(dict(app.state.calls))
+
+
+def main() -> None:
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Local stand-ins for OpenRouter, Google Forms and Gmail.")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Seconds before a completion starts.")
+    parser.add_argument("--google-latency", type=float, default=0.1, help="Seconds per Forms/Gmail call.")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Latency jitter, as a fraction of the latency.")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="Share of completions that do not match the output template.")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Share of completions answered with 429 Too Many Requests.")
+    parser.add_argument("--duplicate-rate", type=float, default=0.0,
+                        help="Share of generated questions that repeat the same question.")
+    parser.add_argument("--prefill-latency", type=float, default=0.0,
+                        help="Seconds per 1000 prompt tokens not served from the emulated prefix cache.")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SECONDS",
+                        help="Latency of one model, overriding --llm-latency (repeatable).")
+    args = parser.parse_args()
+
+    app.state.llm_latency = args.llm_latency
+    app.state.google_latency = args.google_latency
+    app.state.jitter = args.jitter
+    app.state.malformed_rate = args.malformed_rate
+    app.state.rate_limit_rate = args.rate_limit_rate
+    app.state.duplicate_rate = args.duplicate_rate
+    app.state.prefill_latency = args.prefill_latency
+    for setting in args.model_latency:
+        model, seconds = setting.rsplit("=", 1)
+        app.state.model_latency[model] = float(seconds)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+'''
+Deterministic, offline runs of the quiz generation.
+
+Record once against the model (or the `bench.fakes` stand-in), then replay
+the recorded traffic as often as needed with no network, e.g. to profile the
+generation code or to check that a change keeps the output identical. The
+generation goes through `agenerate_quiz` with the configured
+`mcq_generation`, `transcript` and `dedup` settings, as in the server;
+`--path sync` runs `generate_questions` and `generate_title` instead:
+
+    python -m bench.replay --mode record --log data/traffic.jsonl.gz --output before.json
+    python -m bench.replay --mode replay --log data/traffic.jsonl.gz --output after.json --profile
+
+The answer letters of the MCQs are drawn at random, so the same `--seed` must
+be used for the recording and its replays.
+'''
+
+import argparse
+import asyncio
+import cProfile
+import json
+import pstats
+import random
+import time
+from pathlib import Path
+
+from dotenv import load_dotenv
+
+from api.schemas import ExtensionData
+from bench.run import make_payload
+from src.agent import Agent
+from src.enums.processing import MCQGenerationEnum
+from src.processing import (
+    agenerate_quiz,
+    generate_questions,
+    generate_title,
+    load_config,
+    load_system_prompts,
+    resolve_api_key
+)
+
+
+async def agenerate(agent: Agent, data: ExtensionData, system_prompts: dict, config: dict) -> tuple[list[dict], str]:
+    """The quiz as the server's pipeline generates it."""
+    try:
+        return await agenerate_quiz(
+            agent=agent,
+            messages=data.messages,
+            num_mcq=data.num_mcq,
+            num_open=data.num_open,
+            system_propmts=system_prompts,
+            mcq_generation=config.get("mcq_generation", MCQGenerationEnum.CONCURRENT.value),
+            transcript_config=config.get("transcript", {}),
+            dedup_config=config.get("dedup", {})
+        )
+    finally:
+        await agent.aclose()
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Record or replay the model traffic of one quiz generation.")
+    parser.add_argument("--mode", choices=["record", "replay"], required=True)
+    parser.add_argument("--log", type=Path, default=Path("./data/llm_traffic.jsonl.gz"))
+    parser.add_argument("--transcript", type=Path, default=None,
+                        help="JSON request body as sent to /receive (default: a synthetic transcript).")
+    parser.add_argument("--config", type=Path, default=Path("./configs/base.json"))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--path", choices=["async", "sync"], default="async",
+                        help="Generate through agenerate_quiz, as the server does, or the sync functions.")
+    parser.add_argument("--latency", action="store_true", help="Replay with the recorded latency.")
+    parser.add_argument("--profile", action="store_true", help="Print the top functions by cumulative time.")
+    parser.add_argument("--output", type=Path, default=None, help="Write the generated quiz to this file.")
+    # Only used for the synthetic transcript
+    parser.add_argument("--messages", type=int, default=20)
+    parser.add_argument("--message-words", type=int, default=60)
+    parser.add_argument("--num-mcq", type=int, default=7)
+    parser.add_argument("--num-open", type=int, default=3)
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    config["llm_traffic"] = {"mode": args.mode, "path": str(args.log), "replay_latency": args.latency}
+    if args.mode == "record":
+        load_dotenv()
+        config["api_key"] = resolve_api_key(config)
+    system_prompts = load_system_prompts("./specs/base.json")
+
+    if args.transcript is not None:
+        payload = json.loads(args.transcript.read_text())
+    else:
+        payload = make_payload(0, args)
+    data = ExtensionData(**payload)
+
+    random.seed(args.seed)
+    agent = Agent(config)
+    profiler = cProfile.Profile() if args.profile else None
+
+    start = time.perf_counter()
+    if profiler is not None:
+        profiler.enable()
+    if args.path == "sync":
+        questions = generate_questions(agent, data.messages, data.num_mcq, data.num_open, system_prompts, config.get("dedup"))
+        title = generate_title(agent, questions, system_prompts)
+    else:
+        questions, title = asyncio.run(agenerate(agent, data, system_prompts, config))
+    if profiler is not None:
+        profiler.disable()
+    elapsed = time.perf_counter() - start
+
+    print(f"{args.mode.capitalize()}ed {agent.stats['completions']} completion(s) in {elapsed:.2f}s: "
+          f"{len(questions)} question(s), {agent.stats['invalid_responses']} invalid response(s), title {title!r}")
+    if profiler is not None:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(25)
+    if args.output is not None:
+        args.output.write_text(json.dumps({"title": title, "questions": questions}, indent=4, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+'''
+Load test of the quiz server against the local upstream stand-ins.
+
+Starts `bench.fakes` and the server (configured to use them), submits quiz
+requests to `/receive` at the given concurrency, follows every job to its
+final stage and writes a report to a JSON file:
+end-to-end latency percentiles, quizzes per second, per-stage timings,
+upstream call counts, the model retry rate and the requests rejected by
+backpressure.
+
+Run from the project root, e.g.
+`python -m bench.run --requests 100 --concurrency 20 --messages 40 --malformed-rate 0.1`.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+from pathlib import Path
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+WORDS = ("empire republic senate emperor legion province trade army reform citizen law road "
+         "aqueduct consul crisis dynasty border tax revolt culture").split()
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(values: list[float]) -> dict:
+    return {
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "mean": sum(values) / len(values) if values else 0.0,
+        "max": max(values, default=0.0)
+    }
+
+def make_payload(index: int, args: argparse.Namespace, heavy: bool = False) -> dict:
+    """A synthetic transcript; the index keeps it unique so the quiz cache is not hit."""
+    rng = random.Random(index)
+    messages = []
+    for i in range(args.heavy_messages if heavy else args.messages):
+        words = " ".join(rng.choice(WORDS) for _ in range(args.message_words))
+        messages.append({
+            "conv_id": i // 10,
+            "role": "user" if i % 2 == 0 else "assistant",
+            "content": f"Message {index}-{i}: {words}"
+        })
+    return {
+        # Every heavy quiz comes from the same user
+        "user_email": "heavy@example.com" if heavy else f"bench{index}@example.com",
+        "num_mcq": args.heavy_mcq if heavy else args.num_mcq,
+        "num_open": args.num_open,
+        "messages": messages
+    }
+
+def write_config(args: argparse.Namespace, fakes_url: str, data_dir: Path) -> Path:
+    with open(ROOT / "configs" / "base.json") as f:
+        config = json.load(f)
+    config.update({
+        "base_url": f"{fakes_url}/v1",
+        "google_api_endpoint": f"{fakes_url}/",
+        "job_database": str(data_dir / "jobs.sqlite3"),
+        "job_workers": args.job_workers,
+        "max_concurrency": args.max_concurrency,
+        "mcq_generation": args.mcq_generation
+    })
+    if args.prompt_layout is not None:
+        config["prompt_layout"] = {**config.get("prompt_layout", {}), "mode": args.prompt_layout}
+    if args.no_rate_limits:
+        config.pop("rate_limits", None)
+    elif args.max_wait is not None:
+        config["rate_limits"] = {**config.get("rate_limits", {}), "max_wait_seconds": args.max_wait}
+    config["email_outbox"] = {**config.get("email_outbox", {}), "path": str(data_dir / "outbox.sqlite3"), "poll_interval": 0.2}
+    config["quiz_cache"] = {**config.get("quiz_cache", {}), "path": str(data_dir / "quiz_cache.sqlite3")}
+    config["question_bank"] = {**config.get("question_bank", {}), "path": str(data_dir / "question_bank.sqlite3")}
+    # Scheduled digests would compete with the benchmark's quizzes
+    config["digest"] = {**config.get("digest", {}), "path": str(data_dir / "digest.sqlite3"), "enabled": False}
+    path = data_dir / "config.json"
+    path.write_text(json.dumps(config, indent=4))
+    return path
+
+async def wait_until_up(client: httpx.AsyncClient, url: str, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if (await client.get(url)).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        await asyncio.sleep(0.2)
+    raise Exception(f"{url} did not come up within {timeout} seconds.")
+
+async def run_quiz(client: httpx.AsyncClient, server_url: str, payload: dict, poll_interval: float) -> dict:
+    start = time.perf_counter()
+    response = await client.post(f"{server_url}/receive", json=payload)
+    accepted = time.perf_counter() - start
+    if response.status_code == 429:
+        # Turned away by the server's backpressure
+        return {
+            "job_id": None,
+            "stage": "rejected",
+            "error": None,
+            "retry_after": response.json()["retry_after"],
+            "accept_seconds": accepted,
+            "total_seconds": accepted,
+            "timings": {}
+        }
+    response.raise_for_status()
+    job_id = response.json()["job_id"]
+    while True:
+        await asyncio.sleep(poll_interval)
+        job = (await client.get(f"{server_url}/jobs/{job_id}")).json()
+        if job["stage"] in ("completed", "failed"):
+            return {
+                "job_id": job_id,
+                "stage": job["stage"],
+                "error": job["error"],
+                "accept_seconds": accepted,
+                "total_seconds": time.perf_counter() - start,
+                "timings": job["timings"]
+            }
+
+async def drive(args: argparse.Namespace, server_url: str, fakes_url: str) -> dict:
+    semaphore = asyncio.Semaphore(args.concurrency)
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(timeout=args.timeout, limits=limits) as client:
+        await wait_until_up(client, f"{fakes_url}/stats")
+        await wait_until_up(client, f"{server_url}/readyz")
+
+        async def one(index: int) -> dict:
+            async with semaphore:
+                return await run_quiz(client, server_url, make_payload(index, args), args.poll_interval)
+
+        start = time.perf_counter()
+        # The heavy user's quizzes all arrive at once, ahead of the others
+        heavy = [
+            asyncio.create_task(run_quiz(client, server_url, make_payload(-1 - i, args, heavy=True), args.poll_interval))
+            for i in range(args.heavy_requests)
+        ]
+        await asyncio.sleep(0.1)
+        results = await asyncio.gather(*(one(i) for i in range(args.requests)))
+        duration = time.perf_counter() - start
+        heavy_results = await asyncio.gather(*heavy)
+
+        # Give the outbox a moment to deliver the last emails
+        await asyncio.sleep(1.0)
+        upstream = (await client.get(f"{fakes_url}/stats")).json()
+        agent = (await client.get(f"{server_url}/agent/stats")).json()
+
+    completed = [result for result in results if result["stage"] == "completed"]
+    rejected = [result for result in results if result["stage"] == "rejected"]
+    stages = sorted({stage for result in completed for stage in result["timings"]})
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "settings": vars(args),
+        "requests": len(results),
+        "completed": len(completed),
+        "rejected": len(rejected),
+        "failed": len(results) - len(completed) - len(rejected),
+        "errors": sorted({result["error"] for result in results if result["error"]}),
+        "duration_seconds": duration,
+        "quizzes_per_second": len(completed) / duration if duration else 0.0,
+        "latency_seconds": summarize([result["total_seconds"] for result in completed]),
+        "heavy_latency_seconds": summarize([result["total_seconds"] for result in heavy_results if result["stage"] == "completed"]),
+        "heavy_failed": sum(result["stage"] != "completed" for result in heavy_results),
+        "accept_latency_seconds": summarize([result["accept_seconds"] for result in results]),
+        "stage_seconds": {
+            stage: summarize([result["timings"][stage] for result in completed if stage in result["timings"]])
+            for stage in stages
+        },
+        "upstream_calls": upstream,
+        "agent": agent,
+        "retry_rate": agent["invalid_responses"] / agent["completions"] if agent.get("completions") else 0.0,
+        "cached_prompt_share": agent["cached_prompt_tokens"] / agent["prompt_tokens"] if agent.get("prompt_tokens") else 0.0
+    }
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Load test the quiz server against local upstream stand-ins.")
+    parser.add_argument("--requests", type=int, default=50, help="Number of quizzes to generate.")
+    parser.add_argument("--concurrency", type=int, default=10, help="Quizzes in flight at once.")
+    parser.add_argument("--messages", type=int, default=20, help="Messages per transcript.")
+    parser.add_argument("--message-words", type=int, default=60, help="Words per message.")
+    parser.add_argument("--num-mcq", type=int, default=7)
+    parser.add_argument("--num-open", type=int, default=3)
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--google-latency", type=float, default=0.1)
+    parser.add_argument("--malformed-rate", type=float, default=0.0)
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0)
+    parser.add_argument("--duplicate-rate", type=float, default=0.0)
+    parser.add_argument("--prefill-latency", type=float, default=0.0)
+    parser.add_argument("--prompt-layout", choices=["system", "prefix_cache"], default=None,
+                        help="Override prompt_layout.mode.")
+    parser.add_argument("--model-latency", action="append", default=[], metavar="MODEL=SECONDS")
+    parser.add_argument("--heavy-requests", type=int, default=0,
+                        help="Large quizzes submitted at once by a single user before the others; "
+                             "the latencies are reported separately.")
+    parser.add_argument("--heavy-messages", type=int, default=400)
+    parser.add_argument("--heavy-mcq", type=int, default=50)
+    parser.add_argument("--job-workers", type=int, default=4)
+    parser.add_argument("--server-workers", type=int, default=1,
+                        help="Server processes sharing the job database; agent stats come from one of them.")
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--mcq-generation", default="concurrent", choices=["concurrent", "batched"])
+    parser.add_argument("--no-rate-limits", action="store_true",
+                        help="Drop the client-side upstream rate limits from the configuration.")
+    parser.add_argument("--max-wait", type=float, default=None,
+                        help="Override rate_limits.max_wait_seconds, past which /receive answers 429.")
+    parser.add_argument("--poll-interval", type=float, default=0.05)
+    parser.add_argument("--timeout", type=float, default=60.0)
+    parser.add_argument("--output", type=Path, default=None,
+                        help="Report file (default: bench/results/<timestamp>.json).")
+    args = parser.parse_args()
+
+    output = args.output or ROOT / "bench" / "results" / f"{datetime.now():%Y%m%d-%H%M%S}.json"
+    fakes_port, server_port = free_port(), free_port()
+    fakes_url, server_url = f"http://127.0.0.1:{fakes_port}", f"http://127.0.0.1:{server_port}"
+
+    with tempfile.TemporaryDirectory(prefix="mindfullm-bench-") as data_dir:
+        config_path = write_config(args, fakes_url, Path(data_dir))
+        env = {
+            **os.environ, "MINDFULLM_CONFIG": str(config_path), "OPENROUTER_API_KEY": "bench",
+            "WEB_CONCURRENCY": str(args.server_workers)
+        }
+        logs = open(Path(data_dir) / "server.log", "w")
+        processes = [
+            subprocess.Popen([
+                sys.executable, "-m", "bench.fakes", "--port", str(fakes_port),
+                "--llm-latency", str(args.llm_latency), "--google-latency", str(args.google_latency),
+                "--malformed-rate", str(args.malformed_rate), "--rate-limit-rate", str(args.rate_limit_rate),
+                "--duplicate-rate", str(args.duplicate_rate), "--prefill-latency", str(args.prefill_latency),
+                *(option for setting in args.model_latency for option in ("--model-latency", setting))
+            ], cwd=ROOT),
+            subprocess.Popen([
+                sys.executable, "-m", "uvicorn", "main:app", "--port", str(server_port), "--log-level", "warning",
+                "--workers", str(args.server_workers)
+            ], cwd=ROOT, env=env, stdout=logs, stderr=subprocess.STDOUT)
+        ]
+        try:
+            report = asyncio.run(drive(args, server_url, fakes_url))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait(10)
+            logs.close()
+
+    report["settings"]["output"] = str(output)
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(json.dumps(report, indent=4))
+
+    latency = report["latency_seconds"]
+    if args.heavy_requests:
+        heavy = report["heavy_latency_seconds"]
+        print(f"Heavy user: {args.heavy_requests - report['heavy_failed']}/{args.heavy_requests} quizzes, "
+              f"latency p50 {heavy['p50']:.2f}s max {heavy['max']:.2f}s.")
+    if report["rejected"]:
+        print(f"{report['rejected']} request(s) rejected with 429.")
+    print(f"{report['completed']}/{report['requests']} quizzes in {report['duration_seconds']:.1f}s "
+          f"({report['quizzes_per_second']:.2f}/s), latency p50 {latency['p50']:.2f}s "
+          f"p95 {latency['p95']:.2f}s p99 {latency['p99']:.2f}s, retry rate {report['retry_rate']:.1%}, "
+          f"cached prompt tokens {report['cached_prompt_share']:.1%}")
+    print(f"Report written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,59 @@
 from contextlib import asynccontextmanager
+from functools import partial
 from dotenv import load_dotenv
+import asyncio
+import math
+import os
 import sys
-from fastapi import FastAPI
+import time
+import uuid
+from typing import Optional
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import JSONResponse, PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
-from api.schemas import ExtensionData
+from api.ingest import message_batches
+from api.schemas import DigestMessages, ExtensionData
 from src.agent import Agent
 from src.forms_generator import GoogleFormsGenerator
 from src.processing import (
     load_config, 
     load_system_prompts,
-    resolve_api_key,
-    generate_questions,
-    generate_title
+    resolve_api_key
 ) 
 from src.email import GmailEmailSender
-from src.email.utils import build_email_body
+from src.email.outbox import EmailOutbox
+from src.jobs import JobStore, JobQueue, SchedulingPolicy
+from src.cache import QuizCache
+from src.bank import QuestionBank
+from src.digest import DigestScheduler, DigestStore
+from src.pipeline import estimated_calls, estimated_cost, estimated_wait, run_quiz_pipeline
+from src.ratelimit import TokenBucket
+from src.logs import log, new_request_id, request_id
+from src import metrics
+
+async def warm_up(state) -> None:
+    """
+    Create the upstream clients in the background, so the server takes
+    requests right away; `/readyz` reports when they are authenticated.
+    """
+    async def init(name: str, create) -> None:
+        try:
+            await asyncio.to_thread(create)
+        except Exception as exc:
+            log(f"Unable to initialize the {name} client: {exc}", error=True)
+
+    await asyncio.gather(
+        init("OpenRouter", lambda: state.agent.async_ai),
+        init("Google Forms", lambda: state.form_generator.service),
+        init("Gmail", lambda: state.email_sender.service)
+    )
+    print("Upstream clients initialized.")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     print("Server started.")
 
-    app.state.config = load_config("./configs/base.json")
+    app.state.config = load_config(os.getenv("MINDFULLM_CONFIG", "./configs/base.json"))
     app.state.system_prompts = load_system_prompts("./specs/base.json")
 
     load_dotenv()
@@ -30,11 +63,98 @@ async def lifespan(app: FastAPI):
         sys.exit(str(exc))
 
     app.state.agent = Agent(config=app.state.config)
-    app.state.form_generator = GoogleFormsGenerator('credentials.json')
-    app.state.email_sender = GmailEmailSender('credentials.json')
+    google_api_endpoint = app.state.config.get("google_api_endpoint")
+    rate_limits = app.state.config.get("rate_limits", {})
+    app.state.form_generator = GoogleFormsGenerator(
+        'credentials.json',
+        api_endpoint=google_api_endpoint,
+        rate_limiter=TokenBucket.from_config("google_forms", rate_limits.get("google_forms"))
+    )
+    app.state.email_sender = GmailEmailSender(
+        'credentials.json',
+        api_endpoint=google_api_endpoint,
+        rate_limiter=TokenBucket.from_config("gmail", rate_limits.get("gmail"))
+    )
+
+    outbox_config = app.state.config.get("email_outbox", {})
+    app.state.email_outbox = EmailOutbox(
+        app.state.email_sender,
+        outbox_config.get("path", "./data/outbox.sqlite3"),
+        batch_size=outbox_config.get("batch_size", 50),
+        poll_interval=outbox_config.get("poll_interval", 1.0),
+        max_attempts=outbox_config.get("max_attempts", 5),
+        lease_seconds=outbox_config.get("lease_seconds", 300)
+    )
+    app.state.email_outbox.start()
+
+    cache_config = app.state.config.get("quiz_cache", {})
+    app.state.quiz_cache = QuizCache(
+        cache_config.get("path", "./data/quiz_cache.sqlite3"),
+        memory_entries=cache_config.get("memory_entries", 256),
+        ttl_seconds=cache_config.get("ttl_seconds", 7 * 24 * 3600),
+        max_disk_bytes=cache_config.get("max_disk_bytes", 64 * 1024 * 1024)
+    )
+
+    bank_config = app.state.config.get("question_bank", {})
+    app.state.question_bank = None
+    # Reusing questions changes users' quizzes, so the bank is opt-in
+    if bank_config.get("enabled", False):
+        app.state.question_bank = QuestionBank(bank_config.get("path", "./data/question_bank.sqlite3"))
+
+    app.state.job_store = JobStore(app.state.config.get("job_database", "./data/jobs.sqlite3"))
+    # Jobs are leased from the store, so the queues of several server processes can share it
+    lease_seconds = app.state.config.get("job_lease_seconds", 60)
+    poll_interval = app.state.config.get("job_poll_interval", 1.0)
+    # Workers take the users' jobs in turn, by estimated cost, rather than in arrival order
+    job_cost = partial(estimated_cost, app.state.config)
+    job_calls = partial(estimated_calls, app.state.config)
+    app.state.job_queue = JobQueue(
+        app.state.job_store,
+        pipeline=partial(run_quiz_pipeline, app.state),
+        num_workers=app.state.config.get("job_workers", 4),
+        lease_seconds=lease_seconds,
+        poll_interval=poll_interval,
+        policy=SchedulingPolicy.from_config(app.state.config.get("scheduling"), cost=job_cost),
+        calls=job_calls
+    )
+    app.state.job_queue.start()
+
+    # Digests have their own queue, so their worker count caps them separately
+    digest_config = app.state.config.get("digest", {})
+    app.state.digest_store = DigestStore(digest_config.get("path", "./data/digest.sqlite3"))
+    app.state.digest_queue = JobQueue(
+        app.state.job_store,
+        pipeline=partial(run_quiz_pipeline, app.state),
+        num_workers=digest_config.get("workers", 2),
+        name="digest",
+        lease_seconds=lease_seconds,
+        poll_interval=poll_interval,
+        policy=SchedulingPolicy(cost=job_cost),
+        calls=job_calls
+    )
+    app.state.digest_queue.start()
+    app.state.digest_scheduler = DigestScheduler(
+        app.state.digest_store,
+        app.state.digest_queue,
+        run_at=digest_config.get("run_at", "03:00"),
+        num_mcq=digest_config.get("num_mcq", 7),
+        num_open=digest_config.get("num_open", 3),
+        stale_upload_seconds=digest_config.get("upload", {}).get("stale_seconds", 86400)
+    )
+    # Uploads cut off when the server last stopped are not resumed
+    app.state.digest_store.purge_uploads(app.state.digest_scheduler.stale_upload_seconds)
+    if digest_config.get("enabled", True):
+        app.state.digest_scheduler.start()
+
+    app.state.warm_up = asyncio.create_task(warm_up(app.state))
 
     yield
 
+    await app.state.digest_scheduler.stop()
+    await app.state.digest_queue.stop()
+    await app.state.job_queue.stop()
+    app.state.email_outbox.stop()
+    await app.state.agent.aclose()
     print("Server shutting down.")
 
 app = FastAPI(lifespan=lifespan)
@@ -46,45 +166,138 @@ app.add_middleware(
     allow_headers=["*"]
 )
 
+@app.middleware("http")
+async def tag_request(request: Request, call_next):
+    """Tag the logs of each request with an id, taken from `X-Request-ID` when the client sends one."""
+    token = request_id.set(request.headers.get("X-Request-ID") or new_request_id())
+    try:
+        response = await call_next(request)
+        response.headers["X-Request-ID"] = request_id.get()
+        return response
+    finally:
+        request_id.reset(token)
+
+@app.get("/healthz")
+async def healthz():
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    upstreams = {
+        "openrouter": app.state.agent.ready,
+        "google_forms": app.state.form_generator.ready,
+        "gmail": app.state.email_sender.ready
+    }
+    ready = all(upstreams.values())
+    return JSONResponse(
+        status_code=200 if ready else 503,
+        content={"status": "ready" if ready else "starting", "upstreams": upstreams}
+    )
+
 @app.post("/receive")
 async def receive_from_extension(data: ExtensionData):
-    print("Request received.")
-    
-    questions = generate_questions(
-        agent=app.state.agent,
-        messages=data.messages,
+    # Push back rather than queue work that would sit behind the upstream rate limits for too long
+    max_wait = app.state.config.get("rate_limits", {}).get("max_wait_seconds", 120)
+    wait = await estimated_wait(app.state, data)
+    if wait > max_wait:
+        metrics.REJECTED_REQUESTS.inc()
+        retry_after = math.ceil(wait - max_wait)
+        log(f"Request rejected, the queued work would wait {wait:.0f}s for the upstream rate limits.")
+        return JSONResponse(
+            status_code=429,
+            headers={"Retry-After": str(retry_after)},
+            content={"status": "busy", "estimated_wait": round(wait, 1), "retry_after": retry_after}
+        )
+    job_id = await app.state.job_queue.asubmit(data.model_dump())
+    # The job's own logs are tagged with the job id
+    log(f"Request received, queued as job {job_id}.")
+    return {"status": "queued", "job_id": job_id}
+
+@app.post("/digest/messages")
+async def receive_digest_messages(data: DigestMessages):
+    pending = await asyncio.to_thread(
+        app.state.digest_store.append,
+        data.user_email,
+        [message.model_dump() for message in data.messages],
         num_mcq=data.num_mcq,
-        num_open=data.num_open,
-        system_propmts=app.state.system_prompts
+        num_open=data.num_open
     )
+    log(f"Stored {len(data.messages)} message(s) for the next digest.")
+    return {"status": "stored", "pending_messages": pending}
 
-    quiz_title = generate_title(
-        agent=app.state.agent,
-        questions=questions,
-        system_propmts=app.state.system_prompts
-    )
+@app.post("/digest/messages/stream")
+async def stream_digest_messages(request: Request, user_email: str,
+                                 num_mcq: Optional[int] = None, num_open: Optional[int] = None):
+    """
+    Append an NDJSON body (one message per line) to the user's next digest.
+    The messages are stored as they arrive and only join the digest once the
+    whole upload is valid.
+    """
+    limits = app.state.config.get("digest", {}).get("upload", {})
+    max_bytes = limits.get("max_bytes", 64 * 1024 * 1024)
+    if int(request.headers.get("content-length") or 0) > max_bytes:
+        raise HTTPException(status_code=413, detail=f"The upload is larger than {max_bytes} bytes.")
 
-    form_url = app.state.form_generator.create_quiz_from_json(
-        questions,
-        form_title=quiz_title
-    )
+    store = app.state.digest_store
+    upload_id, received_at, received = uuid.uuid4().hex, time.time(), 0
+    try:
+        async for batch in message_batches(
+            request.stream(),
+            batch_size=limits.get("batch_size", 500),
+            max_bytes=max_bytes,
+            max_messages=limits.get("max_messages", 100_000),
+            max_line_bytes=limits.get("max_line_bytes", 1024 * 1024)
+        ):
+            await asyncio.to_thread(store.stage, upload_id, user_email, batch, received_at)
+            received += len(batch)
+    except Exception:
+        await asyncio.to_thread(store.discard_upload, upload_id, user_email)
+        raise
+    pending = await asyncio.to_thread(store.commit_upload, upload_id, user_email, num_mcq=num_mcq, num_open=num_open)
+    log(f"Stored {received} streamed message(s) for the next digest.")
+    return {"status": "stored", "messages": received, "pending_messages": pending}
 
-    print(f"Quiz generated at URL: {form_url}")
+@app.post("/digest/run")
+async def run_digest():
+    """Queue today's digests now instead of waiting for the scheduled time."""
+    job_ids = await asyncio.to_thread(app.state.digest_scheduler.run_once)
+    return {"status": "queued", "job_ids": job_ids}
 
-    email_subject = f"MindfuLLM - {quiz_title}"
-    email_sender_name = app.state.config.get("email_sender_name")
-    email_body = build_email_body(form_url)
+@app.get("/cache/stats")
+async def get_cache_stats():
+    return app.state.quiz_cache.stats()
 
-    try:
-        message_id = app.state.email_sender.send_email(
-            recipient=data.user_email,
-            subject=email_subject,
-            body=email_body,
-            sender_name=email_sender_name
-        )
-        print(f"Emailed form link to {data.user_email} (message id: {message_id})")
-    except Exception as exc:
-         print(f"Unable to email form link: {exc}", file=sys.stderr)
+@app.get("/bank/stats")
+async def get_bank_stats():
+    if app.state.question_bank is None:
+        raise HTTPException(status_code=404, detail="The question bank is disabled.")
+    return await asyncio.to_thread(app.state.question_bank.stats)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    for event, value in app.state.quiz_cache.stats().items():
+        metrics.QUIZ_CACHE.labels(event).set(value)
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/agent/stats")
+async def get_agent_stats():
+    return app.state.agent.generation_stats()
 
+@app.get("/jobs/{job_id}")
+async def get_job(job_id: str):
+    job = await asyncio.to_thread(app.state.job_store.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
 
-    return {"status": "ok"}
\ No newline at end of file
+    return {
+        "job_id": job["job_id"],
+        "queue": job["queue"],
+        "lane": job["lane"],
+        "cost": job["cost"],
+        "stage": job["stage"],
+        "timings": job["timings"],
+        "form_url": job["form_url"],
+        "error": job["error"],
+        "created_at": job["created_at"],
+        "updated_at": job["updated_at"]
+    }
@@ -1,10 +1,27 @@
 from __future__ import annotations
 from src.enums.agent import *
-from typing import Optional
-from copy import deepcopy
-from openai import OpenAI
+from typing import Callable, Optional, TYPE_CHECKING
+from src.agent.schema import CompiledTemplate, compile_template, strip_fences
+from src.agent.stream import StreamingTemplateChecker
+from src.agent.tokens import MESSAGE_OVERHEAD, message_tokens, truncate_to_tokens
+from src.agent.traffic import TrafficLog
+from src.agent.pool import Model, ModelPool, ROUTING_ROUNDS
+from src.dedup import QuestionIndex
+from src.ratelimit import TokenBucket
+from src import metrics
+from src.logs import log
+from collections import Counter
+import asyncio
+import time
+import threading
 import json
 
+if TYPE_CHECKING:
+    from openai import OpenAI, AsyncOpenAI
+
+# Words in a 400 response telling that the provider or model does not support structured output
+UNSUPPORTED_FORMAT_MARKERS = ("response_format", "json_schema", "unsupported parameter")
+
 def create_message(role: str, content: str) -> dict:
     return {
         'role': role,
@@ -12,13 +29,28 @@ def create_message(role: str, content: str) -> dict:
     }
 
 class Conversation:
-    def __init__(self) -> None:
-        self.messages = []
+    """
+    The messages of a chat, the system message (if any) first.
+
+    Message dicts are never modified in place, so copies share them: slicing
+    only copies the list of references. The estimated token count of every
+    message is kept alongside it, and their total in `tokens`.
+    """
+
+    def __init__(self, messages: Optional[list[dict]] = None, token_counts: Optional[list[int]] = None) -> None:
+        self.messages = list(messages or [])
+        self._token_counts = list(token_counts) if token_counts is not None else [message_tokens(m) for m in self.messages]
+        self.tokens = sum(self._token_counts)
+        # Number of leading messages shared by the calls of a request, marked for provider caching
+        self.cached_prefix = None
 
     def insert(self, i: int, role: str, content: str) -> dict:
-       message = create_message(role, content)
-       self.messages.insert(i, message)
-       return message
+        message = create_message(role, content)
+        count = message_tokens(message)
+        self.messages.insert(i, message)
+        self._token_counts.insert(i, count)
+        self.tokens += count
+        return message
 
     def prepend(self, role: str, content: str) -> dict:
         return self.insert(0, role, content)
@@ -27,24 +59,96 @@ class Conversation:
         return self.insert(len(self), role, content)
     
     def pop(self, i: int = -1) -> dict:
+        self.tokens -= self._token_counts.pop(i)
         return self.messages.pop(i)
 
+    def _replace(self, i: int, message: dict) -> None:
+        count = message_tokens(message)
+        self.tokens += count - self._token_counts[i]
+        self.messages[i] = message
+        self._token_counts[i] = count
+
+    @property
+    def has_system(self) -> bool:
+        return bool(self.messages) and self.messages[0]['role'] == RoleEnum.SYSTEM.value
+
     def set_system(self, content: str) -> dict:
+        """Replace the system message, or put one in front."""
         system_message = create_message(RoleEnum.SYSTEM.value, content)
-        self.messages = [system_message] + [m for m in self.messages if m['role'] != RoleEnum.SYSTEM.value]
+        if self.has_system:
+            self._replace(0, system_message)
+        else:
+            self.messages.insert(0, system_message)
+            self._token_counts.insert(0, message_tokens(system_message))
+            self.tokens += self._token_counts[0]
         return system_message
 
+    def _keep(self, head: int, start: int, extra: Optional[dict] = None) -> None:
+        """Keep the first `head` messages, then `extra` if given, then the messages from `start` on."""
+        messages = self.messages[:head] + ([extra] if extra else []) + self.messages[start:]
+        counts = self._token_counts[:head] + ([message_tokens(extra)] if extra else []) + self._token_counts[start:]
+        self.messages, self._token_counts, self.tokens = messages, counts, sum(counts)
+        self.cached_prefix = None
+
     def shorten_to(self, last_n: int) -> Conversation:
-        self.messages = [self.messages[0]] + self.messages[-(max(last_n - 1, 0)):]
+        """Keep the first message and the latest `last_n - 1`."""
+        self._keep(1, max(len(self) - max(last_n - 1, 0), 1))
         return self
-    
+
+    def fit_to_tokens(self, budget: int, summarize: Optional[Callable[[list[dict]], str]] = None) -> Conversation:
+        """
+        Drop the oldest turns until the conversation fits in `budget` tokens.
+        The system message and the latest message are always kept, the latter
+        truncated if it alone is over budget. The newest of the dropped turns
+        is kept truncated to the room left, or with `summarize`, the dropped
+        turns are replaced by a message with their summary, if it fits.
+        Raises ValueError if the system message leaves no room for the latest.
+        """
+        if self.tokens <= budget or not self.messages:
+            return self
+        head = 1 if self.has_system else 0
+        # Cutting the system message would change the instructions: fail instead
+        required = sum(self._token_counts[:head]) + (MESSAGE_OVERHEAD if len(self) > head else 0)
+        if required > budget:
+            raise ValueError(
+                f"The system message takes {self._token_counts[0] if head else 0} tokens, "
+                f"which leaves no room for the conversation in a budget of {budget}."
+            )
+        start = max(len(self) - 1, head)
+        used = sum(self._token_counts[:head]) + sum(self._token_counts[start:])
+        while start > head and used + self._token_counts[start - 1] <= budget:
+            start -= 1
+            used += self._token_counts[start]
+
+        summary = None
+        if summarize is not None and start > head:
+            summary = create_message(
+                RoleEnum.USER.value,
+                "Summary of the earlier conversation:\n" + summarize(self.messages[head:start])
+            )
+            if used + message_tokens(summary) > budget:
+                summary = None
+        elif start > head and budget - used > MESSAGE_OVERHEAD:
+            boundary = self.messages[start - 1]
+            summary = create_message(boundary['role'], truncate_to_tokens(boundary['content'], budget - used - MESSAGE_OVERHEAD))
+        self._keep(head, start, summary)
+
+        if self.tokens > budget:
+            last = self.messages[-1]
+            room = budget - (self.tokens - self._token_counts[-1]) - MESSAGE_OVERHEAD
+            self._replace(len(self) - 1, create_message(last['role'], truncate_to_tokens(last['content'], room)))
+        return self
+
     def __len__(self) -> int:
         return len(self.messages)
     
     def __getitem__(self, key: INDEX) -> Conversation|dict:
         if isinstance(key, slice):
-            conversation = deepcopy(self)
-            conversation.messages = self.messages[key.start:key.stop:key.step]
+            conversation = Conversation(self.messages[key], self._token_counts[key])
+            # A copy from the start keeps the request's shared prefix
+            if not key.start and key.step in (None, 1) and self.cached_prefix is not None \
+                    and self.cached_prefix <= len(conversation):
+                conversation.cached_prefix = self.cached_prefix
             return conversation
         else:
             return self.messages[key]
@@ -55,9 +159,9 @@ class Conversation:
             if len(r) != len(value):
                 raise ValueError('Value length does not equal length of slice')
             for i, v in zip(r, value):
-                self.messages[i] = (v)
+                self._replace(i, v)
         else:
-            self.messages[key] = value
+            self._replace(key, value)
     
     def __iter__(self) -> dict:
         for message in self.messages:
@@ -67,57 +171,89 @@ class Conversation:
     def __repr__(self) -> str:
         return '\n'.join((f'{message["role"]}: {message["content"]}' for message in self.messages))
 
-class Agent:
-    config = {}
-
-    def __init__(self,
-                 config: dict,
-                 default_system_prompt: str = '',
-                 generation_attempts: int = 5
-            ) -> None:
-        self.ai = OpenAI(
-            base_url = config['base_url'],
-            api_key = config['api_key']
-        )
-
-        self.chat_model = config["chat_model"]
-        self.generation_attempts = generation_attempts
+class AgentSession:
+    """
+    Conversation state of a single request. Sessions are cheap to create and
+    all share the HTTP connection pool and concurrency limit of their Agent,
+    so overlapping requests never see each other's context.
+    """
 
+    def __init__(self, agent: Agent, system_prompt: str = '') -> None:
+        self.agent = agent
         self.conversation = Conversation()
-        
-        Agent.config.update({
-            RoleEnum.SYSTEM.value: default_system_prompt
-        })
-        self.conversation.set_system(default_system_prompt)
-
-    def reset_conversation(self) -> None:
-        self.conversation = Conversation()
+        self.conversation.set_system(system_prompt)
 
     def send_message(self, content: str) -> dict:
         return self.conversation.append(
             RoleEnum.USER.value,
             content
         )
-    
+
+    def _generate(self, output_template: dict, many: bool = False,
+                  conversation: Optional[Conversation] = None) -> tuple[str, dict | list]:
+        compiled = compile_template(output_template)
+        conversation = conversation if conversation is not None else self.conversation
+        for attempt in range(1, self.agent.generation_attempts + 1):
+            self.agent.record_request(compiled, attempt)
+            content = self.agent.complete(conversation, self.agent.response_format(compiled, many))
+            parsed = compiled.parse(content)
+            if parsed is not None:
+                self.agent.record_attempts(attempt)
+                return content, parsed
+            self.agent.record_invalid(compiled)
+        raise Exception(f"Response generation failed after {self.agent.generation_attempts} attempts.")
+
+    async def _agenerate(self, conversation: Conversation, output_template: dict,
+                         many: bool = False) -> tuple[str, dict | list]:
+        compiled = compile_template(output_template)
+        for attempt in range(1, self.agent.generation_attempts + 1):
+            checker = StreamingTemplateChecker(output_template, many) if self.agent.stream_responses else None
+            self.agent.record_request(compiled, attempt)
+            content = await self.agent.acomplete(
+                conversation, self.agent.response_format(compiled, many), checker,
+                validate=lambda content: compiled.parse(content) is not None
+            )
+            parsed = compiled.parse(content)
+            if parsed is not None:
+                self.agent.record_attempts(attempt)
+                return content, parsed
+            self.agent.record_invalid(compiled)
+        raise Exception(f"Response generation failed after {self.agent.generation_attempts} attempts.")
+
+    def layout(self, conversation: Conversation, system_prompt: str, instructions: str) -> Conversation:
+        """
+        Lay out the system prompt and the per-call `instructions`. With the
+        prefix cache layout the instructions follow the conversation in a
+        message of their own, so every call of the request starts with the
+        same system prompt and transcript.
+        """
+        if not instructions:
+            conversation.set_system(system_prompt)
+        elif self.agent.prompt_layout == PromptLayoutEnum.PREFIX_CACHE.value:
+            conversation.set_system(system_prompt)
+            conversation.cached_prefix = len(conversation)
+            conversation.append(RoleEnum.USER.value, instructions)
+        else:
+            conversation.set_system(f"{system_prompt}\n\n{instructions}")
+        return conversation
+
     def receive_response(self, 
                          output_template: dict, 
                          system_prompt: str = "", 
-                         auto_append: bool = True) -> dict:
-        self.conversation.set_system(system_prompt)
+                         auto_append: bool = True,
+                         many: bool = False,
+                         instructions: str = "") -> dict:
+        """
+        Generate a response matching `output_template`, regenerating invalid
+        ones. Set `many` when a list of such objects is expected.
+        """
+        conversation = self.conversation
+        if instructions:
+            # The instructions message is not part of the session's conversation
+            conversation = self.conversation[:]
+        self.layout(conversation, system_prompt, instructions)
 
-        retries = self.generation_attempts
-        content = ""
-        while not self.valid_response(content, output_template) and retries > 0:
-            retries -= 1
-            response = self.ai.chat.completions.create(
-                messages = self.conversation.messages,
-                model = self.chat_model
-            )
-            _message = response.choices[0].message
-            content = self.postprocess(_message.content)
-        if retries == 0:
-            if not self.valid_response(content, output_template):
-                raise Exception(f"Response generation failed after {self.generation_attempts} attempts.")
+        content, _ = self._generate(output_template, many, conversation)
         message = create_message(
             RoleEnum.ASSISTANT.value,
             content
@@ -125,50 +261,538 @@ class Agent:
         if auto_append:
             self.conversation.append(**message)
         return message
-    
-    def postprocess(self, content: str) -> str:
-        # This postprocessing deems necessary, because the LLM likes to wrap its answer
-        # in ```json ```
-        return content.strip("```").strip("json")
-    
-    def _valid_response(self, content: str | dict, output_template: dict) -> bool:
-        if content == "":
-            return False
-        else:
+
+    async def areceive_response(self,
+                                output_template: dict,
+                                system_prompt: str = "",
+                                many: bool = False,
+                                instructions: str = "") -> dict:
+        """
+        Async counterpart of `receive_response`. It works on a copy of the
+        conversation, so many calls can be awaited concurrently against the
+        same context without interfering with each other.
+        """
+        conversation = self.layout(self.conversation[:], system_prompt, instructions)
+
+        content, _ = await self._agenerate(conversation, output_template, many)
+        return create_message(
+            RoleEnum.ASSISTANT.value,
+            content
+        )
+
+    async def areceive_json(self,
+                            output_template: dict,
+                            system_prompt: str = "",
+                            many: bool = False,
+                            instructions: str = "") -> dict | list:
+        """Like `areceive_response`, but returns the already parsed and validated output."""
+        conversation = self.layout(self.conversation[:], system_prompt, instructions)
+
+        _, parsed = await self._agenerate(conversation, output_template, many)
+        return parsed
+
+    async def areceive_items(self,
+                             output_template: dict,
+                             system_prompt: str,
+                             count: int,
+                             item_name: str = "items",
+                             summary_key: str = "question",
+                             index: Optional[QuestionIndex] = None) -> list[dict]:
+        """
+        Generate a list of `count` objects matching `output_template`, accepting
+        them item by item. Valid items of a partially invalid list are kept, and
+        only the missing number is requested again. With an `index`, items whose
+        `summary_key` is a near-duplicate of an indexed one are dropped as well,
+        and the accepted ones are added to it.
+        """
+        compiled = compile_template(output_template)
+        accepted = []
+        duplicates = []
+        for attempt in range(1, self.agent.generation_attempts + 1):
+            missing = count - len(accepted)
+            conversation = self.layout(self.conversation[:], system_prompt, f"Generate exactly {missing} {item_name}.")
+
+            # Not streamed: aborting on the first bad item would lose the good ones
+            self.agent.record_request(compiled, attempt)
+            content = await self.agent.acomplete(conversation)
             try:
-                if type(content) == str:
-                    response = json.loads(content)
-                elif type(content) == dict:
-                    response = content
-                else:
-                    print("Wrong content type.")
-                    return False
-                if set(response.keys()) != set(output_template.keys()):
-                    print("Keys do not match.")
-                    print(set(response.keys()), set(output_template.keys()))
-                    return False
-                for key, value in response.items():
-                    if type(value) != type(output_template[key]):
-                        print("Type mismatch.")
-                        print(type(value), type(output_template[key]))
-                        return False
-                    if type(output_template[key]) == dict:
-                        valid = self._valid_response(value, output_template[key])
-                        if not valid:
-                            print("Value dict invalid.")
-                            print(value, output_template[key])
-                            return False
-            except:
-                return False
+                items = json.loads(content)
+            except ValueError:
+                items = []
+            if not isinstance(items, list):
+                items = [items]
+
+            valids = compiled.validate_items(items)
+            new_items = []
+            for item, valid in zip(items, valids):
+                if len(new_items) == missing:
+                    break
+                if not valid:
+                    continue
+                if index is not None and not self.agent.accept_unique(index, str(item[summary_key])):
+                    duplicates.append(item)
+                    continue
+                new_items.append(item)
+            self.agent.stats["items_requested"] += missing
+            self.agent.stats["items_accepted"] += len(new_items)
+            if new_items and not all(valids):
+                # Items a whole-list validation would have thrown away
+                self.agent.stats["items_salvaged"] += len(new_items)
+            accepted += new_items
+
+            if len(accepted) >= count:
+                self.agent.record_attempts(attempt)
+                return accepted
+            self.agent.record_invalid(compiled)
+        if len(accepted) + len(duplicates) >= count:
+            # Better a repeated question than no quiz
+            log(f"Accepting {count - len(accepted)} near-duplicate {item_name}.")
+            return accepted + duplicates[:count - len(accepted)]
+        raise Exception(f"Generated {len(accepted)} of {count} {item_name} after {self.agent.generation_attempts} attempts.")
+
+class Agent:
+    """
+    Shared, stateless access to the chat model. One Agent serves the whole
+    server: it owns the pooled keep-alive HTTP clients, while the
+    conversation of each request lives in its own `AgentSession`.
+    """
+
+    def __init__(self,
+                 config: dict,
+                 default_system_prompt: str = '',
+                 generation_attempts: int = 5
+            ) -> None:
+        self.config = dict(config)
+        self.default_system_prompt = default_system_prompt
+
+        # The OpenAI clients are created on first use, one per endpoint, see `client`
+        self._clients = {}
+        self._client_lock = threading.Lock()
+        # Caps the number of in-flight async completions
+        self.semaphore = asyncio.Semaphore(config.get("max_concurrency", 8))
+
+        # Models to route completions to, in order of preference
+        self.pool = ModelPool.from_config(self.config)
+        # Client-side limit on the requests sent to the endpoint, shared by all sessions
+        self.rate_limiter = TokenBucket.from_config("openrouter", config.get("rate_limits", {}).get("openrouter"))
+        self.chat_model = self.pool.primary.name
+        self.generation_attempts = generation_attempts
+        # Send the output templates as JSON Schemas through `response_format`
+        self.structured_output = config.get("structured_output", True)
+        # Stream async completions and abort them as soon as they diverge from the template
+        self.stream_responses = config.get("stream_responses", True)
+        # Prompt tokens a request may use, below the smallest context window of the pool
+        self.context_tokens = config.get("context_tokens")
+        # Where per-call instructions go, and whether the cacheable prefix is marked with cache_control
+        layout = config.get("prompt_layout", {})
+        self.prompt_layout = layout.get("mode", PromptLayoutEnum.SYSTEM.value)
+        self.cache_control = layout.get("cache_control", False)
+        # Generation outcomes, to see how much rework validation failures cause
+        self.stats = {
+            "completions": 0,
+            "invalid_responses": 0,
+            "stream_aborts": 0,
+            "items_requested": 0,
+            "items_accepted": 0,
+            "items_salvaged": 0,
+            "duplicates": 0,
+            "prompt_tokens": 0,
+            "cached_prompt_tokens": 0
+        }
+        # Attempt number -> number of generations that succeeded on that attempt
+        self.attempts = Counter()
+
+        # Optional recording or replay of the model traffic, for deterministic offline runs
+        traffic = config.get("llm_traffic", {})
+        self.traffic = None
+        if traffic.get("mode", TrafficModeEnum.OFF.value) != TrafficModeEnum.OFF.value:
+            self.traffic = TrafficLog(
+                traffic.get("path", "./data/llm_traffic.jsonl.gz"),
+                traffic["mode"],
+                replay_latency=traffic.get("replay_latency", False)
+            )
+
+    def client(self, model: Model, asynchronous: bool = True) -> OpenAI | AsyncOpenAI:
+        """Pooled client for the endpoint of `model`, created on first use."""
+        key = (asynchronous, model.base_url, model.api_key)
+        client = self._clients.get(key)
+        if client is None:
+            with self._client_lock:
+                client = self._clients.get(key)
+                if client is None:
+                    client = self._clients[key] = self._create_client(model, asynchronous)
+        return client
+
+    def _create_client(self, model: Model, asynchronous: bool) -> OpenAI | AsyncOpenAI:
+        # openai is a heavy import, so it is deferred until the first completion
+        import httpx
+        from openai import OpenAI, AsyncOpenAI, DefaultHttpxClient, DefaultAsyncHttpxClient
+        limits = httpx.Limits(
+            max_connections = self.config.get("max_connections", 32),
+            max_keepalive_connections = self.config.get("max_connections", 32),
+            keepalive_expiry = self.config.get("keepalive_expiry", 60)
+        )
+        args = {"base_url": model.base_url, "api_key": model.api_key}
+        if len(self.pool.models) > 1:
+            # Rather than retrying a slow or rate-limited model, fall back to the next one
+            args["max_retries"] = 0
+        if asynchronous:
+            return AsyncOpenAI(**args, http_client=DefaultAsyncHttpxClient(limits=limits))
+        return OpenAI(**args, http_client=DefaultHttpxClient(limits=limits))
+
+    @property
+    def ai(self) -> OpenAI:
+        return self.client(self.pool.primary, asynchronous=False)
+
+    @property
+    def async_ai(self) -> AsyncOpenAI:
+        return self.client(self.pool.primary)
+
+    @property
+    def ready(self) -> bool:
+        """Whether the async client, used by the job pipeline, has been created."""
+        if self.traffic is not None and self.traffic.replaying:
             return True
-    
-    def valid_response(self, content: str | list, output_template: dict) -> bool:
+        primary = self.pool.primary
+        return bool(primary.api_key) and (True, primary.base_url, primary.api_key) in self._clients
+
+    def session(self, system_prompt: Optional[str] = None) -> AgentSession:
+        if system_prompt is None:
+            system_prompt = self.default_system_prompt
+        return AgentSession(self, system_prompt)
+
+    def record_request(self, compiled: CompiledTemplate, attempt: int) -> None:
+        metrics.LLM_REQUESTS.labels(compiled.name).inc()
+        if attempt > 1:
+            metrics.LLM_RETRIES.labels(compiled.name).inc()
+
+    def record_invalid(self, compiled: CompiledTemplate) -> None:
+        self.stats["invalid_responses"] += 1
+        metrics.LLM_VALIDATION_FAILURES.labels(compiled.name).inc()
+
+    def record_attempts(self, attempt: int) -> None:
+        self.attempts[attempt] += 1
+
+    def accept_unique(self, index: QuestionIndex, text: str) -> bool:
+        """Add `text` to the index, unless it is a near-duplicate of an accepted question."""
+        if index.add(text):
+            return True
+        self.stats["duplicates"] += 1
+        metrics.QUESTION_DUPLICATES.inc()
+        return False
+
+    def record_usage(self, model: str, usage) -> None:
+        """Count the tokens reported in a response's `usage`, when the provider sends it."""
+        if usage is None:
+            return
+        # Prompt tokens served from the provider's prefix cache, when it reports them
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = (getattr(details, "cached_tokens", None) or 0) if details is not None else 0
+        metrics.LLM_TOKENS.labels(model, "prompt").inc(usage.prompt_tokens or 0)
+        metrics.LLM_TOKENS.labels(model, "cached").inc(cached)
+        metrics.LLM_TOKENS.labels(model, "completion").inc(usage.completion_tokens or 0)
+        self.stats["prompt_tokens"] += usage.prompt_tokens or 0
+        self.stats["cached_prompt_tokens"] += cached
+
+    def generation_stats(self) -> dict:
+        return {
+            **self.stats,
+            "attempts": dict(sorted(self.attempts.items())),
+            "models": self.pool.stats()
+        }
+
+    def response_format(self, compiled: CompiledTemplate, many: bool = False) -> Optional[dict]:
+        """
+        Provider-side constraint for the output, if structured output is enabled.
+        Lists are left unconstrained, as providers only accept object schemas.
+        """
+        if not self.structured_output or many:
+            return None
+        return compiled.response_format()
+
+    def _completion_args(self, conversation: Conversation, response_format: Optional[dict]) -> dict:
+        if self.context_tokens and conversation.tokens > self.context_tokens:
+            log(f"Fitting a ~{conversation.tokens}-token conversation to the {self.context_tokens}-token context budget.")
+            conversation = conversation[:].fit_to_tokens(self.context_tokens)
+        messages = conversation.messages
+        if self.cache_control and conversation.cached_prefix:
+            # Breakpoint at the end of the shared prefix, for providers that cache explicitly
+            messages = list(messages)
+            last = messages[conversation.cached_prefix - 1]
+            messages[conversation.cached_prefix - 1] = {
+                "role": last["role"],
+                "content": [{"type": "text", "text": last["content"], "cache_control": {"type": "ephemeral"}}]
+            }
+        args = {
+            "messages": messages,
+            "model": self.chat_model
+        }
+        if response_format is not None:
+            args["response_format"] = response_format
+        return args
+
+    def _unsupported_format(self, error: Exception) -> bool:
+        """
+        Turn structured output off if the provider rejected the request for its
+        `response_format`. Returns whether it did; other bad requests (context
+        length, malformed messages, ...) leave it on.
+        """
+        details = f"{error} {json.dumps(getattr(error, 'body', None), default=str)}".lower()
+        if not any(marker in details for marker in UNSUPPORTED_FORMAT_MARKERS):
+            return False
+        log(f"Structured output rejected by the provider, falling back to plain JSON: {error}")
+        self.structured_output = False
+        return True
+
+    def complete(self, conversation: Conversation, response_format: Optional[dict] = None) -> str:
+        """Single completion for the conversation, without any validation."""
+        self.stats["completions"] += 1
+        args = self._completion_args(conversation, response_format)
+        if self.traffic is not None:
+            return self.traffic.complete(args, lambda: self._route(args))
+        return self._route(args)
+
+    def _route(self, args: dict) -> str:
+        """Try the models of the pool in turn until one answers."""
+        for round in range(ROUTING_ROUNDS):
+            try:
+                return self._route_once(args)
+            except Exception as exc:
+                if round == ROUTING_ROUNDS - 1 or not self._routable(exc):
+                    raise
+            time.sleep(self._hold_off(self.pool.retry_delay(round)))
+
+    def _route_once(self, args: dict) -> str:
+        error = None
+        for model in self.pool.ranked():
+            start = time.perf_counter()
+            try:
+                content = self._complete(model, {**args, "model": model.name})
+            except Exception as exc:
+                if not self._fall_back(model, exc):
+                    raise
+                error = exc
+                continue
+            self.pool.record_success(model, time.perf_counter() - start)
+            return content
+        raise error
+
+    def _complete(self, model: Model, args: dict) -> str:
+        from openai import BadRequestError
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
         try:
-            loaded_content = json.loads(content)
-            if type(loaded_content) == dict:
-                return self._valid_response(content, output_template)
-            elif type(loaded_content) == list:
-                valids = [self._valid_response(question, output_template) for question in loaded_content]
-                return not (False in valids)
-        except:
-            return False
\ No newline at end of file
+            response = self.client(model, asynchronous=False).chat.completions.create(**args)
+        except BadRequestError as error:
+            if "response_format" not in args or not self._unsupported_format(error):
+                raise
+            return self._complete(model, {key: value for key, value in args.items() if key != "response_format"})
+        self.record_usage(model.name, response.usage)
+        _message = response.choices[0].message
+        return self.postprocess(_message.content)
+
+    async def acomplete(self, conversation: Conversation, response_format: Optional[dict] = None,
+                        checker: Optional[StreamingTemplateChecker] = None,
+                        validate: Optional[Callable[[str], bool]] = None) -> str:
+        """
+        Single completion for the conversation, without any validation. With a
+        `checker` the completion is streamed, and an empty string is returned as
+        soon as the checker rejects the partial output.
+
+        The completion is routed through the model pool: a model that fails is
+        replaced by the next one, and one that is slower than usual is hedged
+        with a second request to the next model. With `validate`, the first
+        response it accepts wins; otherwise the first response does.
+        """
+        self.stats["completions"] += 1
+        args = self._completion_args(conversation, response_format)
+        if self.traffic is not None:
+            return await self.traffic.acomplete(
+                args, lambda: self._aroute(args, checker, validate), stream=checker is not None
+            )
+        return await self._aroute(args, checker, validate)
+
+    async def _attempt(self, model: Model, args: dict, checker: Optional[StreamingTemplateChecker],
+                       on_sent: Callable[[], None]) -> tuple[Model, str]:
+        async with self.semaphore:
+            if self.rate_limiter is not None:
+                await self.rate_limiter.aacquire()
+            on_sent()
+            start = time.perf_counter()
+            try:
+                content = await self._acomplete(model, {**args, "model": model.name}, checker)
+            except asyncio.CancelledError:
+                # Lost to a hedged request
+                self.pool.record(model, "cancelled")
+                raise
+        # Aborted streams end early, so their duration says nothing about the model's latency
+        self.pool.record_success(model, time.perf_counter() - start if content else None)
+        return model, content
+
+    async def _aroute(self, args: dict, checker: Optional[StreamingTemplateChecker],
+                      validate: Optional[Callable[[str], bool]]) -> str:
+        for round in range(ROUTING_ROUNDS):
+            try:
+                return await self._aroute_once(args, checker, validate)
+            except Exception as exc:
+                if round == ROUTING_ROUNDS - 1 or not self._routable(exc):
+                    raise
+            await asyncio.sleep(self._hold_off(self.pool.retry_delay(round)))
+
+    async def _aroute_once(self, args: dict, checker: Optional[StreamingTemplateChecker],
+                           validate: Optional[Callable[[str], bool]]) -> str:
+        candidates = self.pool.ranked()
+        pending = {}
+        hedges = set()
+        # Model -> when its request got past the concurrency limit and was sent
+        sent_at = {}
+        error = None
+        fallback = None
+
+        def launch() -> asyncio.Task:
+            model = candidates.pop(0)
+            # Every request needs a checker of its own
+            own_checker = StreamingTemplateChecker(checker.template, checker.many) if checker else None
+            on_sent = lambda: sent_at.__setitem__(model, time.monotonic())
+            task = asyncio.create_task(self._attempt(model, args, own_checker, on_sent))
+            pending[task] = model
+            return task
+
+        self.pool.record_request()
+        hedging = True
+        launch()
+        try:
+            while pending:
+                delay = None
+                if hedging and candidates and len(pending) == 1:
+                    current = next(iter(pending.values()))
+                    delay = self.pool.hedge_delay(current)
+                    if delay is not None and current in sent_at:
+                        delay = max(delay - (time.monotonic() - sent_at[current]), 0)
+                done, _ = await asyncio.wait(pending, timeout=delay, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    if current not in sent_at:
+                        # Still waiting for a free slot, which says nothing about the model
+                        continue
+                    if not self._may_hedge():
+                        # Let the request run rather than spend quota on a second one
+                        metrics.LLM_HEDGES.labels("skipped").inc()
+                        hedging = False
+                        continue
+                    # The request is slower than usual for this model: hedge it
+                    self.pool.record(candidates[0], "hedges")
+                    metrics.LLM_HEDGES.labels("sent").inc()
+                    hedges.add(launch())
+                    continue
+                for task in done:
+                    model = pending.pop(task)
+                    try:
+                        _, content = task.result()
+                    except Exception as exc:
+                        if not self._fall_back(model, exc):
+                            raise
+                        error = exc
+                        if candidates and not pending:
+                            launch()
+                        continue
+                    valid = validate(content) if validate is not None else True
+                    if validate is not None:
+                        self.pool.record_validity(model, valid)
+                    if valid:
+                        if task in hedges:
+                            self.pool.record(model, "hedge_wins")
+                            metrics.LLM_HEDGES.labels("won").inc()
+                        return content
+                    # Wait for a hedged request still running, it may be valid
+                    fallback = content
+            if fallback is not None:
+                return fallback
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _may_hedge(self) -> bool:
+        """Whether a hedge may be sent: not while the rate limiter queues requests, and within the hedge budget."""
+        if self.rate_limiter is not None and self.rate_limiter.wait_time() > 0:
+            return False
+        return self.pool.take_hedge()
+
+    def _hold_off(self, seconds: float) -> float:
+        """
+        Every model failed: pause the rate limiter, so that all other requests
+        wait too. Returns how long the caller should still sleep itself.
+        """
+        if self.rate_limiter is None:
+            return seconds
+        self.rate_limiter.pause(seconds)
+        return 0.0
+
+    @staticmethod
+    def _routable(error: Exception) -> bool:
+        """Whether the error is the model's or endpoint's, so another model (or a later try) may succeed."""
+        from openai import APIConnectionError, APIStatusError, APITimeoutError, RateLimitError
+        return isinstance(error, (RateLimitError, APIConnectionError, APITimeoutError)) or (
+            isinstance(error, APIStatusError) and error.status_code >= 500)
+
+    def _fall_back(self, model: Model, error: Exception) -> bool:
+        """Record a failed request; whether another model should be tried instead."""
+        from openai import RateLimitError
+        if not self._routable(error):
+            return False
+        if isinstance(error, RateLimitError):
+            retry_after = error.response.headers.get("retry-after")
+            try:
+                retry_after = float(retry_after) if retry_after is not None else None
+            except ValueError:
+                retry_after = None
+            self.pool.record_error(model, rate_limited=True, retry_after=retry_after)
+            log(f"Model {model.name} is rate limited, falling back.")
+        else:
+            self.pool.record_error(model)
+            log(f"Model {model.name} failed, falling back: {error}")
+        return True
+
+    async def _acomplete(self, model: Model, args: dict, checker: Optional[StreamingTemplateChecker]) -> str:
+        from openai import BadRequestError
+        try:
+            if checker is not None:
+                return await self._astream(model, args, checker)
+            response = await self.client(model).chat.completions.create(**args)
+        except BadRequestError as error:
+            if "response_format" not in args or not self._unsupported_format(error):
+                raise
+            return await self._acomplete(model, {key: value for key, value in args.items() if key != "response_format"}, checker)
+        self.record_usage(model.name, response.usage)
+        _message = response.choices[0].message
+        return self.postprocess(_message.content)
+
+    async def _astream(self, model: Model, args: dict, checker: StreamingTemplateChecker) -> str:
+        # The token usage of a stream comes in a last chunk without choices
+        stream = await self.client(model).chat.completions.create(
+            **args, stream=True, stream_options={"include_usage": True}
+        )
+        parts = []
+        try:
+            async for chunk in stream:
+                self.record_usage(model.name, getattr(chunk, "usage", None))
+                if not chunk.choices or not chunk.choices[0].delta.content:
+                    continue
+                parts.append(chunk.choices[0].delta.content)
+                if not checker.feed(parts[-1]):
+                    self.stats["stream_aborts"] += 1
+                    log(f"Aborted response after {sum(map(len, parts))} characters: {checker.error}")
+                    return ""
+        finally:
+            await stream.close()
+        return self.postprocess("".join(parts))
+
+    async def aclose(self) -> None:
+        for (asynchronous, _, _), client in self._clients.items():
+            if asynchronous:
+                await client.close()
+            else:
+                client.close()
+    
+    def postprocess(self, content: Optional[str]) -> str:
+        return strip_fences(content or "")
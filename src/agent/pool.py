@@ -0,0 +1,192 @@
+'''
+Pool of chat models the Agent can route a completion to.
+
+Models are listed in order of preference in `models` in the config, each
+optionally on its own endpoint. The pool keeps per-model latency, error and
+validity statistics and ranks the models with them: models that were rate
+limited are skipped for a cooldown, models failing most of their recent
+requests go last, and among the rest the one with the lowest expected time
+to a valid response goes first. The statistics also decide when a hedged
+request is worth sending (see `hedge_delay`), within a budget of hedges per
+routed request (see `take_hedge`).
+'''
+
+from __future__ import annotations
+import os
+import threading
+import time
+from collections import Counter, deque
+from typing import Optional
+
+# Recent requests considered for a model's error rate and latency percentiles
+WINDOW = 200
+ERROR_WINDOW = 20
+# Passes over the pool before a completion fails because every model errored
+ROUTING_ROUNDS = 3
+
+
+class Model:
+    def __init__(self, name: str, base_url: str, api_key: str, order: int) -> None:
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.order = order
+        self.latencies = deque(maxlen=WINDOW)
+        self.outcomes = deque(maxlen=ERROR_WINDOW)
+        self.counts = Counter()
+        self.cooldown_until = 0.0
+
+    def percentile(self, q: float) -> Optional[float]:
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    @property
+    def error_rate(self) -> float:
+        return self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0
+
+    @property
+    def validity(self) -> float:
+        # With a prior of one valid response, so a single failure does not rule a model out
+        return (self.counts["valid"] + 1) / (self.counts["valid"] + self.counts["invalid"] + 1)
+
+    def stats(self) -> dict:
+        return {
+            **self.counts,
+            "p50_seconds": self.percentile(0.5),
+            "p90_seconds": self.percentile(0.9),
+            "error_rate": self.error_rate,
+            "validity": self.validity,
+            "cooling_down": self.cooldown_until > time.monotonic()
+        }
+
+
+class ModelPool:
+    def __init__(self,
+                 models: list[Model],
+                 hedging: bool = True,
+                 hedge_percentile: float = 0.9,
+                 hedge_min_samples: int = 20,
+                 hedge_initial_delay: float = 10.0,
+                 hedge_min_delay: float = 0.5,
+                 hedge_budget: float = 0.1,
+                 hedge_burst: float = 3.0,
+                 cooldown: float = 30.0,
+                 min_samples: int = 5) -> None:
+        if not models:
+            raise Exception("The model pool needs at least one model.")
+        self.models = models
+        self.hedging = hedging and len(models) > 1
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_initial_delay = hedge_initial_delay
+        self.hedge_min_delay = hedge_min_delay
+        # Every routed request earns `hedge_budget` of a hedge, up to `hedge_burst` saved
+        self.hedge_budget = hedge_budget
+        self.hedge_burst = max(hedge_burst, 1.0)
+        self._hedge_credit = self.hedge_burst
+        self.cooldown = cooldown
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config: dict) -> ModelPool:
+        """
+        Build the pool from `models` (falling back to `chat_model` and
+        `base_url`) and the `hedging` settings of the config.
+        """
+        entries = config.get("models") or [{"name": config["chat_model"]}]
+        models = []
+        for order, entry in enumerate(entries):
+            api_key = os.getenv(entry["api_key_env"], "") if entry.get("api_key_env") else config.get("api_key", "")
+            models.append(Model(entry["name"], entry.get("base_url", config["base_url"]), api_key, order))
+        hedging = config.get("hedging", {})
+        return cls(
+            models,
+            hedging=hedging.get("enabled", True),
+            hedge_percentile=hedging.get("percentile", 0.9),
+            hedge_min_samples=hedging.get("min_samples", 20),
+            hedge_initial_delay=hedging.get("initial_delay", 10.0),
+            hedge_min_delay=hedging.get("min_delay", 0.5),
+            hedge_budget=hedging.get("budget", 0.1),
+            hedge_burst=hedging.get("burst", 3.0),
+            cooldown=hedging.get("cooldown", 30.0)
+        )
+
+    @property
+    def primary(self) -> Model:
+        return self.models[0]
+
+    def _expected_seconds(self, model: Model) -> float:
+        if len(model.latencies) < self.min_samples:
+            return float("inf")
+        return model.percentile(0.5) / model.validity
+
+    def ranked(self) -> list[Model]:
+        """Models in the order they should be tried for the next request."""
+        now = time.monotonic()
+        with self._lock:
+            return sorted(self.models, key=lambda model: (
+                model.cooldown_until > now,
+                model.error_rate > 0.5,
+                self._expected_seconds(model),
+                model.order
+            ))
+
+    def hedge_delay(self, model: Model) -> Optional[float]:
+        """Seconds to wait on `model` before hedging, or None when hedging is off."""
+        if not self.hedging:
+            return None
+        with self._lock:
+            if len(model.latencies) < self.hedge_min_samples:
+                return self.hedge_initial_delay
+            return max(model.percentile(self.hedge_percentile), self.hedge_min_delay)
+
+    def record_request(self) -> None:
+        """Count a routed request towards the hedge budget."""
+        with self._lock:
+            self._hedge_credit = min(self._hedge_credit + self.hedge_budget, self.hedge_burst)
+
+    def take_hedge(self) -> bool:
+        """Spend one hedge of the budget. Returns False when it is used up."""
+        with self._lock:
+            if self._hedge_credit < 1:
+                return False
+            self._hedge_credit -= 1
+            return True
+
+    def retry_delay(self, round: int) -> float:
+        """Seconds to wait before trying the pool again after every model failed."""
+        now = time.monotonic()
+        with self._lock:
+            cooldowns = [model.cooldown_until - now for model in self.models if model.cooldown_until > now]
+        if cooldowns:
+            return min(cooldowns)
+        return min(2 ** round, self.cooldown)
+
+    def record_success(self, model: Model, seconds: Optional[float]) -> None:
+        with self._lock:
+            model.counts["succeeded"] += 1
+            model.outcomes.append(True)
+            if seconds is not None:
+                model.latencies.append(seconds)
+
+    def record_error(self, model: Model, rate_limited: bool = False, retry_after: Optional[float] = None) -> None:
+        with self._lock:
+            model.counts["rate_limited" if rate_limited else "errors"] += 1
+            model.outcomes.append(False)
+            if rate_limited:
+                model.cooldown_until = time.monotonic() + (retry_after if retry_after is not None else self.cooldown)
+
+    def record_validity(self, model: Model, valid: bool) -> None:
+        with self._lock:
+            model.counts["valid" if valid else "invalid"] += 1
+
+    def record(self, model: Model, event: str) -> None:
+        with self._lock:
+            model.counts[event] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {model.name: model.stats() for model in self.models}
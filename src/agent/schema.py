@@ -0,0 +1,116 @@
+'''
+Output templates compiled into JSON Schemas and precompiled validators.
+
+A template is an example of the expected JSON output (see `specs/templates`).
+A response matches it when it has exactly the same keys and every value has
+the same type as in the template, recursively for nested objects.
+'''
+
+from __future__ import annotations
+import json
+from typing import Any, Callable, Optional
+
+Validator = Callable[[Any], bool]
+
+_JSON_TYPES = {
+    str: "string",
+    bool: "boolean",
+    int: "integer",
+    float: "number",
+    list: "array",
+    dict: "object"
+}
+
+def template_to_schema(template: Any) -> dict:
+    if isinstance(template, dict):
+        return {
+            "type": "object",
+            "properties": {key: template_to_schema(value) for key, value in template.items()},
+            "required": list(template.keys()),
+            "additionalProperties": False
+        }
+    if isinstance(template, list):
+        schema = {"type": "array"}
+        if template:
+            schema["items"] = template_to_schema(template[0])
+        return schema
+    return {"type": _JSON_TYPES.get(type(template), "string")}
+
+def _compile(template: Any) -> Validator:
+    expected_type = type(template)
+    if expected_type != dict:
+        return lambda value: type(value) == expected_type
+
+    keys = frozenset(template.keys())
+    fields = [(key, _compile(value)) for key, value in template.items()]
+
+    def validate(value: Any) -> bool:
+        if type(value) != dict or value.keys() != keys:
+            return False
+        return all(check(value[key]) for key, check in fields)
+    return validate
+
+def strip_fences(content: str) -> str:
+    # The LLM likes to wrap its answer in ```json ```
+    content = content.strip()
+    if content.startswith("```"):
+        content = content[3:]
+        if content[:4].lower() == "json":
+            content = content[4:]
+        if content.endswith("```"):
+            content = content[:-3]
+    return content.strip()
+
+class CompiledTemplate:
+    def __init__(self, template: dict, name: str = "output") -> None:
+        self.template = template
+        # Identifies the template in metrics and in the response_format schema
+        self.name = name
+        self.schema = template_to_schema(template)
+        self.validate = _compile(template)
+
+    def validate_items(self, items: list) -> list[bool]:
+        return [self.validate(item) for item in items]
+
+    def parse(self, content: Any) -> Optional[dict | list]:
+        """
+        Parse a response once and validate it against the template; a list
+        is valid when every item is. Returns None when invalid.
+        """
+        if isinstance(content, str):
+            try:
+                content = json.loads(strip_fences(content))
+            except ValueError:
+                return None
+        if isinstance(content, list):
+            return content if all(self.validate_items(content)) else None
+        return content if self.validate(content) else None
+
+    def response_format(self) -> dict:
+        return {
+            "type": "json_schema",
+            "json_schema": {
+                "name": self.name,
+                "strict": True,
+                "schema": self.schema
+            }
+        }
+
+_compiled: dict[str, CompiledTemplate] = {}
+# Fast path for the template objects loaded at startup, which are reused for every call
+_compiled_by_id: dict[int, tuple[dict, CompiledTemplate]] = {}
+
+def compile_template(template: dict, name: Optional[str] = None) -> CompiledTemplate:
+    """
+    Compile a template, reusing the compiled form for identical templates.
+    `name` labels it the first time it is compiled.
+    """
+    known = _compiled_by_id.get(id(template))
+    if known is not None and known[0] is template:
+        return known[1]
+    key = json.dumps(template, sort_keys=True)
+    compiled = _compiled.get(key)
+    if compiled is None:
+        compiled = _compiled[key] = CompiledTemplate(template, name or "output")
+    _compiled_by_id[id(template)] = (template, compiled)
+    return compiled
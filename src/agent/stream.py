@@ -0,0 +1,200 @@
+'''
+Incremental structure checks for streamed responses.
+
+`StreamingTemplateChecker` is fed the response text as it arrives and tracks
+the JSON structure character by character. It reports a divergence from the
+output template as early as possible: a wrong opening character, an unknown
+or repeated key, a value of the wrong type or an object missing keys. Only
+structure is checked here; the complete response is still validated by the
+compiled template.
+'''
+
+from __future__ import annotations
+from typing import Any, Optional
+
+_FENCE = "```json"
+_WHITESPACE = " \t\r\n"
+_NUMBER_START = "-0123456789"
+
+
+def _starts_type(char: str, template: Any) -> bool:
+    """Whether a JSON value starting with `char` can have the type of `template`."""
+    expected = type(template)
+    if expected == dict:
+        return char == "{"
+    if expected == list:
+        return char == "["
+    if expected == str:
+        return char == '"'
+    if expected == bool:
+        return char in "tf"
+    if expected in (int, float):
+        return char in _NUMBER_START
+    return True
+
+
+class _Frame:
+    def __init__(self, kind: str, template: Any) -> None:
+        self.kind = kind
+        self.template = template
+        # object: key -> colon -> value -> comma; array: value -> comma
+        self.expect = "key" if kind == "object" else "value"
+        self.keys = set()
+        self.key = None
+        self.items = 0
+
+    def value_template(self) -> Any:
+        if self.kind == "object":
+            if isinstance(self.template, dict):
+                return self.template.get(self.key)
+            return None
+        if isinstance(self.template, list):
+            return self.template[0] if self.template else None
+        return self.template
+
+
+class StreamingTemplateChecker:
+    def __init__(self, template: dict, many: bool = False) -> None:
+        self.template = template
+        self.many = many
+        self.error: Optional[str] = None
+        self.done = False
+        self._preamble = ""
+        self._started = False
+        self._stack: list[_Frame] = []
+        self._in_string = False
+        self._escape = False
+        self._string = []
+        self._string_is_key = False
+        self._in_scalar = False
+
+    def feed(self, text: str) -> bool:
+        """Consume the next piece of the response. Returns False once it diverges."""
+        if self.error is not None:
+            return False
+        for char in text:
+            if self.done:
+                break
+            if not self._started:
+                self._start(char)
+            else:
+                self._step(char)
+            if self.error is not None:
+                return False
+        return True
+
+    def _fail(self, error: str) -> None:
+        self.error = error
+
+    def _start(self, char: str) -> None:
+        if char in "{[":
+            if char == "[" and not self.many:
+                return self._fail("expected an object, got a list")
+            self._started = True
+            template = [self.template] if char == "[" else self.template
+            self._stack.append(_Frame("array" if char == "[" else "object", template))
+            return
+        # Allow whitespace and a ```json fence, in any case, before the JSON itself
+        self._preamble += char
+        preamble = self._preamble.strip().lower()
+        if preamble and not (_FENCE.startswith(preamble) or preamble == "```"):
+            self._fail(f"unexpected text before JSON: {preamble[:20]!r}")
+
+    def _step(self, char: str) -> None:
+        if self._in_string:
+            return self._string_char(char)
+        if self._in_scalar:
+            if char not in _WHITESPACE + ",}]":
+                return
+            self._in_scalar = False
+            self._after_value()
+
+        frame = self._stack[-1]
+        if char in _WHITESPACE:
+            return
+
+        if frame.expect == "key":
+            if char == '"':
+                self._open_string(is_key=True)
+            elif char == "}" and frame.items == 0:
+                self._close("}")
+            else:
+                self._fail(f"expected a key, got {char!r}")
+        elif frame.expect == "colon":
+            if char == ":":
+                frame.expect = "value"
+            else:
+                self._fail(f"expected ':', got {char!r}")
+        elif frame.expect == "value":
+            if frame.kind == "array" and char == "]" and frame.items == 0:
+                return self._close("]")
+            self._value(char, frame)
+        elif frame.expect == "comma":
+            if char == ",":
+                frame.expect = "key" if frame.kind == "object" else "value"
+            elif char in "}]":
+                self._close(char)
+            else:
+                self._fail(f"expected ',' or a closing bracket, got {char!r}")
+
+    def _value(self, char: str, frame: _Frame) -> None:
+        frame.items += 1
+        template = frame.value_template()
+        if template is not None and not _starts_type(char, template):
+            where = f"key {frame.key!r}" if frame.kind == "object" else "list item"
+            return self._fail(f"wrong type for {where}: starts with {char!r}")
+        if char == '"':
+            self._open_string(is_key=False)
+        elif char in "{[":
+            self._stack.append(_Frame("object" if char == "{" else "array", template))
+        elif char in "}],:":
+            self._fail(f"expected a value, got {char!r}")
+        else:
+            self._in_scalar = True
+
+    def _open_string(self, is_key: bool) -> None:
+        self._in_string = True
+        self._string_is_key = is_key
+        self._string = []
+
+    def _string_char(self, char: str) -> None:
+        if self._escape:
+            self._escape = False
+        elif char == "\\":
+            self._escape = True
+            return
+        elif char == '"':
+            self._in_string = False
+            if self._string_is_key:
+                return self._key("".join(self._string))
+            return self._after_value()
+        if self._string_is_key:
+            self._string.append(char)
+
+    def _key(self, key: str) -> None:
+        frame = self._stack[-1]
+        if isinstance(frame.template, dict):
+            if key not in frame.template:
+                return self._fail(f"unexpected key {key!r}")
+            if key in frame.keys:
+                return self._fail(f"repeated key {key!r}")
+        frame.keys.add(key)
+        frame.key = key
+        frame.expect = "colon"
+
+    def _after_value(self) -> None:
+        self._stack[-1].expect = "comma"
+
+    def _close(self, char: str) -> None:
+        frame = self._stack[-1]
+        if (frame.kind == "object") != (char == "}"):
+            return self._fail(f"mismatched {char!r}")
+        if frame.kind == "object" and isinstance(frame.template, dict):
+            missing = set(frame.template) - frame.keys
+            if missing:
+                return self._fail(f"missing keys {sorted(missing)}")
+        self._stack.pop()
+        if self._stack:
+            self._after_value()
+        else:
+            self.done = True
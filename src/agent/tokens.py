@@ -0,0 +1,25 @@
+'''
+Token estimates for prompts, without loading a tokenizer.
+
+The estimates only need to be good enough to keep prompts within a budget,
+so a characters-per-token average is used, plus the fixed cost of the role
+and separators of every chat message.
+'''
+
+from __future__ import annotations
+
+# Rough average for English text with the tokenizers of the models we use
+CHARS_PER_TOKEN = 4
+# Tokens each chat message adds for its role and delimiters
+MESSAGE_OVERHEAD = 4
+
+
+def estimate_tokens(text: str) -> int:
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+def message_tokens(message: dict) -> int:
+    return estimate_tokens(message["content"]) + MESSAGE_OVERHEAD
+
+def truncate_to_tokens(text: str, tokens: int) -> str:
+    """The start of `text`, cut to about `tokens` tokens."""
+    return text[:max(tokens, 0) * CHARS_PER_TOKEN]
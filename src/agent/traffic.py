@@ -0,0 +1,96 @@
+'''
+Record and replay of the traffic to the chat model.
+
+In record mode every completion is appended to a gzipped JSON-lines log,
+keyed by a hash of the request. In replay mode the log is loaded and the
+recorded responses are served back instead of calling the model, in the order
+they were recorded for each request (so the invalid responses that caused a
+retry are replayed too), optionally with their original latency.
+'''
+
+from __future__ import annotations
+import asyncio
+import gzip
+import hashlib
+import json
+import threading
+import time
+from collections import defaultdict
+from pathlib import Path
+from typing import Awaitable, Callable
+
+from src.enums.agent import TrafficModeEnum
+
+
+def request_key(args: dict, stream: bool) -> str:
+    payload = json.dumps({**args, "stream": stream}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TrafficLog:
+    def __init__(self, path: str | Path, mode: str, replay_latency: bool = False) -> None:
+        self.path = Path(path)
+        self.mode = TrafficModeEnum(mode)
+        self.replay_latency = replay_latency
+        self._lock = threading.Lock()
+        # key -> recorded (content, latency) pairs, and how many were served
+        self._responses = defaultdict(list)
+        self._served = defaultdict(int)
+
+        if self.mode == TrafficModeEnum.RECORD:
+            # A recording starts a fresh log, so a replay sees a single run
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.path.write_bytes(b"")
+        elif self.mode == TrafficModeEnum.REPLAY:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    entry = json.loads(line)
+                    self._responses[entry["key"]].append((entry["content"], entry["latency"]))
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == TrafficModeEnum.REPLAY
+
+    def _next(self, args: dict, stream: bool) -> tuple[str, float]:
+        key = request_key(args, stream)
+        with self._lock:
+            responses = self._responses.get(key, [])
+            served = self._served[key]
+            if served >= len(responses):
+                raise Exception(f"No recorded response for request {key[:12]} (call {served + 1}); "
+                                "the run diverged from the recording.")
+            self._served[key] += 1
+        return responses[served]
+
+    def _record(self, args: dict, stream: bool, content: str, latency: float) -> None:
+        key = request_key(args, stream)
+        entry = {"key": key, "content": content, "latency": round(latency, 4)}
+        with self._lock:
+            if key not in self._responses:
+                # The request itself is stored once, for inspecting the log
+                entry["request"] = args
+            self._responses[key].append((content, latency))
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+
+    def complete(self, args: dict, call: Callable[[], str], stream: bool = False) -> str:
+        if self.replaying:
+            content, latency = self._next(args, stream)
+            if self.replay_latency:
+                time.sleep(latency)
+            return content
+        start = time.perf_counter()
+        content = call()
+        self._record(args, stream, content, time.perf_counter() - start)
+        return content
+
+    async def acomplete(self, args: dict, call: Callable[[], Awaitable[str]], stream: bool = False) -> str:
+        if self.replaying:
+            content, latency = self._next(args, stream)
+            if self.replay_latency:
+                await asyncio.sleep(latency)
+            return content
+        start = time.perf_counter()
+        content = await call()
+        self._record(args, stream, content, time.perf_counter() - start)
+        return content
@@ -0,0 +1,166 @@
+"""
+Persistent bank of generated questions, reused by spaced repetition.
+
+Every validated question is stored with the hash of the transcript it came
+from, the topic keywords of that transcript, the user and the day it was
+created. When a quiz is generated, part of it can be filled with the user's
+questions from earlier days that are due again, preferring those whose
+keywords overlap the new transcript; only the rest is generated. A reused
+question moves up a box, and its next due day is pushed further out
+(1, 2, 4, ... days), as in a Leitner system.
+"""
+
+from __future__ import annotations
+
+import datetime
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+# Days until a question is due again, by box
+INTERVALS = (1, 2, 4, 8, 16, 32)
+STOPWORDS = set(
+    "a about above after again all also am an and any are as at be because been before being below between "
+    "both but by can could did do does doing down during each few for from further had has have having he her "
+    "here hers him his how i if in into is it its just like me more most my no nor not now of off on once only "
+    "or other our out over own same she should so some such than that the their them then there these they "
+    "this those through to too under until up very was we were what when where which while who why will with "
+    "would you your yes okay user assistant".split()
+)
+
+
+def content_hash(messages: list) -> str:
+    """Hash of the normalized transcript the questions were generated from."""
+    material = [[message.conv_id, message.role, " ".join(message.content.split())] for message in messages]
+    return hashlib.sha256(json.dumps(material, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+def extract_keywords(text: str, limit: int = 12) -> list[str]:
+    """The most frequent content words of the text."""
+    words = [word for word in re.findall(r"[a-z][a-z0-9-]{2,}", text.lower()) if word not in STOPWORDS]
+    return [word for word, _ in Counter(words).most_common(limit)]
+
+
+class QuestionBank:
+    """SQLite store of every user's generated questions and their repetition schedule."""
+
+    def __init__(self, db_path: str | Path) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS questions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_email TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    type TEXT NOT NULL,
+                    question TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    created_day TEXT NOT NULL,
+                    box INTEGER NOT NULL DEFAULT 0,
+                    due_day TEXT NOT NULL,
+                    times_served INTEGER NOT NULL DEFAULT 0
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS questions_due ON questions (user_email, type, due_day)")
+            db.execute("CREATE INDEX IF NOT EXISTS questions_content ON questions (content_hash)")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS question_keywords (
+                    question_id INTEGER NOT NULL,
+                    keyword TEXT NOT NULL,
+                    PRIMARY KEY (keyword, question_id)
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            connection = sqlite3.connect(self.db_path)
+            connection.row_factory = sqlite3.Row
+            try:
+                with connection:
+                    yield connection
+            finally:
+                connection.close()
+
+    def add(self, user_email: str, content_hash: str, questions: list[dict],
+            keywords: list[str], day: Optional[datetime.date] = None) -> int:
+        """Store generated questions, first due the day after `day`. Returns the number stored."""
+        day = day or datetime.date.today()
+        due_day = (day + datetime.timedelta(days=INTERVALS[0])).isoformat()
+        now = time.time()
+        with self._connect() as db:
+            # The same transcript is only banked once per user
+            if db.execute(
+                "SELECT 1 FROM questions WHERE content_hash = ? AND user_email = ? LIMIT 1",
+                (content_hash, user_email)
+            ).fetchone():
+                return 0
+            for question in questions:
+                # Templates and prompts disagree on "open-ended" and "open_ended"
+                question_type = "mcq" if question.get("type") == "mcq" else "open_ended"
+                cursor = db.execute(
+                    "INSERT INTO questions (user_email, content_hash, type, question, created_at, created_day, due_day) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (user_email, content_hash, question_type, json.dumps(question), now, day.isoformat(), due_day)
+                )
+                db.executemany(
+                    "INSERT OR IGNORE INTO question_keywords (question_id, keyword) VALUES (?, ?)",
+                    [(cursor.lastrowid, keyword) for keyword in keywords]
+                )
+        return len(questions)
+
+    def due(self, user_email: str, question_type: str, limit: int,
+            keywords: list[str] = (), day: Optional[datetime.date] = None) -> list[dict]:
+        """
+        Up to `limit` of the user's questions of `question_type` due on `day`,
+        created on an earlier day. Questions sharing more keywords with
+        `keywords` come first, then the most overdue.
+        """
+        if limit <= 0:
+            return []
+        day = (day or datetime.date.today()).isoformat()
+        placeholders = ", ".join("?" for _ in keywords) or "NULL"
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT q.id, q.question, ("
+                f"SELECT COUNT(*) FROM question_keywords k WHERE k.question_id = q.id AND k.keyword IN ({placeholders})"
+                ") AS overlap FROM questions q "
+                "WHERE q.user_email = ? AND q.type = ? AND q.due_day <= ? AND q.created_day < ? "
+                "ORDER BY overlap DESC, q.due_day, q.id LIMIT ?",
+                (*keywords, user_email, question_type, day, day, limit)
+            ).fetchall()
+        return [{**json.loads(row["question"]), "bank_id": row["id"]} for row in rows]
+
+    def mark_served(self, question_ids: list[int], day: Optional[datetime.date] = None) -> None:
+        """Move reused questions up a box and schedule their next repetition."""
+        day = day or datetime.date.today()
+        with self._connect() as db:
+            for question_id in question_ids:
+                row = db.execute("SELECT box FROM questions WHERE id = ?", (question_id,)).fetchone()
+                if row is None:
+                    continue
+                box = min(row["box"] + 1, len(INTERVALS) - 1)
+                db.execute(
+                    "UPDATE questions SET box = ?, due_day = ?, times_served = times_served + 1 WHERE id = ?",
+                    (box, (day + datetime.timedelta(days=INTERVALS[box])).isoformat(), question_id)
+                )
+
+    def stats(self) -> dict:
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT COUNT(*) AS questions, COUNT(DISTINCT user_email) AS users, "
+                "COALESCE(SUM(times_served), 0) AS reuses FROM questions"
+            ).fetchone()
+        return dict(row)
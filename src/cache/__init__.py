@@ -0,0 +1,162 @@
+"""
+Content-addressed cache for generated quizzes.
+
+Quizzes are keyed by a hash of everything that determines the generation
+output: the normalized transcript, the requested question counts, the chat
+model and the loaded prompts and templates. Entries live in a small
+in-memory LRU tier backed by a SQLite tier with a TTL and a size cap.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split())
+
+def quiz_cache_key(messages: list, num_mcq: int, num_open: int,
+                   chat_model: str, system_prompts: dict, **options) -> str:
+    """Hash the inputs of a quiz generation into a cache key."""
+    material = {
+        "messages": [
+            [message.conv_id, message.role, _normalize(message.content)]
+            for message in messages
+        ],
+        "num_mcq": num_mcq,
+        "num_open": num_open,
+        "chat_model": chat_model,
+        "system_prompts": system_prompts,
+        "options": options
+    }
+    encoded = json.dumps(material, sort_keys=True, ensure_ascii=False).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+
+class QuizCache:
+    """Two-tier (memory LRU + SQLite) cache of generated quizzes."""
+
+    def __init__(self,
+                 db_path: str | Path,
+                 memory_entries: int = 256,
+                 ttl_seconds: float = 7 * 24 * 3600,
+                 max_disk_bytes: int = 64 * 1024 * 1024) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.memory_entries = memory_entries
+        self.ttl_seconds = ttl_seconds
+        self.max_disk_bytes = max_disk_bytes
+
+        self._memory: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {
+            "memory_hits": 0,
+            "disk_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0
+        }
+
+        with self._connect() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS quizzes (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS quizzes_accessed ON quizzes (accessed_at)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.db_path)
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def get(self, key: str) -> Optional[dict]:
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None and now - entry[0] < self.ttl_seconds:
+                self._memory.move_to_end(key)
+                self.counters["memory_hits"] += 1
+                return entry[1]
+            self._memory.pop(key, None)
+
+            with self._connect() as db:
+                row = db.execute(
+                    "SELECT value, created_at FROM quizzes WHERE key = ? AND created_at > ?",
+                    (key, now - self.ttl_seconds)
+                ).fetchone()
+                if row is not None:
+                    db.execute("UPDATE quizzes SET accessed_at = ? WHERE key = ?", (now, key))
+            if row is None:
+                self.counters["misses"] += 1
+                return None
+
+            value = json.loads(row[0])
+            self._remember(key, row[1], value)
+            self.counters["disk_hits"] += 1
+            return value
+
+    def set(self, key: str, value: dict) -> None:
+        now = time.time()
+        encoded = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._remember(key, now, value)
+            with self._connect() as db:
+                db.execute(
+                    "INSERT OR REPLACE INTO quizzes (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, encoded, len(encoded), now, now)
+                )
+                self._evict(db, now)
+            self.counters["stores"] += 1
+
+    def _remember(self, key: str, created_at: float, value: dict) -> None:
+        self._memory[key] = (created_at, value)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _evict(self, db: sqlite3.Connection, now: float) -> None:
+        """Drop expired entries, then the least recently used until under the size cap."""
+        evicted = db.execute(
+            "DELETE FROM quizzes WHERE created_at <= ?", (now - self.ttl_seconds,)
+        ).rowcount
+        total = db.execute("SELECT COALESCE(SUM(size), 0) FROM quizzes").fetchone()[0]
+        if total > self.max_disk_bytes:
+            rows = db.execute("SELECT key, size FROM quizzes ORDER BY accessed_at").fetchall()
+            stale = []
+            for key, size in rows:
+                if total <= self.max_disk_bytes:
+                    break
+                stale.append((key,))
+                total -= size
+            db.executemany("DELETE FROM quizzes WHERE key = ?", stale)
+            evicted += len(stale)
+        self.counters["evictions"] += evicted
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.counters["memory_hits"] + self.counters["disk_hits"] + self.counters["misses"]
+            hits = lookups - self.counters["misses"]
+            return {
+                **self.counters,
+                "memory_entries": len(self._memory),
+                "hit_rate": hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,109 @@
+'''
+Near-duplicate detection of generated questions.
+
+Every accepted question is reduced to a MinHash signature of its character
+shingles and filed in a locality-sensitive hashing index (the signature is cut
+into bands, and questions sharing a band are candidates). A new question is a
+duplicate when its estimated Jaccard similarity to a candidate reaches the
+threshold. This replaces sending the list of questions generated so far back
+to the model: the prompt stays the same size, and only the questions that
+collide are regenerated.
+'''
+
+from __future__ import annotations
+import hashlib
+import random
+import re
+from typing import Optional
+
+# Mersenne prime, larger than any 32-bit shingle hash
+PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+
+def normalize(text: str) -> str:
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+def shingles(text: str, size: int) -> set[int]:
+    """32-bit hashes of the character `size`-grams of the normalized text."""
+    text = normalize(text)
+    if len(text) <= size:
+        grams = {text}
+    else:
+        grams = {text[i:i + size] for i in range(len(text) - size + 1)}
+    return {int.from_bytes(hashlib.blake2b(gram.encode(), digest_size=4).digest(), "big") for gram in grams}
+
+
+class QuestionIndex:
+    def __init__(self,
+                 threshold: float = 0.5,
+                 num_perm: int = 64,
+                 bands: int = 32,
+                 shingle_size: int = 4,
+                 seed: int = 1) -> None:
+        if num_perm % bands:
+            raise Exception(f"num_perm ({num_perm}) must be a multiple of bands ({bands}).")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        # The permutations are fixed by the seed, so signatures are comparable across indexes
+        rng = random.Random(seed)
+        self._permutations = [(rng.randrange(1, PRIME), rng.randrange(0, PRIME)) for _ in range(num_perm)]
+        self._buckets: list[dict[tuple, list[int]]] = [{} for _ in range(bands)]
+        self._signatures: list[tuple[int, ...]] = []
+        self.texts: list[str] = []
+
+    @classmethod
+    def from_config(cls, config: Optional[dict]) -> QuestionIndex:
+        """Build an index from the `dedup` settings of the config."""
+        config = config or {}
+        return cls(
+            threshold=config.get("threshold", 0.5),
+            num_perm=config.get("num_perm", 64),
+            bands=config.get("bands", 32),
+            shingle_size=config.get("shingle_size", 4)
+        )
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def signature(self, text: str) -> tuple[int, ...]:
+        hashes = shingles(text, self.shingle_size)
+        return tuple(min((a * h + b) % PRIME & MAX_HASH for h in hashes) for a, b in self._permutations)
+
+    def _bands(self, signature: tuple[int, ...]):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows]
+
+    def similarity(self, first: tuple[int, ...], second: tuple[int, ...]) -> float:
+        """Estimated Jaccard similarity of the shingles behind two signatures."""
+        return sum(a == b for a, b in zip(first, second)) / self.num_perm
+
+    def duplicate_of(self, text: str) -> Optional[str]:
+        """The indexed text `text` is a near-duplicate of, if any."""
+        return self._duplicate_of(self.signature(text))
+
+    def _duplicate_of(self, signature: tuple[int, ...]) -> Optional[str]:
+        candidates = set()
+        for band, key in self._bands(signature):
+            candidates.update(self._buckets[band].get(key, ()))
+        best, best_similarity = None, self.threshold
+        for candidate in sorted(candidates):
+            similarity = self.similarity(signature, self._signatures[candidate])
+            if similarity >= best_similarity:
+                best, best_similarity = candidate, similarity
+        return self.texts[best] if best is not None else None
+
+    def add(self, text: str) -> bool:
+        """Index `text` unless it is a near-duplicate of an indexed one. Returns whether it was added."""
+        signature = self.signature(text)
+        if self._duplicate_of(signature) is not None:
+            return False
+        position = len(self.texts)
+        self.texts.append(text)
+        self._signatures.append(signature)
+        for band, key in self._bands(signature):
+            self._buckets[band].setdefault(key, []).append(position)
+        return True
@@ -0,0 +1,250 @@
+"""
+Daily digest quizzes.
+
+Instead of one quiz per request, messages can be submitted throughout the day
+and are appended to a per-user store keyed by `user_email`; large uploads are
+staged in parts and join the digest at once when fully received. Once a day,
+at a configured off-peak time, the scheduler turns every user's pending
+messages into a single quiz job, run by a dedicated job queue whose worker
+count caps how many digests are generated at once. When several server processes run
+the scheduler, each user's digest for a day is claimed by exactly one of them.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import datetime
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+from src.jobs import JobQueue
+from src.logs import log
+
+
+class DigestStore:
+    """SQLite store of the messages waiting for each user's next digest."""
+
+    def __init__(self, db_path: str | Path) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS digest_messages (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_email TEXT NOT NULL,
+                    conv_id INTEGER NOT NULL,
+                    role TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    received_at REAL NOT NULL,
+                    job_id TEXT
+                )
+                """
+            )
+            db.execute("CREATE INDEX IF NOT EXISTS digest_pending ON digest_messages (user_email, job_id)")
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS digest_users (
+                    user_email TEXT PRIMARY KEY,
+                    num_mcq INTEGER,
+                    num_open INTEGER,
+                    last_digest_day TEXT
+                )
+                """
+            )
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level="IMMEDIATE")
+            connection.row_factory = sqlite3.Row
+            try:
+                with connection:
+                    yield connection
+            finally:
+                connection.close()
+
+    def append(self, user_email: str, messages: list[dict],
+               num_mcq: Optional[int] = None, num_open: Optional[int] = None) -> int:
+        """Add messages to the user's next digest. Returns the number of pending messages."""
+        now = time.time()
+        with self._connect() as db:
+            self._insert(db, user_email, messages, now, None)
+            return self._update_user(db, user_email, num_mcq, num_open)
+
+    def stage(self, upload_id: str, user_email: str, messages: list[dict], received_at: float) -> None:
+        """Store part of an upload; its messages join the digest only once `commit_upload` is called."""
+        with self._connect() as db:
+            self._insert(db, user_email, messages, received_at, f"upload:{upload_id}")
+
+    def commit_upload(self, upload_id: str, user_email: str,
+                      num_mcq: Optional[int] = None, num_open: Optional[int] = None) -> int:
+        """Add every staged message of an upload to the user's next digest. Returns the number of pending messages."""
+        with self._connect() as db:
+            db.execute(
+                "UPDATE digest_messages SET job_id = NULL WHERE user_email = ? AND job_id = ?",
+                (user_email, f"upload:{upload_id}")
+            )
+            return self._update_user(db, user_email, num_mcq, num_open)
+
+    def discard_upload(self, upload_id: str, user_email: str) -> None:
+        with self._connect() as db:
+            db.execute(
+                "DELETE FROM digest_messages WHERE user_email = ? AND job_id = ?",
+                (user_email, f"upload:{upload_id}")
+            )
+
+    def purge_uploads(self, older_than: float) -> int:
+        """Delete the staged parts of uploads started more than `older_than` seconds ago. Returns the count."""
+        # An upload cut off by a crash is never committed nor discarded
+        with self._connect() as db:
+            cursor = db.execute(
+                "DELETE FROM digest_messages WHERE job_id LIKE 'upload:%' AND received_at < ?",
+                (time.time() - older_than,)
+            )
+        return cursor.rowcount
+
+    @staticmethod
+    def _insert(db: sqlite3.Connection, user_email: str, messages: list[dict],
+                received_at: float, job_id: Optional[str]) -> None:
+        db.executemany(
+            "INSERT INTO digest_messages (user_email, conv_id, role, content, received_at, job_id) VALUES (?, ?, ?, ?, ?, ?)",
+            [(user_email, message["conv_id"], message["role"], message["content"], received_at, job_id)
+             for message in messages]
+        )
+
+    @staticmethod
+    def _update_user(db: sqlite3.Connection, user_email: str,
+                     num_mcq: Optional[int], num_open: Optional[int]) -> int:
+        # The latest question counts a user asked for apply to their digest
+        db.execute(
+            "INSERT INTO digest_users (user_email, num_mcq, num_open) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_email) DO UPDATE SET "
+            "num_mcq = COALESCE(excluded.num_mcq, num_mcq), num_open = COALESCE(excluded.num_open, num_open)",
+            (user_email, num_mcq, num_open)
+        )
+        row = db.execute(
+            "SELECT COUNT(*) FROM digest_messages WHERE user_email = ? AND job_id IS NULL",
+            (user_email,)
+        ).fetchone()
+        return row[0]
+
+    def due_users(self, day: str) -> list[dict]:
+        """Users with pending messages whose digest for `day` has not been created yet."""
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT u.user_email, u.num_mcq, u.num_open FROM digest_users u "
+                "WHERE (u.last_digest_day IS NULL OR u.last_digest_day < ?) AND EXISTS ("
+                "SELECT 1 FROM digest_messages m WHERE m.user_email = u.user_email AND m.job_id IS NULL) "
+                "ORDER BY u.user_email",
+                (day,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def claim_day(self, user_email: str, day: str) -> bool:
+        """Mark the user's digest for `day` as taken. Returns False when another run already took it."""
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE digest_users SET last_digest_day = ? "
+                "WHERE user_email = ? AND (last_digest_day IS NULL OR last_digest_day < ?)",
+                (day, user_email, day)
+            )
+        return cursor.rowcount == 1
+
+    def pending(self, user_email: str) -> list[dict]:
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT id, conv_id, role, content, received_at FROM digest_messages "
+                "WHERE user_email = ? AND job_id IS NULL ORDER BY id",
+                (user_email,)
+            ).fetchall()
+        return [dict(row) for row in rows]
+
+    def assign(self, user_email: str, up_to_id: int, job_id: str, day: str) -> None:
+        """Attach the pending messages up to `up_to_id` to the digest job created for `day`."""
+        with self._connect() as db:
+            db.execute(
+                "UPDATE digest_messages SET job_id = ? WHERE user_email = ? AND job_id IS NULL AND id <= ?",
+                (job_id, user_email, up_to_id)
+            )
+            db.execute("UPDATE digest_users SET last_digest_day = ? WHERE user_email = ?", (day, user_email))
+
+
+class DigestScheduler:
+    """Creates the digest jobs once a day, at `run_at` local time ("HH:MM")."""
+
+    def __init__(self, store: DigestStore, queue: JobQueue, run_at: str = "03:00",
+                 num_mcq: int = 7, num_open: int = 3, stale_upload_seconds: float = 86400.0) -> None:
+        self.store = store
+        self.queue = queue
+        hour, minute = run_at.split(":")
+        self.run_at = datetime.time(int(hour), int(minute))
+        self.num_mcq = num_mcq
+        self.num_open = num_open
+        # Staged uploads older than this are taken as abandoned
+        self.stale_upload_seconds = stale_upload_seconds
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run(), name="digest-scheduler")
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def _next_run(self, now: datetime.datetime) -> datetime.datetime:
+        run = datetime.datetime.combine(now.date(), self.run_at)
+        return run if run > now else run + datetime.timedelta(days=1)
+
+    async def _run(self) -> None:
+        # Catch up on today's digests if the server was down at run time
+        catch_up = datetime.datetime.now().time() >= self.run_at
+        while True:
+            if not catch_up:
+                now = datetime.datetime.now()
+                await asyncio.sleep((self._next_run(now) - now).total_seconds())
+            catch_up = False
+            try:
+                # Reading the stored messages blocks on SQLite: keep it off the event loop
+                await asyncio.to_thread(self.run_once)
+            except Exception as exc:
+                log(f"Digest run failed: {exc}", error=True)
+
+    def run_once(self, day: Optional[datetime.date] = None) -> list[str]:
+        """Queue one quiz job per user with pending messages. Returns the job ids. Blocking."""
+        day = (day or datetime.date.today()).isoformat()
+        purged = self.store.purge_uploads(self.stale_upload_seconds)
+        if purged:
+            log(f"Deleted {purged} message(s) of abandoned uploads.")
+        job_ids = []
+        for user in self.store.due_users(day):
+            # Another process's scheduler may be going through the same users
+            if not self.store.claim_day(user["user_email"], day):
+                continue
+            messages = self.store.pending(user["user_email"])
+            if not messages:
+                continue
+            # Conversation ids are only unique within one submission
+            conversations = {}
+            for message in messages:
+                message["conv_id"] = conversations.setdefault((message["received_at"], message["conv_id"]), len(conversations))
+            job_id = self.queue.submit({
+                "user_email": user["user_email"],
+                "num_mcq": user["num_mcq"] if user["num_mcq"] is not None else self.num_mcq,
+                "num_open": user["num_open"] if user["num_open"] is not None else self.num_open,
+                "messages": [
+                    {"conv_id": message["conv_id"], "role": message["role"], "content": message["content"]}
+                    for message in messages
+                ]
+            })
+            self.store.assign(user["user_email"], messages[-1]["id"], job_id, day)
+            job_ids.append(job_id)
+        log(f"Queued {len(job_ids)} digest job(s) for {day}.")
+        return job_ids
@@ -10,16 +10,21 @@ so the Gmail scope does not collide with other saved credentials.
 from __future__ import annotations
 
 import base64
-import os
-import pickle
+import threading
 from email.mime.text import MIMEText
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
-from google.auth.transport.requests import Request
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
 
+from src.oauth import TokenFile
+from src.ratelimit import TokenBucket, is_rate_limited, retry_after
+
+# The Google auth and discovery modules are imported on first use, which keeps
+# server startup fast.
+if TYPE_CHECKING:
+    from google_auth_httplib2 import AuthorizedHttp
+    from googleapiclient.http import BatchHttpRequest, HttpRequest
+
 
 GMAIL_SCOPES = ["https://www.googleapis.com/auth/gmail.send"]
 
@@ -31,32 +36,71 @@ class GmailEmailSender:
         self,
         credentials_file: str = "credentials.json",
         token_file: str = "token.gmail.pickle",
+        api_endpoint: Optional[str] = None,
+        rate_limiter: Optional[TokenBucket] = None,
     ) -> None:
         self.credentials_file = credentials_file
         self.token_file = token_file
+        self.tokens = TokenFile(token_file, credentials_file, GMAIL_SCOPES)
+        # Root URL replacing the Google API (e.g. the benchmark stand-ins);
+        # requests to it are sent without credentials
+        self.api_endpoint = api_endpoint
+        # Shared limit on the messages sent, one token per message
+        self.rate_limiter = rate_limiter
         self.creds = None
-        self.service = None
-        self._authenticate()
+        self._service = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def service(self):
+        """Gmail API client, authenticated and built on first use."""
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    self._authenticate()
+        return self._service
+
+    @property
+    def ready(self) -> bool:
+        """Whether the client is built and holds usable credentials."""
+        return self._service is not None and self.creds is not None and (
+            self.creds.valid or bool(self.creds.refresh_token)
+        )
 
     def _authenticate(self) -> None:
         """Authenticate the user and build the Gmail API service client."""
-        if os.path.exists(self.token_file):
-            with open(self.token_file, "rb") as token:
-                self.creds = pickle.load(token)
+        from googleapiclient.discovery import build
+
+        if self.api_endpoint:
+            from google.auth.credentials import AnonymousCredentials
+
+            self.creds = AnonymousCredentials()
+            self._service = build(
+                "gmail", "v1", credentials=self.creds, client_options={"api_endpoint": self.api_endpoint},
+                static_discovery=True, cache_discovery=False
+            )
+            return
+
+        # Other server processes may share the token file
+        self.creds = self.tokens.load()
 
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    self.credentials_file, GMAIL_SCOPES
-                )
-                self.creds = flow.run_local_server(port=0)
+        # Use the discovery document bundled with the client library, so
+        # building the service makes no network call.
+        self._service = build(
+            "gmail", "v1", credentials=self.creds, static_discovery=True, cache_discovery=False
+        )
 
-            with open(self.token_file, "wb") as token:
-                pickle.dump(self.creds, token)
+    def _http(self) -> AuthorizedHttp:
+        """Per-thread authorized transport, since httplib2 is not thread-safe."""
+        # Refreshed here rather than by the transport, so the new token is shared with the other processes
+        self.tokens.ensure_fresh(self.creds)
+        if not hasattr(self._local, "http"):
+            import httplib2
+            from google_auth_httplib2 import AuthorizedHttp
 
-        self.service = build("gmail", "v1", credentials=self.creds)
+            self._local.http = AuthorizedHttp(self.creds, http=httplib2.Http())
+        return self._local.http
 
     def _create_message(
         self,
@@ -75,6 +119,40 @@ class GmailEmailSender:
         raw_bytes = base64.urlsafe_b64encode(message.as_bytes())
         return {"raw": raw_bytes.decode("utf-8")}
 
+    def send_request(
+        self,
+        recipient: str,
+        subject: str,
+        body: str,
+        sender_id: str = "me",
+        sender_name: Optional[str] = None,
+    ) -> HttpRequest:
+        """Build the (not yet executed) Gmail API request sending one email."""
+        payload = self._create_message(recipient, subject, body, sender_name)
+        return self.service.users().messages().send(userId=sender_id, body=payload)
+
+    def throttle(self, messages: int = 1) -> None:
+        """Wait until `messages` more emails fit in the rate limit."""
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(messages)
+
+    def back_off(self, error: Exception, default: float = 1.0) -> bool:
+        """Pause the rate limiter for the Retry-After of a quota error. Returns whether it was one."""
+        if not is_rate_limited(error):
+            return False
+        if self.rate_limiter is not None:
+            self.rate_limiter.pause(retry_after(error, default))
+        return True
+
+    def new_batch(self, callback) -> BatchHttpRequest:
+        """Start a batch of Gmail API requests; `callback(request_id, response, exception)` runs per request."""
+        if self.api_endpoint:
+            # The batch URL comes from the discovery document, not the endpoint override
+            from googleapiclient.http import BatchHttpRequest
+
+            return BatchHttpRequest(callback=callback, batch_uri=f"{self.api_endpoint.rstrip('/')}/batch/gmail/v1")
+        return self.service.new_batch_http_request(callback=callback)
+
     def send_email(
         self,
         recipient: str,
@@ -96,13 +174,13 @@ class GmailEmailSender:
         Returns:
             The Gmail API message id for the sent email.
         """
-        payload = self._create_message(recipient, subject, body, sender_name)
+        request = self.send_request(recipient, subject, body, sender_id, sender_name)
 
+        self.throttle()
         try:
-            response = (
-                self.service.users().messages().send(userId=sender_id, body=payload).execute()
-            )
+            response = request.execute(http=self._http())
         except HttpError as error:
+            self.back_off(error)
             raise Exception(f"Failed to send email via Gmail API: {error}") from error
 
         return response.get("id", "")
@@ -0,0 +1,217 @@
+"""
+Persistent outbox for quiz emails.
+
+Emails are queued in a SQLite table and delivered by a background thread,
+which sends everything that is due in Gmail API batch requests. Transient
+failures are retried with exponential backoff, and messages that were not
+delivered yet survive a restart. A batch is claimed before it is sent, so the
+outboxes of several server processes sharing the table never send the same
+email twice; a batch whose sender died is sent again once its claim expires.
+"""
+
+from __future__ import annotations
+
+import random
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Iterator, Optional
+
+from googleapiclient.errors import HttpError
+
+from src.email import GmailEmailSender
+from src.ratelimit import is_rate_limited
+from src.logs import log
+from src import metrics
+
+
+# Gmail recommends batches of at most 50 requests
+MAX_BATCH_SIZE = 50
+TRANSIENT_STATUSES = {429, 500, 502, 503, 504}
+
+
+class EmailOutbox:
+    """Queues emails and delivers them in batches from a background thread."""
+
+    def __init__(
+        self,
+        sender: GmailEmailSender,
+        db_path: str | Path,
+        batch_size: int = MAX_BATCH_SIZE,
+        poll_interval: float = 1.0,
+        max_attempts: int = 5,
+        base_delay: float = 2.0,
+        lease_seconds: float = 300.0,
+    ) -> None:
+        self.sender = sender
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.lease_seconds = lease_seconds
+
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+        with self._connect() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    recipient TEXT NOT NULL,
+                    subject TEXT NOT NULL,
+                    body TEXT NOT NULL,
+                    sender_name TEXT,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    message_id TEXT,
+                    error TEXT,
+                    lease_until REAL,
+                    created_at REAL NOT NULL
+                )
+                """
+            )
+            columns = {row[1] for row in db.execute("PRAGMA table_info(outbox)")}
+            if "lease_until" not in columns:
+                # Outboxes created before batches were claimed
+                db.execute("ALTER TABLE outbox ADD COLUMN lease_until REAL")
+            db.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt_at)")
+            db.execute("PRAGMA journal_mode = WAL")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        connection = sqlite3.connect(self.db_path, timeout=30, isolation_level="IMMEDIATE")
+        try:
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+    def enqueue(
+        self,
+        recipient: str,
+        subject: str,
+        body: str,
+        sender_name: Optional[str] = None,
+    ) -> int:
+        """Queue an email for delivery and return its outbox id."""
+        now = time.time()
+        with self._connect() as db:
+            cursor = db.execute(
+                "INSERT INTO outbox (recipient, subject, body, sender_name, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (recipient, subject, body, sender_name, now, now),
+            )
+        self._wakeup.set()
+        return cursor.lastrowid
+
+    def start(self) -> None:
+        """Start the delivery thread; anything left pending by a previous run is sent first."""
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="email-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0) -> None:
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def stats(self) -> dict:
+        with self._connect() as db:
+            rows = db.execute("SELECT status, COUNT(*) FROM outbox GROUP BY status").fetchall()
+        return dict(rows)
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            try:
+                delivered = self.deliver_due()
+            except Exception as exc:
+                log(f"Email outbox delivery failed: {exc}", error=True)
+                delivered = 0
+            # Keep draining while full batches go out, otherwise wait for new mail
+            if delivered < self.batch_size:
+                self._wakeup.wait(self.poll_interval)
+                self._wakeup.clear()
+
+    def deliver_due(self) -> int:
+        """Send one batch of due emails. Returns the number of emails attempted."""
+        now = time.time()
+        with self._connect() as db:
+            rows = db.execute(
+                "UPDATE outbox SET status = 'sending', lease_until = ? WHERE id IN ("
+                "SELECT id FROM outbox WHERE (status = 'pending' AND next_attempt_at <= ?) "
+                "OR (status = 'sending' AND lease_until < ?) ORDER BY next_attempt_at LIMIT ?"
+                ") RETURNING id, recipient, subject, body, sender_name, attempts",
+                (now + self.lease_seconds, now, now, self.batch_size),
+            ).fetchall()
+        if not rows:
+            return 0
+
+        attempts = {str(row[0]): row[5] + 1 for row in rows}
+        results = {}
+
+        def on_response(request_id: str, response: dict, exception: Optional[Exception]) -> None:
+            results[request_id] = (response, exception)
+
+        batch = self.sender.new_batch(on_response)
+        for outbox_id, recipient, subject, body, sender_name, _ in rows:
+            batch.add(
+                self.sender.send_request(recipient, subject, body, sender_name=sender_name),
+                request_id=str(outbox_id),
+            )
+
+        self.sender.throttle(len(rows))
+        try:
+            with metrics.STAGE_SECONDS.labels("email").time():
+                batch.execute(http=self.sender._http())
+        except Exception as exc:
+            # The whole batch failed (e.g. network); retry every message in it
+            for request_id in attempts:
+                results[request_id] = (None, exc)
+        # One quota error is enough to hold off the next batches
+        for _, exception in results.values():
+            if exception is not None and self.sender.back_off(exception, self.base_delay):
+                break
+
+        with self._connect() as db:
+            for request_id, attempt in attempts.items():
+                response, exception = results.get(request_id, (None, ConnectionError("No response in batch")))
+                if exception is None:
+                    metrics.EMAILS.labels("sent").inc()
+                    db.execute(
+                        "UPDATE outbox SET status = 'sent', attempts = ?, message_id = ?, error = NULL WHERE id = ?",
+                        (attempt, (response or {}).get("id", ""), int(request_id)),
+                    )
+                elif self._transient(exception) and attempt < self.max_attempts:
+                    delay = self.base_delay * 2 ** (attempt - 1) * (1 + random.random())
+                    metrics.EMAILS.labels("retried").inc()
+                    db.execute(
+                        "UPDATE outbox SET status = 'pending', attempts = ?, next_attempt_at = ?, error = ? WHERE id = ?",
+                        (attempt, time.time() + delay, str(exception), int(request_id)),
+                    )
+                else:
+                    log(f"Unable to email form link (outbox id {request_id}): {exception}", error=True)
+                    metrics.EMAILS.labels("failed").inc()
+                    db.execute(
+                        "UPDATE outbox SET status = 'failed', attempts = ?, error = ? WHERE id = ?",
+                        (attempt, str(exception), int(request_id)),
+                    )
+
+        sent = sum(1 for response, exception in results.values() if exception is None)
+        log(f"Email outbox delivered {sent} of {len(rows)} email(s) in one batch request.")
+        return len(rows)
+
+    @staticmethod
+    def _transient(exception: Exception) -> bool:
+        if isinstance(exception, HttpError):
+            # Gmail also reports quota errors as 403 rateLimitExceeded
+            return exception.resp.status in TRANSIENT_STATUSES or is_rate_limited(exception)
+        # Connection-level errors are worth retrying as well
+        return isinstance(exception, (OSError, TimeoutError))
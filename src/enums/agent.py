@@ -6,4 +6,18 @@ INDEX = Union[int, slice]
 class RoleEnum(Enum):
     SYSTEM = 'system'
     USER = 'user'
-    ASSISTANT = 'assistant'
\ No newline at end of file
+    ASSISTANT = 'assistant'
+
+class TrafficModeEnum(Enum):
+    OFF = 'off'
+    # Log every completion to disk
+    RECORD = 'record'
+    # Serve the logged completions instead of calling the model
+    REPLAY = 'replay'
+
+class PromptLayoutEnum(Enum):
+    # Per-call instructions are appended to the system prompt
+    SYSTEM = 'system'
+    # The system prompt and transcript form a stable prefix that providers can
+    # cache; per-call instructions follow in a trailing user message
+    PREFIX_CACHE = 'prefix_cache'
@@ -0,0 +1,15 @@
+from enum import Enum
+
+class JobStageEnum(Enum):
+    QUEUED = 'queued'
+    GENERATING_QUESTIONS = 'generating_questions'
+    CREATING_FORM = 'creating_form'
+    SENDING_EMAIL = 'sending_email'
+    COMPLETED = 'completed'
+    FAILED = 'failed'
+
+FINAL_STAGES = (JobStageEnum.COMPLETED.value, JobStageEnum.FAILED.value)
+
+class JobLaneEnum(Enum):
+    INTERACTIVE = 'interactive'
+    BULK = 'bulk'
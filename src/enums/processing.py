@@ -0,0 +1,7 @@
+from enum import Enum
+
+class MCQGenerationEnum(Enum):
+    # One call per MCQ, all fanned out concurrently
+    CONCURRENT = 'concurrent'
+    # All MCQs in a single call, failed items regenerated one by one
+    BATCHED = 'batched'
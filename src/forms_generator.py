@@ -3,52 +3,279 @@ Google Forms Generator for Question Export
 Automatically creates Google Forms from generated MCQ and open-ended questions
 """
 
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
+# The Google auth and discovery modules are imported on first use, which keeps
+# server startup fast
 from googleapiclient.errors import HttpError
-import pickle
-import os
+from src.oauth import TokenFile
+from src.ratelimit import is_rate_limited, retry_after
 import json
 import datetime
+import threading
+import time
 
 SCOPES = ['https://www.googleapis.com/auth/forms.body']
 
+# Limits for a single batchUpdate call; larger request lists are split
+MAX_BATCH_REQUESTS = 500
+MAX_BATCH_BYTES = 2 * 1024 * 1024
+# Quota errors are waited out this many times before the call fails
+MAX_RATE_LIMIT_RETRIES = 3
+
+
+def mcq_item(question_data):
+    """Build the Forms item for an MCQ question"""
+    options = []
+    correct_answer_value = None
+    
+    for idx, (key, value) in enumerate(question_data['options'].items()):
+        option_value = f"{key}. {value}"
+        options.append({"value": option_value})
+        
+        # Store correct answer value
+        if key == question_data['correct_answer']:
+            correct_answer_value = option_value
+    
+    return {
+        "title": question_data['question'],
+        "questionItem": {
+            "question": {
+                "required": True,
+                "grading": {
+                    "pointValue": 1,
+                    "correctAnswers": {
+                        "answers": [{"value": correct_answer_value}]
+                    },
+                    "whenRight": {
+                        "text": question_data.get('explanation', 'Correct!')
+                    },
+                    "whenWrong": {
+                        "text": question_data.get('explanation', '')
+                    }
+                },
+                "choiceQuestion": {
+                    "type": "RADIO",
+                    "options": options
+                }
+            }
+        }
+    }
+
+
+def open_ended_item(question_data):
+    """Build the Forms item for an open-ended question"""
+    return {
+        "title": question_data['question'],
+        "questionItem": {
+            "question": {
+                "required": True,
+                "grading": {
+                    "pointValue": 0,
+                    "generalFeedback": {
+                        "text": f"Sample Answer:\n\n{question_data.get('answer', 'No sample answer provided.')}"
+                    }
+                },
+                "textQuestion": {
+                    "paragraph": True
+                }
+            }
+        }
+    }
+
+
+class FormRequestBuilder:
+    """
+    Collects the batchUpdate requests of a form, so that the settings, the
+    description and every question can be sent in as few calls as possible
+    """
+
+    def __init__(self, max_requests=MAX_BATCH_REQUESTS, max_bytes=MAX_BATCH_BYTES):
+        self.max_requests = max_requests
+        self.max_bytes = max_bytes
+        self.requests = []
+    
+    def quiz_settings(self):
+        self.requests.append({
+            "updateSettings": {
+                "settings": {
+                    "quizSettings": {
+                        "isQuiz": True
+                    }
+                },
+                "updateMask": "quizSettings.isQuiz"
+            }
+        })
+        return self
+    
+    def description(self, description):
+        self.requests.append({
+            "updateFormInfo": {
+                "info": {
+                    "description": description
+                },
+                "updateMask": "description"
+            }
+        })
+        return self
+    
+    def item(self, item, index):
+        self.requests.append({
+            "createItem": {
+                "item": item,
+                "location": {
+                    "index": index
+                }
+            }
+        })
+        return self
+    
+    def question(self, question_data, index):
+        if question_data['type'] == 'mcq':
+            return self.item(mcq_item(question_data), index)
+        elif question_data['type'] in ['open_ended', 'open-ended']:
+            return self.item(open_ended_item(question_data), index)
+        return self
+    
+    def batches(self):
+        """
+        Split the collected requests into batchUpdate bodies, starting a new
+        one only when the request count or payload size limit would be hit
+        
+        Returns:
+            List of batchUpdate request bodies, in order
+        """
+        batches = []
+        current, current_bytes = [], 0
+        for request in self.requests:
+            request_bytes = len(json.dumps(request))
+            if current and (len(current) >= self.max_requests
+                            or current_bytes + request_bytes > self.max_bytes):
+                batches.append({"requests": current})
+                current, current_bytes = [], 0
+            current.append(request)
+            current_bytes += request_bytes
+        if current:
+            batches.append({"requests": current})
+        return batches
+
+
+
 class GoogleFormsGenerator:
-    def __init__(self, credentials_file='credentials.json'):
+    def __init__(self, credentials_file='credentials.json', token_file='token.pickle', api_endpoint=None,
+                 rate_limiter=None):
         """
-        Initialize the Google Forms generator
+        Initialize the Google Forms generator. Authentication and the API
+        client are deferred until the first call that needs them.
         
         Args:
             credentials_file: Path to OAuth2 credentials JSON file
+            token_file: Path where the authorized credentials are saved
+            api_endpoint: Root URL replacing the Google API (e.g. the benchmark
+                stand-ins); requests to it are sent without credentials
+            rate_limiter: TokenBucket every Forms API call waits on
         """
         self.credentials_file = credentials_file
+        self.token_file = token_file
+        self.tokens = TokenFile(token_file, credentials_file, SCOPES)
+        self.api_endpoint = api_endpoint
+        self.rate_limiter = rate_limiter
         self.creds = None
-        self.service = None
-        self._authenticate()
+        self._service = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+    
+    @property
+    def service(self):
+        """Forms API client, authenticated and built on first use"""
+        if self._service is None:
+            with self._lock:
+                if self._service is None:
+                    self._authenticate()
+        return self._service
+    
+    @property
+    def ready(self):
+        """Whether the client is built and holds usable credentials"""
+        return self._service is not None and self.creds is not None and (
+            self.creds.valid or bool(self.creds.refresh_token))
     
     def _authenticate(self):
         """Handle OAuth2 authentication with Google"""
-        # Check if we have saved credentials
-        if os.path.exists('token.pickle'):
-            with open('token.pickle', 'rb') as token:
-                self.creds = pickle.load(token)
-        
-        # If no valid credentials, let user log in
-        if not self.creds or not self.creds.valid:
-            if self.creds and self.creds.expired and self.creds.refresh_token:
-                self.creds.refresh(Request())
-            else:
-                flow = InstalledAppFlow.from_client_secrets_file(
-                    self.credentials_file, SCOPES)
-                self.creds = flow.run_local_server(port=0)
-            
-            # Save credentials for next run
-            with open('token.pickle', 'wb') as token:
-                pickle.dump(self.creds, token)
+        from googleapiclient.discovery import build
+        
+        if self.api_endpoint:
+            from google.auth.credentials import AnonymousCredentials
+            self.creds = AnonymousCredentials()
+            self._service = build('forms', 'v1', credentials=self.creds,
+                                  client_options={'api_endpoint': self.api_endpoint},
+                                  static_discovery=True, cache_discovery=False)
+            return
+        
+        # Saved credentials, refreshed or created under the token file's lock
+        # since other server processes may share it
+        self.creds = self.tokens.load()
+        
+        # The discovery document bundled with the client library is used, so
+        # building the service makes no network call
+        self._service = build('forms', 'v1', credentials=self.creds,
+                              static_discovery=True, cache_discovery=False)
+
+    def _http(self):
+        """Per-thread authorized transport, since httplib2 is not thread-safe"""
+        # Refreshed here rather than by the transport, so the new token is shared with the other processes
+        self.tokens.ensure_fresh(self.creds)
+        if not hasattr(self._local, 'http'):
+            from google_auth_httplib2 import AuthorizedHttp
+            import httplib2
+            self._local.http = AuthorizedHttp(self.creds, http=httplib2.Http())
+        return self._local.http
+    
+    def _execute(self, request):
+        """Execute a Forms API request within the rate limit, waiting out quota errors"""
+        attempt, reconnected = 0, False
+        while True:
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            try:
+                return request.execute(http=self._http())
+            except (BrokenPipeError, ConnectionResetError, ConnectionAbortedError):
+                # A keep-alive connection the server closed while idle: reconnect once
+                if reconnected:
+                    raise
+                reconnected = True
+                del self._local.http
+            except HttpError as error:
+                if not is_rate_limited(error) or attempt == MAX_RATE_LIMIT_RETRIES:
+                    raise
+                delay = retry_after(error, default=2 ** attempt)
+                attempt += 1
+                if self.rate_limiter is not None:
+                    # Every other caller holds off as well
+                    self.rate_limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+    
+    def _create(self, title):
+        """Create an empty form and return its ID and responder URL"""
+        form = {
+            "info": {
+                "title": title,
+                "documentTitle": title,
+            }
+        }
+        result = self._execute(self.service.forms().create(body=form))
+        return result['formId'], result['responderUri']
+    
+    def _apply(self, form_id, builder):
+        """
+        Send the collected requests of a builder
         
-        self.service = build('forms', 'v1', credentials=self.creds)
+        Returns:
+            Number of batchUpdate calls made
+        """
+        batches = builder.batches()
+        for update_body in batches:
+            self._execute(self.service.forms().batchUpdate(formId=form_id, body=update_body))
+        return len(batches)
     
     def create_form(self, title, description="Quiz"):
         """
@@ -62,45 +289,14 @@ class GoogleFormsGenerator:
             Form ID and URL
         """
         try:
-            form = {
-                "info": {
-                    "title": title,
-                    "documentTitle": title,
-                }
-            }
-            
-            result = self.service.forms().create(body=form).execute()
-            form_id = result['formId']
-            
-            updates = []
-            
-            updates.append({
-                "updateSettings": {
-                    "settings": {
-                        "quizSettings": {
-                            "isQuiz": True
-                        }
-                    },
-                    "updateMask": "quizSettings.isQuiz"
-                }
-            })
+            form_id, form_url = self._create(title)
             
+            builder = FormRequestBuilder().quiz_settings()
             if description:
-                updates.append({
-                    "updateFormInfo": {
-                        "info": {
-                            "description": description
-                        },
-                        "updateMask": "description"
-                    }
-                })
+                builder.description(description)
+            self._apply(form_id, builder)
             
-            if updates:
-                update_body = {"requests": updates}
-                self.service.forms().batchUpdate(
-                    formId=form_id, body=update_body).execute()
-            
-            return form_id, result['responderUri']
+            return form_id, form_url
         
         except HttpError as error:
             raise Exception(f'An error occurred: {error}')
@@ -115,56 +311,7 @@ class GoogleFormsGenerator:
             question_index: Position in the form
         """
         try:
-            options = []
-            correct_answer_value = None
-            
-            for idx, (key, value) in enumerate(question_data['options'].items()):
-                option_value = f"{key}. {value}"
-                options.append({"value": option_value})
-                
-                # Store correct answer value
-                if key == question_data['correct_answer']:
-                    correct_answer_value = option_value
-            
-            question_item = {
-                "title": question_data['question'],
-                "questionItem": {
-                    "question": {
-                        "required": True,
-                        "grading": {
-                            "pointValue": 1,
-                            "correctAnswers": {
-                                "answers": [{"value": correct_answer_value}]
-                            },
-                            "whenRight": {
-                                "text": question_data.get('explanation', 'Correct!')
-                            },
-                            "whenWrong": {
-                                "text": question_data.get('explanation', '')
-                            }
-                        },
-                        "choiceQuestion": {
-                            "type": "RADIO",
-                            "options": options
-                        }
-                    }
-                }
-            }
-            
-            request = {
-                "requests": [{
-                    "createItem": {
-                        "item": question_item,
-                        "location": {
-                            "index": question_index
-                        }
-                    }
-                }]
-            }
-            
-            self.service.forms().batchUpdate(
-                formId=form_id, body=request).execute()
-            
+            self._apply(form_id, FormRequestBuilder().item(mcq_item(question_data), question_index))
         except HttpError as error:
             raise Exception(f'Error adding MCQ question: {error}')
     
@@ -178,51 +325,21 @@ class GoogleFormsGenerator:
             question_index: Position in the form
         """
         try:
-            question_item = {
-                "title": question_data['question'],
-                "questionItem": {
-                    "question": {
-                        "required": True,
-                        "grading": {
-                            "pointValue": 0,
-                            "generalFeedback": {
-                                "text": f"Sample Answer:\n\n{question_data.get('answer', 'No sample answer provided.')}"
-                            }
-                        },
-                        "textQuestion": {
-                            "paragraph": True
-                        }
-                    }
-                }
-            }
-            
-            request = {
-                "requests": [{
-                    "createItem": {
-                        "item": question_item,
-                        "location": {
-                            "index": question_index
-                        }
-                    }
-                }]
-            }
-            
-            self.service.forms().batchUpdate(
-                formId=form_id, body=request).execute()
-            
+            self._apply(form_id, FormRequestBuilder().item(open_ended_item(question_data), question_index))
         except HttpError as error:
             raise Exception(f'Error adding open-ended question: {error}')
     
-    def create_quiz_from_json(self, questions_data, form_title="Generated Quiz"):
+    def create_quiz(self, questions_data, form_title="Generated Quiz"):
         """
-        Create a complete form from question data
+        Create a complete form from question data with one create call and,
+        unless the size limits are hit, a single batchUpdate
         
         Args:
             questions_data: Can be a single question dict or list of questions
             form_title: Title for the form
             
         Returns:
-            Form URL
+            Dictionary with the form ID, form URL and number of API calls made
         """
         if isinstance(questions_data, dict):
             questions = [questions_data]
@@ -230,18 +347,37 @@ class GoogleFormsGenerator:
             questions = questions_data
         
         date = datetime.datetime.now()
-        form_id, form_url = self.create_form(
-            title=form_title,
-            description=f"This quiz contains {len(questions)} question(s). \n Generated by MindfuLLM at {date.month}/{date.day}/{date.year}"
-        )
+        description = f"This quiz contains {len(questions)} question(s). \n Generated by MindfuLLM at {date.month}/{date.day}/{date.year}"
+        
+        try:
+            form_id, form_url = self._create(form_title)
+            
+            if not form_id:
+                raise Exception("Failed to create form")
+            
+            builder = FormRequestBuilder().quiz_settings().description(description)
+            for idx, question in enumerate(questions):
+                builder.question(question, idx)
+            batch_calls = self._apply(form_id, builder)
         
-        if not form_id:
-            raise Exception("Failed to create form")
+        except HttpError as error:
+            raise Exception(f'An error occurred: {error}')
         
-        for idx, question in enumerate(questions):
-            if question['type'] == 'mcq':
-                self.add_mcq_question(form_id, question, idx)
-            elif question['type'] in ['open_ended', 'open-ended']:
-                self.add_open_ended_question(form_id, question, idx)
+        return {
+            "form_id": form_id,
+            "form_url": form_url,
+            "api_calls": 1 + batch_calls
+        }
+    
+    def create_quiz_from_json(self, questions_data, form_title="Generated Quiz"):
+        """
+        Create a complete form from question data
         
-        return form_url
+        Args:
+            questions_data: Can be a single question dict or list of questions
+            form_title: Title for the form
+            
+        Returns:
+            Form URL
+        """
+        return self.create_quiz(questions_data, form_title)["form_url"]
@@ -0,0 +1,465 @@
+"""
+Durable background jobs for quiz generation.
+
+Quiz requests are persisted to a SQLite database as soon as they arrive and
+are processed by a bounded pool of asyncio workers, so the HTTP handler can
+answer immediately with a job id. Jobs that were still pending when the
+server stopped are picked up again on the next start.
+
+Workers claim jobs from the database rather than from memory, so several
+server processes (uvicorn or gunicorn workers, or hosts sharing the file)
+can drain the same store. A claim is a lease that the worker renews while
+the job runs; the job of a worker that died goes back to the others once
+its lease runs out.
+
+Workers do not take jobs in arrival order but by weighted fair queuing
+between users: every job gets a finish tag, its user's previous finish tag
+(or the queue's virtual time, if that is later) plus the job's estimated cost
+divided by the user's weight, and the unclaimed job with the smallest tag
+goes next. A user submitting many or large quizzes only delays their own
+later jobs. Users can also be capped to a number of jobs in flight, and
+cheap jobs go to an interactive lane that some workers are reserved for, so
+a small quiz never waits behind large ones.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import os
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import asynccontextmanager, contextmanager
+from pathlib import Path
+from typing import AsyncIterator, Awaitable, Callable, Iterator, Optional
+
+from src.enums.jobs import JobLaneEnum, JobStageEnum, FINAL_STAGES
+from src.logs import log, request_id
+from src import metrics
+
+# Longest pause of a worker retrying after a store error, in seconds
+MAX_WORKER_BACKOFF = 30.0
+
+
+class JobStore:
+    """SQLite-backed persistence for quiz jobs."""
+
+    def __init__(self, db_path: str | Path) -> None:
+        self.db_path = Path(db_path)
+        self.db_path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        with self._connect() as db:
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    queue TEXT NOT NULL DEFAULT 'default',
+                    payload TEXT NOT NULL,
+                    stage TEXT NOT NULL,
+                    timings TEXT NOT NULL DEFAULT '{}',
+                    form_url TEXT,
+                    error TEXT,
+                    worker TEXT,
+                    lease_until REAL,
+                    user_email TEXT NOT NULL DEFAULT '',
+                    cost REAL NOT NULL DEFAULT 1,
+                    calls REAL NOT NULL DEFAULT 0,
+                    lane TEXT NOT NULL DEFAULT 'bulk',
+                    finish_tag REAL NOT NULL DEFAULT 0,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            columns = {row["name"] for row in db.execute("PRAGMA table_info(jobs)")}
+            if "queue" not in columns:
+                # Databases created before jobs had a queue
+                db.execute("ALTER TABLE jobs ADD COLUMN queue TEXT NOT NULL DEFAULT 'default'")
+            if "lease_until" not in columns:
+                # Databases created before jobs were claimed by workers
+                db.execute("ALTER TABLE jobs ADD COLUMN worker TEXT")
+                db.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+            if "finish_tag" not in columns:
+                # Databases created before jobs were scheduled fairly
+                db.execute("ALTER TABLE jobs ADD COLUMN user_email TEXT NOT NULL DEFAULT ''")
+                db.execute("ALTER TABLE jobs ADD COLUMN cost REAL NOT NULL DEFAULT 1")
+                db.execute("ALTER TABLE jobs ADD COLUMN lane TEXT NOT NULL DEFAULT 'bulk'")
+                db.execute("ALTER TABLE jobs ADD COLUMN finish_tag REAL NOT NULL DEFAULT 0")
+            if "calls" not in columns:
+                # Databases created before jobs recorded their upstream calls
+                db.execute("ALTER TABLE jobs ADD COLUMN calls REAL NOT NULL DEFAULT 0")
+            # Readers do not block the writer, which matters once several processes share the file
+            db.execute("PRAGMA journal_mode = WAL")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_stage ON jobs (stage)")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_user ON jobs (queue, user_email)")
+            # Fair queuing state: the last finish tag of each user, and the virtual time of each queue
+            db.execute(
+                """
+                CREATE TABLE IF NOT EXISTS job_flows (
+                    queue TEXT NOT NULL,
+                    user_email TEXT NOT NULL,
+                    finish REAL NOT NULL,
+                    PRIMARY KEY (queue, user_email)
+                )
+                """
+            )
+            db.execute("CREATE TABLE IF NOT EXISTS job_clock (queue TEXT PRIMARY KEY, virtual REAL NOT NULL)")
+
+    @contextmanager
+    def _connect(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            # Writes take the database lock up front, so a claim cannot interleave with another process's
+            connection = sqlite3.connect(self.db_path, timeout=30, isolation_level="IMMEDIATE")
+            connection.row_factory = sqlite3.Row
+            try:
+                with connection:
+                    yield connection
+            finally:
+                connection.close()
+
+    def create(self, payload: dict, queue: str = "default", user_email: str = "", cost: float = 1.0,
+               weight: float = 1.0, lane: JobLaneEnum = JobLaneEnum.BULK, calls: float = 0.0) -> str:
+        job_id = uuid.uuid4().hex
+        now = time.time()
+        with self._connect() as db:
+            # The tags are read and written in one transaction, whichever process submits
+            db.execute("BEGIN IMMEDIATE")
+            clock = db.execute("SELECT virtual FROM job_clock WHERE queue = ?", (queue,)).fetchone()
+            flow = db.execute(
+                "SELECT finish FROM job_flows WHERE queue = ? AND user_email = ?", (queue, user_email)
+            ).fetchone()
+            finish = max(clock[0] if clock else 0.0, flow[0] if flow else 0.0) + cost / weight
+            db.execute(
+                "INSERT INTO job_flows (queue, user_email, finish) VALUES (?, ?, ?) "
+                "ON CONFLICT (queue, user_email) DO UPDATE SET finish = excluded.finish",
+                (queue, user_email, finish)
+            )
+            db.execute(
+                "INSERT INTO jobs (job_id, queue, payload, stage, user_email, cost, calls, lane, finish_tag, "
+                "created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (job_id, queue, json.dumps(payload), JobStageEnum.QUEUED.value, user_email, cost, calls, lane.value,
+                 finish, now, now)
+            )
+        return job_id
+
+    def get(self, job_id: str) -> Optional[dict]:
+        with self._connect() as db:
+            row = db.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["timings"] = json.loads(job["timings"])
+        return job
+
+    def set_stage(self, job_id: str, stage: JobStageEnum, worker: Optional[str] = None, **fields) -> bool:
+        """Move a job to `stage`; with `worker`, only if that worker holds it. Returns whether it was updated."""
+        columns = {"stage": stage.value, "updated_at": time.time(), **fields}
+        assignments = ", ".join(f"{column} = ?" for column in columns)
+        condition, parameters = ("AND worker = ?", (worker,)) if worker is not None else ("", ())
+        with self._connect() as db:
+            cursor = db.execute(
+                f"UPDATE jobs SET {assignments} WHERE job_id = ? {condition}",
+                (*columns.values(), job_id, *parameters)
+            )
+        return cursor.rowcount == 1
+
+    def record_timing(self, job_id: str, name: str, seconds: float) -> None:
+        with self._connect() as db:
+            row = db.execute("SELECT timings FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            timings = json.loads(row["timings"]) if row else {}
+            timings[name] = round(seconds, 4)
+            db.execute(
+                "UPDATE jobs SET timings = ?, updated_at = ? WHERE job_id = ?",
+                (json.dumps(timings), time.time(), job_id)
+            )
+
+    def claim(self, queue: str, worker: str, lease_seconds: float, lane: Optional[JobLaneEnum] = None,
+              max_inflight_per_user: Optional[int] = None) -> Optional[str]:
+        """
+        Lease the unfinished job of `queue` with the smallest finish tag that
+        no worker holds to `worker` for `lease_seconds`, skipping users who
+        already have `max_inflight_per_user` jobs leased and, with `lane`, the
+        jobs of other lanes. Returns its id, or None when there is none.
+        """
+        now = time.time()
+        placeholders = ", ".join("?" for _ in FINAL_STAGES)
+        conditions, parameters = [], []
+        if lane is not None:
+            conditions.append("AND j.lane = ?")
+            parameters.append(lane.value)
+        if max_inflight_per_user:
+            conditions.append(
+                "AND (SELECT COUNT(*) FROM jobs r WHERE r.queue = j.queue AND r.user_email = j.user_email "
+                f"AND r.stage NOT IN ({placeholders}) AND r.lease_until >= ?) < ?"
+            )
+            parameters += [*FINAL_STAGES, now, max_inflight_per_user]
+        with self._connect() as db:
+            row = db.execute(
+                "UPDATE jobs SET worker = ?, lease_until = ? WHERE job_id = ("
+                f"SELECT j.job_id FROM jobs j WHERE j.queue = ? AND j.stage NOT IN ({placeholders}) "
+                f"AND (j.lease_until IS NULL OR j.lease_until < ?) {' '.join(conditions)} "
+                "ORDER BY j.finish_tag, j.created_at LIMIT 1"
+                ") RETURNING job_id, finish_tag",
+                (worker, now + lease_seconds, queue, *FINAL_STAGES, now, *parameters)
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "INSERT INTO job_clock (queue, virtual) VALUES (?, ?) "
+                "ON CONFLICT (queue) DO UPDATE SET virtual = MAX(virtual, excluded.virtual)",
+                (queue, row["finish_tag"])
+            )
+        return row["job_id"]
+
+    def renew(self, job_id: str, worker: str, lease_seconds: float) -> bool:
+        """Extend `worker`'s lease on a job. Returns False when the worker no longer holds it."""
+        with self._connect() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET lease_until = ? WHERE job_id = ? AND worker = ?",
+                (time.time() + lease_seconds, job_id, worker)
+            )
+        return cursor.rowcount == 1
+
+    def release(self, worker: str) -> None:
+        """Give up `worker`'s leases on unfinished jobs, so other workers take them over right away."""
+        placeholders = ", ".join("?" for _ in FINAL_STAGES)
+        with self._connect() as db:
+            db.execute(
+                f"UPDATE jobs SET lease_until = NULL WHERE worker = ? AND stage NOT IN ({placeholders})",
+                (worker, *FINAL_STAGES)
+            )
+
+    def pending_calls(self) -> tuple[int, float]:
+        """Number of the jobs of every queue that have not started, and the upstream calls they will make."""
+        with self._connect() as db:
+            row = db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(calls), 0) FROM jobs WHERE stage = ?",
+                (JobStageEnum.QUEUED.value,)
+            ).fetchone()
+        return row[0], row[1]
+
+
+class JobContext:
+    """Handle passed to the pipeline so it can report progress on its job."""
+
+    def __init__(self, store: JobStore, job_id: str) -> None:
+        self.store = store
+        self.job_id = job_id
+
+    @asynccontextmanager
+    async def stage(self, stage: JobStageEnum) -> AsyncIterator[None]:
+        await asyncio.to_thread(self.store.set_stage, self.job_id, stage)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            await asyncio.to_thread(self.store.record_timing, self.job_id, stage.value, time.perf_counter() - start)
+
+
+Pipeline = Callable[[JobContext, dict], Awaitable[Optional[str]]]
+
+
+class SchedulingPolicy:
+    """How the workers of a queue share it between users."""
+
+    def __init__(self,
+                 cost: Optional[Callable[[dict], float]] = None,
+                 weights: Optional[dict[str, float]] = None,
+                 max_inflight_per_user: Optional[int] = None,
+                 interactive_workers: int = 0,
+                 interactive_max_cost: Optional[float] = None) -> None:
+        # Estimated cost of a job from its payload; without it every job costs the same
+        self.cost = cost or (lambda payload: 1.0)
+        self.weights = weights or {}
+        self.max_inflight_per_user = max_inflight_per_user
+        self.interactive_max_cost = interactive_max_cost
+        self.interactive_workers = interactive_workers if interactive_max_cost is not None else 0
+
+    @classmethod
+    def from_config(cls, config: Optional[dict], cost: Optional[Callable[[dict], float]] = None) -> SchedulingPolicy:
+        """Build the policy from the `scheduling` settings of the config."""
+        config = config or {}
+        return cls(
+            cost=cost,
+            weights=config.get("weights"),
+            max_inflight_per_user=config.get("max_inflight_per_user"),
+            interactive_workers=config.get("interactive_workers", 0),
+            interactive_max_cost=config.get("interactive_max_cost")
+        )
+
+    def weight(self, user_email: str) -> float:
+        return self.weights.get(user_email, 1.0)
+
+    def lane(self, cost: float) -> JobLaneEnum:
+        if self.interactive_max_cost is not None and cost <= self.interactive_max_cost:
+            return JobLaneEnum.INTERACTIVE
+        return JobLaneEnum.BULK
+
+
+class JobQueue:
+    """
+    Bounded pool of asyncio workers draining the job store. Several queues,
+    each with its own pool, can share a store, and so can the queues of
+    several processes.
+    """
+
+    def __init__(self, store: JobStore, pipeline: Pipeline, num_workers: int = 4, name: str = "default",
+                 lease_seconds: float = 60.0, poll_interval: float = 1.0,
+                 policy: Optional[SchedulingPolicy] = None,
+                 calls: Optional[Callable[[dict], float]] = None) -> None:
+        self.store = store
+        self.pipeline = pipeline
+        self.num_workers = max(int(num_workers), 1)
+        self.name = name
+        self.policy = policy or SchedulingPolicy()
+        # Upstream calls a job will make, stored for the backpressure estimate
+        self.calls = calls or (lambda payload: 0.0)
+        # Workers only taking interactive jobs; at least one worker takes any job
+        self.interactive_workers = min(self.policy.interactive_workers, self.num_workers - 1)
+        self.lease_seconds = lease_seconds
+        # How soon jobs submitted by other processes are noticed
+        self.poll_interval = poll_interval
+        # Each worker task leases under its own id, derived from this one
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{name}"
+        self._wakeup = asyncio.Event()
+        self._workers: list[asyncio.Task] = []
+        # Loop of the workers, woken from other threads through it
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # (job, worker task) pairs whose lease was lost while the job ran
+        self._lost: set[tuple[str, str]] = set()
+
+    def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._workers = [
+            asyncio.create_task(
+                self._work(f"{self.worker_id}:{i}", JobLaneEnum.INTERACTIVE if i < self.interactive_workers else None),
+                name=f"{self.name}-job-worker-{i}"
+            )
+            for i in range(self.num_workers)
+        ]
+
+    async def stop(self) -> None:
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for i in range(self.num_workers):
+            await asyncio.to_thread(self.store.release, f"{self.worker_id}:{i}")
+
+    def _create(self, payload: dict) -> str:
+        user_email = payload.get("user_email", "")
+        cost = self.policy.cost(payload)
+        return self.store.create(
+            payload, self.name, user_email=user_email, cost=cost,
+            weight=self.policy.weight(user_email), lane=self.policy.lane(cost), calls=self.calls(payload)
+        )
+
+    def submit(self, payload: dict) -> str:
+        """Queue a job from synchronous code, on the event loop or in another thread."""
+        job_id = self._create(payload)
+        if self._loop is None:
+            self._wakeup.set()
+        else:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return job_id
+
+    async def asubmit(self, payload: dict) -> str:
+        """Queue a job without blocking the event loop on the store."""
+        job_id = await asyncio.to_thread(self._create, payload)
+        self._wakeup.set()
+        return job_id
+
+    async def _work(self, worker: str, lane: Optional[JobLaneEnum] = None) -> None:
+        failures = 0
+        while True:
+            try:
+                await self._work_once(worker, lane)
+                failures = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                # e.g. "database is locked" under contention: back off rather than lose the worker
+                failures += 1
+                delay = min(self.poll_interval * 2 ** failures, MAX_WORKER_BACKOFF)
+                log(f"Job worker {self.name} failed, retrying in {delay:.1f}s: {exc}", error=True)
+                await asyncio.sleep(delay)
+
+    async def _work_once(self, worker: str, lane: Optional[JobLaneEnum]) -> None:
+        # Cleared before claiming, so a job submitted meanwhile is not missed
+        self._wakeup.clear()
+        job_id = await asyncio.to_thread(
+            self.store.claim, self.name, worker, self.lease_seconds,
+            lane=lane, max_inflight_per_user=self.policy.max_inflight_per_user
+        )
+        if job_id is None:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            return
+        run = asyncio.create_task(self._run(job_id, worker))
+        heartbeat = asyncio.create_task(self._keep_lease(job_id, worker, run))
+        try:
+            await run
+        except asyncio.CancelledError:
+            # Either the queue is stopping, or the job was lost and another worker runs it now
+            if (job_id, worker) not in self._lost:
+                raise
+            log(f"Stopped job {job_id}, whose lease was lost.", error=True)
+        finally:
+            heartbeat.cancel()
+            self._lost.discard((job_id, worker))
+            # The user's next job may have been held back by the in-flight cap
+            self._wakeup.set()
+
+    async def _keep_lease(self, job_id: str, worker: str, run: asyncio.Task) -> None:
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            try:
+                renewed = await asyncio.to_thread(self.store.renew, job_id, worker, self.lease_seconds)
+            except Exception as exc:
+                # The lease still holds for a while: try again at the next beat
+                log(f"Could not renew the lease of job {job_id}: {exc}", error=True)
+                continue
+            if not renewed:
+                # Another worker may have claimed the job: stop it here rather than run it twice
+                self._lost.add((job_id, worker))
+                run.cancel()
+                return
+
+    async def _run(self, job_id: str, worker: str) -> None:
+        job = await asyncio.to_thread(self.store.get, job_id)
+        if job is None or job["stage"] in FINAL_STAGES:
+            return
+        if job["stage"] == JobStageEnum.QUEUED.value:
+            metrics.JOB_WAIT_SECONDS.labels(job["lane"]).observe(time.time() - job["created_at"])
+        context = JobContext(self.store, job_id)
+        # Everything logged while the job runs is tagged with its id
+        token = request_id.set(job_id)
+        start = time.perf_counter()
+        try:
+            try:
+                form_url = await self.pipeline(context, job["payload"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                log(f"Job failed: {exc}")
+                stage, fields = JobStageEnum.FAILED, {"error": str(exc)}
+            else:
+                stage, fields = JobStageEnum.COMPLETED, {"form_url": form_url}
+            # A worker that lost the job must not overwrite the result of the one holding it now
+            if await asyncio.to_thread(self.store.set_stage, job_id, stage, worker=worker, **fields):
+                metrics.JOBS.labels(stage.value).inc()
+            else:
+                self._lost.add((job_id, worker))
+                log(f"Dropped the result of job {job_id}, whose lease was lost.", error=True)
+        finally:
+            elapsed = time.perf_counter() - start
+            if (job_id, worker) not in self._lost:
+                await asyncio.to_thread(self.store.record_timing, job_id, "total", elapsed)
+                metrics.STAGE_SECONDS.labels("total").observe(elapsed)
+            request_id.reset(token)
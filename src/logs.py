@@ -0,0 +1,23 @@
+'''
+Request ids for the server logs.
+
+The id of the current request (or of the job a worker is running) lives in a
+context variable, so it follows the work into tasks and `asyncio.to_thread`
+calls, and `log` prefixes every line with it.
+'''
+
+import sys
+import uuid
+from contextvars import ContextVar
+
+request_id: ContextVar[str] = ContextVar("request_id", default="")
+
+
+def new_request_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+def log(*values, error: bool = False) -> None:
+    """`print` with the current request id in front; `error` writes to stderr."""
+    current = request_id.get()
+    prefix = (f"[{current}]",) if current else ()
+    print(*prefix, *values, file=sys.stderr if error else sys.stdout)
@@ -0,0 +1,233 @@
+'''
+Minimal Prometheus-style metrics: counters, gauges and histograms with labels,
+rendered in the text exposition format served on `/metrics`.
+'''
+
+from __future__ import annotations
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, float("inf"))
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+def _format_labels(names: tuple, values: tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+             for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        REGISTRY.register(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        if len(values) != len(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}")
+        with self._lock:
+            child = self._children.get(values)
+            if child is None:
+                child = self._children[values] = self._new_child()
+        return child
+
+    def _default(self):
+        return self.labels()
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            children = sorted(self._children.items())
+        for values, child in children:
+            lines += self._render_child(values, child)
+        return lines
+
+
+class _Value:
+    def __init__(self) -> None:
+        self.value = 0.0
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def set(self, value: float) -> None:
+        with self._lock:
+            self.value = value
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def _new_child(self) -> _Value:
+        return _Value()
+
+    def inc(self, amount: float = 1) -> None:
+        self._default().inc(amount)
+
+    def _render_child(self, values: tuple, child: _Value) -> list[str]:
+        return [f"{self.name}{_format_labels(self.labelnames, values)} {_format_value(child.value)}"]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def set(self, value: float) -> None:
+        self._default().set(value)
+
+
+class _Buckets:
+    def __init__(self, bounds: tuple) -> None:
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, value)] += 1
+            self.sum += value
+            self.count += 1
+
+    @contextmanager
+    def time(self) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (),
+                 buckets: tuple = DEFAULT_BUCKETS) -> None:
+        self.buckets = tuple(sorted(buckets))
+        if self.buckets[-1] != float("inf"):
+            self.buckets += (float("inf"),)
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self) -> _Buckets:
+        return _Buckets(self.buckets)
+
+    def observe(self, value: float) -> None:
+        self._default().observe(value)
+
+    def time(self):
+        return self._default().time()
+
+    def _render_child(self, values: tuple, child: _Buckets) -> list[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(child.bounds, child.counts):
+            cumulative += count
+            labels = _format_labels(self.labelnames, values, f'le="{_format_value(bound)}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+        labels = _format_labels(self.labelnames, values)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics = []
+
+    def register(self, metric: _Metric) -> None:
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = Histogram(
+    "mindfullm_stage_seconds",
+    "Duration of each quiz pipeline stage.",
+    ("stage",)
+)
+JOB_WAIT_SECONDS = Histogram(
+    "mindfullm_job_wait_seconds",
+    "Time quiz jobs waited for a worker, by lane.",
+    ("lane",)
+)
+JOBS = Counter(
+    "mindfullm_jobs_total",
+    "Quiz jobs finished, by outcome.",
+    ("status",)
+)
+LLM_REQUESTS = Counter(
+    "mindfullm_llm_requests_total",
+    "Chat completion requests sent, by output template.",
+    ("template",)
+)
+LLM_RETRIES = Counter(
+    "mindfullm_llm_retries_total",
+    "Chat completions repeated because an earlier attempt was invalid, by output template.",
+    ("template",)
+)
+LLM_VALIDATION_FAILURES = Counter(
+    "mindfullm_llm_validation_failures_total",
+    "Responses rejected by validation or aborted while streaming, by output template.",
+    ("template",)
+)
+LLM_TOKENS = Counter(
+    "mindfullm_llm_tokens_total",
+    "Tokens reported by the provider, by model and kind (prompt, cached prompt or completion).",
+    ("model", "kind")
+)
+LLM_HEDGES = Counter(
+    "mindfullm_llm_hedges_total",
+    "Hedged completion requests sent to a second model, those that answered first, and those skipped.",
+    ("outcome",)
+)
+QUESTION_DUPLICATES = Counter(
+    "mindfullm_question_duplicates_total",
+    "Generated questions rejected as near-duplicates of an accepted one."
+)
+UPSTREAM_THROTTLE_SECONDS = Histogram(
+    "mindfullm_upstream_throttle_seconds",
+    "Time requests waited for the client-side rate limiter, by upstream.",
+    ("upstream",)
+)
+REJECTED_REQUESTS = Counter(
+    "mindfullm_rejected_requests_total",
+    "Quiz requests answered with 429 because the queued work would wait too long."
+)
+FORMS_API_CALLS = Counter(
+    "mindfullm_forms_api_calls_total",
+    "Google Forms API calls made."
+)
+EMAILS = Counter(
+    "mindfullm_emails_total",
+    "Emails processed by the outbox, by outcome.",
+    ("status",)
+)
+QUIZ_CACHE = Gauge(
+    "mindfullm_quiz_cache_events",
+    "Quiz cache counters, by event.",
+    ("event",)
+)
@@ -0,0 +1,110 @@
+'''
+OAuth tokens of the Google APIs, shared by every server process.
+
+The authorized credentials are saved in a pickle file. When several worker
+processes (or hosts sharing the directory) use the same file, loading,
+refreshing and saving the token happen under an exclusive lock on a `.lock`
+file next to it, and the token is read again once the lock is held: the first
+worker to find the token about to expire refreshes and saves it, and the
+others take the saved token instead of refreshing it themselves. The file is
+replaced in one step, so a reader never sees a half-written token.
+'''
+
+from __future__ import annotations
+import datetime
+import os
+import pickle
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: the lock only covers the threads of this process
+    fcntl = None
+
+# Tokens are refreshed this long before they expire, so no request goes out with an expired one
+REFRESH_MARGIN = datetime.timedelta(minutes=5)
+
+
+def expiring(creds) -> bool:
+    """Whether the credentials' token expires within the refresh margin."""
+    if creds.expiry is None:
+        return False
+    # google-auth keeps expiry as a naive UTC datetime
+    now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+    return creds.expiry - REFRESH_MARGIN <= now
+
+
+class TokenFile:
+    """Credentials saved at `path`, created with the consent flow of `credentials_file` when missing."""
+
+    def __init__(self, path: str, credentials_file: str, scopes: list[str]) -> None:
+        self.path = path
+        self.credentials_file = credentials_file
+        self.scopes = scopes
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def locked(self) -> Iterator[None]:
+        with self._lock, open(f"{self.path}.lock", "a") as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read(self):
+        if not os.path.exists(self.path):
+            return None
+        with open(self.path, "rb") as token:
+            return pickle.load(token)
+
+    def _write(self, creds) -> None:
+        directory = os.path.dirname(os.path.abspath(self.path))
+        descriptor, temporary = tempfile.mkstemp(dir=directory, prefix=".token-")
+        try:
+            with os.fdopen(descriptor, "wb") as token:
+                pickle.dump(creds, token)
+            os.replace(temporary, self.path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def load(self):
+        """The saved credentials, refreshed if they are about to expire; without any, the user logs in."""
+        from google.auth.transport.requests import Request
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
+        with self.locked():
+            creds = self._read()
+            if creds and creds.valid and not expiring(creds):
+                return creds
+            if creds and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(self.credentials_file, self.scopes)
+                creds = flow.run_local_server(port=0)
+            self._write(creds)
+        return creds
+
+    def refresh(self, creds) -> None:
+        """Bring `creds` up to date with the token another worker saved, or refresh it and save it for them."""
+        from google.auth.transport.requests import Request
+
+        with self.locked():
+            saved = self._read()
+            if saved is not None and saved.token and not expiring(saved):
+                creds.token, creds.expiry = saved.token, saved.expiry
+                return
+            creds.refresh(Request())
+            self._write(creds)
+
+    def ensure_fresh(self, creds) -> None:
+        """Refresh `creds` ahead of their expiry. Cheap while the token is fresh."""
+        if getattr(creds, "refresh_token", None) and expiring(creds):
+            self.refresh(creds)
@@ -0,0 +1,172 @@
+'''
+The quiz pipeline run by the background job workers:
+questions and title (partly reused from the question bank) -> Google Form -> e-mail.
+'''
+
+import asyncio
+from api.schemas import ExtensionData
+from src.enums.jobs import JobStageEnum
+from src.enums.processing import MCQGenerationEnum
+from src.agent.tokens import message_tokens
+from src.jobs import JobContext
+from src.ratelimit import worker_processes
+from src.cache import quiz_cache_key
+from src.bank import content_hash, extract_keywords
+from src.processing import agenerate_quiz
+from src.email.utils import build_email_body
+from src.logs import log
+from src import metrics
+
+
+# Model calls of a quiz besides its questions (title, transcript notes),
+# and Forms API calls (create and batchUpdate)
+EXTRA_LLM_CALLS = 2
+FORMS_CALLS = 2
+
+
+def estimated_calls(config: dict, payload: dict) -> int:
+    """Model calls a quiz job makes: the MCQs, one for the open-ended questions, and the extra calls."""
+    batched = config.get("mcq_generation") == MCQGenerationEnum.BATCHED.value
+    num_mcq = payload.get("num_mcq") or 0
+    mcq_calls = min(num_mcq, 1) if batched else num_mcq
+    return mcq_calls + (1 if payload.get("num_open") else 0) + EXTRA_LLM_CALLS
+
+async def estimated_wait(state, data: ExtensionData) -> float:
+    """
+    Seconds a new quiz would wait on the upstream rate limits, behind the
+    jobs of every queue and process that have not started yet. The calls of
+    running jobs are already in the limiters.
+    """
+    jobs, llm_calls = await asyncio.to_thread(state.job_store.pending_calls)
+    llm_calls += estimated_calls(state.config, {"num_mcq": data.num_mcq, "num_open": data.num_open})
+    # Any process may run the jobs, each at its share of the rate
+    processes = worker_processes()
+    waits = []
+    if state.agent.rate_limiter is not None:
+        waits.append(state.agent.rate_limiter.wait_time(llm_calls / processes))
+    if state.form_generator.rate_limiter is not None:
+        waits.append(state.form_generator.rate_limiter.wait_time((jobs + 1) * FORMS_CALLS / processes))
+    return max(waits, default=0.0)
+
+def estimated_cost(config: dict, payload: dict) -> float:
+    """
+    Rough size of a quiz job, in thousands of prompt tokens: the transcript,
+    cut to the token budget, goes with every model call, and a longer one is
+    read once more to be condensed.
+    """
+    transcript_tokens = sum(message_tokens(message) for message in payload.get("messages", []))
+    budget = config.get("transcript", {}).get("token_budget", 12000)
+    batched = config.get("mcq_generation") == MCQGenerationEnum.BATCHED.value
+    num_mcq = payload.get("num_mcq") or 0
+    llm_calls = (min(num_mcq, 1) if batched else num_mcq) + (1 if payload.get("num_open") else 0) + 1
+    condensed = transcript_tokens if transcript_tokens > budget else 0
+    return (llm_calls * min(transcript_tokens, budget) + condensed) / 1000
+
+def is_mcq(question: dict) -> bool:
+    return question.get("type") == "mcq"
+
+async def reuse_questions(state, data: ExtensionData, keywords: list[str]) -> tuple[list[dict], list[dict]]:
+    """Due questions from the user's earlier quizzes, filling up to `reuse_share` of each question type."""
+    if state.question_bank is None:
+        return [], []
+    share = state.config.get("question_bank", {}).get("reuse_share", 0.0)
+    return await asyncio.gather(
+        asyncio.to_thread(state.question_bank.due, data.user_email, "mcq", int(data.num_mcq * share), keywords),
+        asyncio.to_thread(state.question_bank.due, data.user_email, "open_ended", int(data.num_open * share), keywords)
+    )
+
+async def run_quiz_pipeline(state, context: JobContext, payload: dict) -> str:
+    data = ExtensionData(**payload)
+
+    mcq_generation = state.config.get("mcq_generation", MCQGenerationEnum.CONCURRENT.value)
+    transcript_config = state.config.get("transcript", {})
+    dedup_config = state.config.get("dedup", {})
+
+    source_hash = content_hash(data.messages)
+    keywords = extract_keywords(" ".join(message.content for message in data.messages))
+    reused_mcq, reused_open = await reuse_questions(state, data, keywords)
+    reused = reused_mcq + reused_open
+    num_mcq, num_open = data.num_mcq - len(reused_mcq), data.num_open - len(reused_open)
+    if reused:
+        log(f"Reusing {len(reused)} question(s) from the question bank.")
+
+    # The requested counts, not what is left after reuse: that depends on which bank questions are due.
+    # The generation around reused questions is only shared when the same questions are reused.
+    reuse_options = {"reused_questions": sorted(question["bank_id"] for question in reused)} if reused else {}
+    cache_key = quiz_cache_key(
+        messages=data.messages,
+        num_mcq=data.num_mcq,
+        num_open=data.num_open,
+        chat_model=",".join(model.name for model in state.agent.pool.models),
+        system_prompts=state.system_prompts,
+        mcq_generation=mcq_generation,
+        transcript_config=transcript_config,
+        dedup_config=dedup_config,
+        **reuse_options
+    )
+
+    async with context.stage(JobStageEnum.GENERATING_QUESTIONS):
+        try:
+            cached = await asyncio.to_thread(state.quiz_cache.get, cache_key)
+        except Exception as exc:
+            # A busy cache database only costs a regeneration
+            log(f"Quiz cache read failed: {exc}", error=True)
+            cached = None
+        if cached is not None:
+            questions, quiz_title = cached["questions"], cached["title"]
+            log("Quiz served from cache.")
+        else:
+            questions, quiz_title = await agenerate_quiz(
+                agent=state.agent,
+                messages=data.messages,
+                num_mcq=num_mcq,
+                num_open=num_open,
+                system_propmts=state.system_prompts,
+                mcq_generation=mcq_generation,
+                transcript_config=transcript_config,
+                dedup_config=dedup_config,
+                seen_questions=[question["question"] for question in reused]
+            )
+            try:
+                await asyncio.to_thread(state.quiz_cache.set, cache_key, {"questions": questions, "title": quiz_title})
+            except Exception as exc:
+                # The quiz is generated: failing to cache it must not fail the job
+                log(f"Quiz cache write failed: {exc}", error=True)
+            if state.question_bank is not None:
+                await asyncio.to_thread(state.question_bank.add, data.user_email, source_hash, questions, keywords)
+
+        if reused:
+            await asyncio.to_thread(state.question_bank.mark_served, [question.pop("bank_id") for question in reused])
+            questions = (reused_mcq + [question for question in questions if is_mcq(question)] +
+                         reused_open + [question for question in questions if not is_mcq(question)])
+
+    # The blocking Google calls run in worker threads so the event loop
+    # keeps serving other requests.
+    async with context.stage(JobStageEnum.CREATING_FORM):
+        with metrics.STAGE_SECONDS.labels("form").time():
+            form = await asyncio.to_thread(
+                state.form_generator.create_quiz,
+                questions,
+                form_title=quiz_title
+            )
+    form_url = form["form_url"]
+    metrics.FORMS_API_CALLS.inc(form["api_calls"])
+
+    log(f"Quiz generated at URL: {form_url} ({form['api_calls']} Forms API calls)")
+
+    email_subject = f"MindfuLLM - {quiz_title}"
+    email_sender_name = state.config.get("email_sender_name")
+    email_body = build_email_body(form_url)
+
+    # Delivery happens in the background, in batches, with retries
+    async with context.stage(JobStageEnum.SENDING_EMAIL):
+        outbox_id = await asyncio.to_thread(
+            state.email_outbox.enqueue,
+            recipient=data.user_email,
+            subject=email_subject,
+            body=email_body,
+            sender_name=email_sender_name
+        )
+    log(f"Queued form link email to {data.user_email} (outbox id: {outbox_id})")
+
+    return form_url
@@ -1,12 +1,22 @@
 from src.agent import Agent
+from src.agent.schema import compile_template
+from src.dedup import QuestionIndex
+from src.enums.processing import MCQGenerationEnum
 from src.forms_generator import GoogleFormsGenerator
+from src.transcript import SUMMARY_TEMPLATE, prepare_transcript
+from src.logs import log
+from src import metrics
 from dotenv import load_dotenv
+import asyncio
 import json
 import os
 import sys
 from pathlib import Path
+from typing import Optional
 import random
 
+TITLE_TEMPLATE = {"title": "..."}
+
 
 def load_config(config_path: str | Path) -> dict:
     with open(config_path, "r") as j:
@@ -25,8 +35,13 @@ def load_system_prompts(path_to_specs: str | Path) -> dict:
             file_extension = file_path.suffix.lower()
             with open(file_path, "r") as f:
                 system_prompts[qtype][spec] = json.loads(f.read()) if file_extension == ".json" else f.read()
-    with open(spec_paths["quiz_title"], "r") as f:
-        system_prompts["quiz_title"] = f.read()
+        # Compile the output template once, up front
+        compile_template(system_prompts[qtype]["template"], name=qtype)
+    compile_template(TITLE_TEMPLATE, name="quiz_title")
+    compile_template(SUMMARY_TEMPLATE, name="transcript_summary")
+    for prompt in ["quiz_title", "quiz_title_from_transcript", "transcript_summary"]:
+        with open(spec_paths[prompt], "r") as f:
+            system_prompts[prompt] = f.read()
     
     return system_prompts    
 
@@ -56,26 +71,14 @@ def prompt_for_int(prompt: str) -> int:
         return parsed
 
 
-def generate_questions(agent: Agent, messages: list[dict], 
-                       num_mcq: int, num_open: int, 
-                       system_propmts: dict) -> list[dict]:
-    
-    # We always start from a blank conversation
-    agent.reset_conversation()
-
-    query = "\n".join([message.content for message in messages])
-    agent.send_message(query)
+def build_query(messages: list[dict]) -> str:
+    return "\n".join([message.content for message in messages])
 
-    questions = []
+def plan_correct_answers(num_mcq: int) -> list[str]:
+    """Assign the correct option of every MCQ up front, balanced across A-D."""
     answer_balance = {"A": 0, "B": 0, "C": 0, "D": 0}
-
-    for i in range(num_mcq):
-        enhanced_prompt = system_propmts["mcq"]["prompt"]
-
-        if questions:
-            covered = "\n".join([f"- {q['question']}" for q in questions if q['type'] == 'mcq'])
-            enhanced_prompt += f"\n\nAlready generated questions:\n{covered}"
-        
+    planned = []
+    for _ in range(num_mcq):
         total = sum(answer_balance.values()) + 1  
         weights = []
         for k in ["A", "B", "C", "D"]:
@@ -83,27 +86,52 @@ def generate_questions(agent: Agent, messages: list[dict],
             weight = (total - answer_balance[k] + random.random()) / total
             weights.append(weight)
         chosen_correct = random.choices(["A", "B", "C", "D"], weights=weights, k=1)[0]
+        answer_balance[chosen_correct] += 1
+        planned.append(chosen_correct)
+    return planned
+
+def generate_questions(agent: Agent, messages: list[dict], 
+                       num_mcq: int, num_open: int, 
+                       system_propmts: dict,
+                       dedup_config: Optional[dict] = None) -> list[dict]:
+    
+    # Every call starts from a blank conversation of its own
+    session = agent.session()
 
+    query = build_query(messages)
+    session.send_message(query)
 
-        enhanced_prompt += f"\n\nFor this next question, ensure the correct answer is option '{chosen_correct}'."
+    questions = []
+    # Repeats are caught locally rather than by listing the earlier questions in every prompt
+    index = QuestionIndex.from_config(dedup_config)
+    max_regenerations = (dedup_config or {}).get("max_regenerations", 2)
 
-        response = agent.receive_response(
-            output_template=system_propmts["mcq"]["template"],
-            system_prompt=enhanced_prompt,
-            auto_append=False
-        )
+    for chosen_correct in plan_correct_answers(num_mcq):
+        instructions = f"For this next question, ensure the correct answer is option '{chosen_correct}'."
 
-        response_content = json.loads(response["content"])
+        for _ in range(max_regenerations + 1):
+            response = session.receive_response(
+                output_template=system_propmts["mcq"]["template"],
+                system_prompt=system_propmts["mcq"]["prompt"],
+                auto_append=False,
+                instructions=instructions
+            )
+            response_content = json.loads(response["content"])
+            if agent.accept_unique(index, response_content["question"]):
+                break
+        else:
+            log("Keeping a near-duplicate question after all regenerations.")
 
         response_content["correct_answer"] = chosen_correct
-        answer_balance[chosen_correct] += 1
         questions.append(response_content)
 
     # Generate open-ended questions only once (after MCQs)
-    open_response = agent.receive_response(
+    open_response = session.receive_response(
         output_template=system_propmts["open_ended"]["template"],
-        system_prompt=system_propmts["open_ended"]["prompt"] + f"\n\nGenerate exactly {num_open} open-ended questions.",
-        auto_append=False
+        system_prompt=system_propmts["open_ended"]["prompt"],
+        auto_append=False,
+        many=True,
+        instructions=f"Generate exactly {num_open} open-ended questions."
     )
     open_content = json.loads(open_response["content"])
     
@@ -115,16 +143,157 @@ def generate_questions(agent: Agent, messages: list[dict],
     return questions
 
 def generate_title(agent: Agent, questions: list[dict], system_propmts: dict) -> str:
-    agent.reset_conversation()
+    session = agent.session()
 
     query = "\n".join([str(question) for question in questions])
-    agent.send_message(query)
+    session.send_message(query)
 
-    response = agent.receive_response(
-        output_template={"title": "..."},
+    response = session.receive_response(
+        output_template=TITLE_TEMPLATE,
         system_prompt=system_propmts["quiz_title"],
         auto_append=False
     )
     content = json.loads(response["content"])
     title = content["title"]
-    return title
\ No newline at end of file
+    return title
+
+async def agenerate_questions(agent: Agent, query: str,
+                              num_mcq: int, num_open: int,
+                              system_propmts: dict,
+                              mcq_generation: str = MCQGenerationEnum.CONCURRENT.value,
+                              dedup_config: Optional[dict] = None,
+                              seen_questions: Optional[list[str]] = None) -> list[dict]:
+    """
+    Concurrent version of `generate_questions`: the correct options are planned
+    up front, so every MCQ call and the open-ended call are independent and
+    are fanned out at once (bounded by the agent's concurrency limit).
+
+    With `mcq_generation="batched"` all MCQs are requested in a single call
+    instead, and only the items that fail validation are regenerated.
+
+    Questions that are near-duplicates of an accepted one, or of one of the
+    `seen_questions` (e.g. reused from the question bank), are regenerated,
+    up to `max_regenerations` times (see `src.dedup`).
+    """
+    session = agent.session()
+    session.send_message(query)
+    planned = plan_correct_answers(num_mcq)
+    index = QuestionIndex.from_config(dedup_config)
+    for question in seen_questions or []:
+        index.add(question)
+    max_regenerations = (dedup_config or {}).get("max_regenerations", 2)
+
+    async def mcq(i: int, chosen_correct: str) -> dict:
+        # Only the instructions differ between the MCQ calls (see `PromptLayoutEnum`)
+        instructions = (f"This is question {i + 1} of {num_mcq}. "
+                        "Each question must test a different concept from the conversation.")
+        instructions += f"\n\nFor this next question, ensure the correct answer is option '{chosen_correct}'."
+
+        response_content = await session.areceive_json(
+            output_template=system_propmts["mcq"]["template"],
+            system_prompt=system_propmts["mcq"]["prompt"],
+            instructions=instructions
+        )
+        response_content["correct_answer"] = chosen_correct
+        return response_content
+
+    async def batched_mcqs() -> list[dict]:
+        if num_mcq <= 0:
+            return []
+        compiled = compile_template(system_propmts["mcq"]["template"])
+        letters = ", ".join(f"'{chosen_correct}'" for chosen_correct in planned)
+        instructions = (f"Generate exactly {num_mcq} questions, each testing a different concept, "
+                        "and return them as a JSON list of objects in the output format above.")
+        instructions += f"\n\nIn order, the correct answers of the questions must be options {letters}."
+
+        batch_conversation = session.layout(session.conversation[:], system_propmts["mcq"]["prompt"], instructions)
+        agent.record_request(compiled, 1)
+        content = await agent.acomplete(batch_conversation)
+
+        try:
+            items = json.loads(content)
+        except ValueError:
+            items = []
+        if not isinstance(items, list):
+            items = [items]
+
+        valids = compiled.validate_items(items)
+        if len(items) == num_mcq and all(valids):
+            accepted = items
+        else:
+            agent.record_invalid(compiled)
+            # Keep the valid items and regenerate only the rest, one call each
+            accepted = [item if valid else None for item, valid in zip(items[:num_mcq], valids)]
+            accepted += [None] * (num_mcq - len(accepted))
+            missing = [i for i, item in enumerate(accepted) if item is None]
+            regenerated = await asyncio.gather(*(mcq(i, planned[i]) for i in missing))
+            for i, question in zip(missing, regenerated):
+                accepted[i] = question
+
+        for question, chosen_correct in zip(accepted, planned):
+            question["correct_answer"] = chosen_correct
+        return accepted
+
+    async def unique_mcqs(questions: list[dict]) -> list[dict]:
+        # Accept the questions in order, regenerating only those that collide
+        candidates = range(len(questions))
+        for regeneration in range(max_regenerations + 1):
+            collisions = [i for i in candidates if not agent.accept_unique(index, questions[i]["question"])]
+            if not collisions:
+                break
+            if regeneration == max_regenerations:
+                log(f"Keeping {len(collisions)} near-duplicate question(s) after {max_regenerations} regenerations.")
+                break
+            regenerated = await asyncio.gather(*(mcq(i, planned[i]) for i in collisions))
+            for i, question in zip(collisions, regenerated):
+                questions[i] = question
+            candidates = collisions
+        return questions
+
+    async def all_mcqs() -> list[dict]:
+        if mcq_generation == MCQGenerationEnum.BATCHED.value:
+            return await unique_mcqs(await batched_mcqs())
+        return await unique_mcqs(list(await asyncio.gather(*(mcq(i, chosen_correct) for i, chosen_correct in enumerate(planned)))))
+
+    async def open_ended() -> list[dict]:
+        if num_open <= 0:
+            return []
+        return await session.areceive_items(
+            output_template=system_propmts["open_ended"]["template"],
+            system_prompt=system_propmts["open_ended"]["prompt"],
+            count=num_open,
+            item_name="open-ended questions",
+            index=index
+        )
+
+    mcqs, open_questions = await asyncio.gather(all_mcqs(), open_ended())
+    return mcqs + open_questions
+
+async def agenerate_title(agent: Agent, query: str, system_propmts: dict) -> str:
+    """Title the quiz from the transcript, so it need not wait for the questions."""
+    session = agent.session()
+    session.send_message(query)
+
+    content = await session.areceive_json(
+        output_template=TITLE_TEMPLATE,
+        system_prompt=system_propmts["quiz_title_from_transcript"]
+    )
+    return content["title"]
+
+async def agenerate_quiz(agent: Agent, messages: list[dict],
+                         num_mcq: int, num_open: int,
+                         system_propmts: dict,
+                         mcq_generation: str = MCQGenerationEnum.CONCURRENT.value,
+                         transcript_config: Optional[dict] = None,
+                         dedup_config: Optional[dict] = None,
+                         seen_questions: Optional[list[str]] = None) -> tuple[list[dict], str]:
+    async def timed(stage: str, generation):
+        with metrics.STAGE_SECONDS.labels(stage).time():
+            return await generation
+
+    query = await timed("transcript", prepare_transcript(agent, messages, system_propmts, **(transcript_config or {})))
+    return await asyncio.gather(
+        timed("questions", agenerate_questions(agent, query, num_mcq, num_open, system_propmts,
+                                               mcq_generation, dedup_config, seen_questions)),
+        timed("title", agenerate_title(agent, query, system_propmts))
+    )
@@ -0,0 +1,121 @@
+'''
+Client-side rate limiting of the upstream APIs.
+
+Each upstream (OpenRouter, Google Forms, Gmail) has one token bucket shared by
+every caller in the process. Callers reserve tokens and sleep until their
+reservation is due, so requests over the rate queue up in order instead of
+failing at the upstream. A Retry-After from the upstream pauses the bucket,
+and the wait of the queued work is used to push back on new requests.
+
+With several worker processes (`WEB_CONCURRENCY`, which uvicorn and gunicorn
+take as their worker count), each process gets an equal share of the
+configured rate, so together they stay within it.
+'''
+
+from __future__ import annotations
+import asyncio
+import os
+import threading
+import time
+from typing import Optional
+
+from src import metrics
+
+
+def worker_processes() -> int:
+    """Number of server processes splitting the rate limits."""
+    return max(int(os.getenv("WEB_CONCURRENCY", "1")), 1)
+
+
+class TokenBucket:
+    def __init__(self, name: str, rate: float, burst: Optional[float] = None) -> None:
+        if rate <= 0:
+            raise Exception(f"The rate of the {name} limiter must be positive.")
+        self.name = name
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.0)
+        # Negative when reservations are queued: -tokens / rate is the wait of the next one
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+        self.counts = {"acquired": 0, "throttled": 0, "paused": 0}
+
+    @classmethod
+    def from_config(cls, name: str, config: Optional[dict]) -> Optional[TokenBucket]:
+        """The limiter configured under `rate_limits.<name>`, or None when there is none."""
+        if not config or not config.get("rate"):
+            return None
+        processes = worker_processes()
+        burst = config.get("burst")
+        return cls(name, config["rate"] / processes, burst / processes if burst is not None else None)
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def _reserve(self, tokens: float) -> float:
+        with self._lock:
+            self._refill()
+            self._tokens -= tokens
+            self.counts["acquired"] += 1
+            delay = max(-self._tokens / self.rate, 0.0)
+            if delay:
+                self.counts["throttled"] += 1
+        metrics.UPSTREAM_THROTTLE_SECONDS.labels(self.name).observe(delay)
+        return delay
+
+    def _release(self, tokens: float) -> None:
+        with self._lock:
+            self._tokens += tokens
+
+    def acquire(self, tokens: float = 1) -> None:
+        """Block until `tokens` requests may be sent."""
+        delay = self._reserve(tokens)
+        if delay:
+            time.sleep(delay)
+
+    async def aacquire(self, tokens: float = 1) -> None:
+        delay = self._reserve(tokens)
+        if not delay:
+            return
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            # The request will not be sent, so its place goes to the next one
+            self._release(tokens)
+            raise
+
+    def pause(self, seconds: float) -> None:
+        """Hold every request for at least `seconds`, e.g. the upstream's Retry-After."""
+        with self._lock:
+            self._refill()
+            self._tokens = min(self._tokens, -seconds * self.rate)
+            self.counts["paused"] += 1
+
+    def wait_time(self, tokens: float = 1) -> float:
+        """Seconds before `tokens` more requests, queued behind the current ones, would be sent."""
+        with self._lock:
+            self._refill()
+            return max((tokens - self._tokens) / self.rate, 0.0)
+
+    def stats(self) -> dict:
+        return {**self.counts, "rate": self.rate, "burst": self.burst, "wait_seconds": self.wait_time()}
+
+
+def retry_after(error: Exception, default: Optional[float] = None) -> Optional[float]:
+    """Seconds from the Retry-After header of a Google API or OpenAI error, if it has one."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or getattr(error, "resp", None) or {}
+    value = headers.get("retry-after")
+    try:
+        return float(value) if value is not None else default
+    except ValueError:
+        return default
+
+def is_rate_limited(error: Exception) -> bool:
+    """Whether a Google API error is a quota error (429, or 403 with a rate limit reason)."""
+    from googleapiclient.errors import HttpError
+    if not isinstance(error, HttpError):
+        return False
+    status = error.resp.status
+    return status == 429 or (status == 403 and "ratelimitexceeded" in str(error).lower())
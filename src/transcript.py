@@ -0,0 +1,83 @@
+'''
+Preprocessing of the submitted chat history into the query sent to the model.
+
+Messages are grouped by conversation, duplicates are dropped and the result is
+fitted to a token budget. Transcripts over the budget are split into chunks that
+are summarized concurrently, and the summaries are used in place of the raw text.
+'''
+
+import asyncio
+from src.agent import Agent
+from src.agent.tokens import CHARS_PER_TOKEN, estimate_tokens, truncate_to_tokens
+from src.logs import log
+
+SUMMARY_TEMPLATE = {"summary": "..."}
+
+
+def group_conversations(messages: list) -> dict[int, list]:
+    """Group messages by `conv_id` (in order of first appearance), dropping repeated messages."""
+    conversations = {}
+    seen = set()
+    for message in messages:
+        content = " ".join(message.content.split())
+        if not content or (message.role, content) in seen:
+            continue
+        seen.add((message.role, content))
+        conversations.setdefault(message.conv_id, []).append(message)
+    return conversations
+
+def format_conversation(conv_id: int, messages: list) -> str:
+    lines = [f"Conversation {conv_id}:"]
+    lines += [f"{message.role.capitalize()}: {message.content.strip()}" for message in messages]
+    return "\n".join(lines)
+
+def chunk_text(blocks: list[str], chunk_tokens: int) -> list[str]:
+    """Pack text blocks into chunks of at most `chunk_tokens`, splitting oversized blocks."""
+    chunk_chars = chunk_tokens * CHARS_PER_TOKEN
+    pieces = []
+    for block in blocks:
+        pieces += [block[i:i + chunk_chars] for i in range(0, len(block), chunk_chars)]
+
+    chunks, current = [], ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > chunk_chars:
+            chunks.append(current)
+            current = ""
+        current = f"{current}\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def summarize_chunk(agent: Agent, chunk: str, system_propmts: dict) -> str:
+    session = agent.session()
+    session.send_message(chunk)
+    content = await session.areceive_json(
+        output_template=SUMMARY_TEMPLATE,
+        system_prompt=system_propmts["transcript_summary"]
+    )
+    return content["summary"]
+
+async def prepare_transcript(agent: Agent, messages: list, system_propmts: dict,
+                             token_budget: int = 12000, chunk_tokens: int = 4000,
+                             max_rounds: int = 3) -> str:
+    """
+    Build the model query from the raw messages, fitted to `token_budget`.
+
+    While the text is over budget, it is split into chunks of `chunk_tokens`
+    which are summarized in parallel (map) and joined (reduce). After
+    `max_rounds` the remainder is truncated.
+    """
+    conversations = group_conversations(messages)
+    blocks = [format_conversation(conv_id, conversation) for conv_id, conversation in conversations.items()]
+    text = "\n\n".join(blocks)
+
+    rounds = 0
+    while estimate_tokens(text) > token_budget and rounds < max_rounds:
+        rounds += 1
+        chunks = chunk_text(blocks, chunk_tokens)
+        summaries = await asyncio.gather(*(summarize_chunk(agent, chunk, system_propmts) for chunk in chunks))
+        blocks = [summary for summary in summaries if summary.strip()]
+        text = "\n\n".join(blocks)
+        log(f"Condensed transcript to ~{estimate_tokens(text)} tokens from {len(chunks)} chunk(s).")
+
+    return truncate_to_tokens(text, token_budget)
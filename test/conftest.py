@@ -0,0 +1,2 @@
+# test_request.py posts to a running server as soon as it is imported; run it by hand
+collect_ignore = ["test_request.py"]
@@ -0,0 +1,31 @@
+import pytest
+
+from src.agent import Conversation
+
+
+def conversation(system_chars: int) -> Conversation:
+    return Conversation([
+        {"role": "system", "content": "s" * system_chars},
+        {"role": "user", "content": "u" * 400},
+        {"role": "assistant", "content": "a" * 400},
+        {"role": "user", "content": "q" * 400},
+    ])
+
+
+def test_fit_to_tokens_keeps_system_and_latest_message():
+    fitted = conversation(40).fit_to_tokens(150)
+
+    assert fitted.tokens <= 150
+    assert fitted[0]["content"] == "s" * 40
+    assert fitted[-1]["content"] == "q" * 400
+
+
+@pytest.mark.parametrize("system_chars, budget", [(4000, 100), (56, 5)])
+def test_fit_to_tokens_rejects_system_message_over_budget(system_chars, budget):
+    original = conversation(system_chars)
+    messages = list(original.messages)
+
+    with pytest.raises(ValueError):
+        original.fit_to_tokens(budget)
+    # Nothing was cut before failing
+    assert original.messages == messages
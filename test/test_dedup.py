@@ -0,0 +1,74 @@
+import asyncio
+
+from src.dedup import QuestionIndex
+from src.processing import agenerate_questions
+
+
+AUGUSTUS = "What year did Augustus become the first Roman emperor?"
+PARAPHRASE = "In what year did Augustus become the first emperor of Rome?"
+RUBICON = "Which river did Julius Caesar cross in 49 BCE to start a civil war?"
+SENATE = "Which body advised the consuls of the Roman Republic?"
+
+PROMPTS = {
+    "mcq": {"prompt": "Write a multiple-choice question.", "template": {"question": ""}},
+    "open_ended": {"prompt": "Write open-ended questions.", "template": {"question": ""}},
+}
+
+
+class FakeSession:
+    def __init__(self, answers: list[str]):
+        self.answers = answers
+        self.calls = 0
+
+    def send_message(self, content):
+        pass
+
+    async def areceive_json(self, output_template, system_prompt, instructions=None):
+        self.calls += 1
+        return {"question": self.answers.pop(0)}
+
+
+class FakeAgent:
+    def __init__(self, answers: list[str]):
+        self._session = FakeSession(answers)
+
+    def session(self):
+        return self._session
+
+    def accept_unique(self, index, text):
+        return index.add(text)
+
+
+def test_index_rejects_a_paraphrase():
+    index = QuestionIndex()
+
+    assert index.add(AUGUSTUS)
+    assert index.duplicate_of(PARAPHRASE) == AUGUSTUS
+    assert not index.add(PARAPHRASE)
+    assert len(index) == 1
+
+
+def test_index_accepts_a_distinct_question():
+    index = QuestionIndex()
+
+    assert index.add(AUGUSTUS)
+    assert index.duplicate_of(RUBICON) is None
+    assert index.add(RUBICON)
+    assert len(index) == 2
+
+
+def test_duplicate_mcq_is_regenerated():
+    agent = FakeAgent([AUGUSTUS, PARAPHRASE, RUBICON, SENATE])
+
+    questions = asyncio.run(agenerate_questions(agent, "transcript", 3, 0, PROMPTS))
+
+    assert [question["question"] for question in questions] == [AUGUSTUS, SENATE, RUBICON]
+    assert agent.session().calls == 4
+
+
+def test_question_seen_before_is_regenerated():
+    agent = FakeAgent([PARAPHRASE, RUBICON])
+
+    questions = asyncio.run(agenerate_questions(agent, "transcript", 1, 0, PROMPTS, seen_questions=[AUGUSTUS]))
+
+    assert [question["question"] for question in questions] == [RUBICON]
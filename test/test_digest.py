@@ -0,0 +1,43 @@
+import time
+
+from src.digest import DigestScheduler, DigestStore
+
+
+MESSAGES = [
+    {"conv_id": 0, "role": "user", "content": "What is a monad?"},
+    {"conv_id": 0, "role": "assistant", "content": "A way to chain computations."},
+]
+
+
+class RecordingQueue:
+    def __init__(self):
+        self.payloads = []
+
+    def submit(self, payload):
+        self.payloads.append(payload)
+        return f"job-{len(self.payloads)}"
+
+
+def test_purge_uploads_drops_abandoned_uploads_only(tmp_path):
+    store = DigestStore(tmp_path / "digest.sqlite3")
+    store.stage("crashed", "a@example.com", MESSAGES, received_at=time.time() - 2 * 86400)
+    store.stage("running", "a@example.com", MESSAGES, received_at=time.time())
+    store.append("a@example.com", MESSAGES[:1])
+
+    assert store.purge_uploads(86400) == 2
+
+    # The upload still in progress can be committed, next to the appended message
+    assert store.commit_upload("running", "a@example.com") == 3
+
+
+def test_run_once_purges_abandoned_uploads(tmp_path):
+    store = DigestStore(tmp_path / "digest.sqlite3")
+    store.stage("crashed", "a@example.com", MESSAGES, received_at=time.time() - 2 * 86400)
+    store.append("b@example.com", MESSAGES)
+    queue = RecordingQueue()
+
+    DigestScheduler(store, queue, stale_upload_seconds=86400).run_once()
+
+    assert [payload["user_email"] for payload in queue.payloads] == ["b@example.com"]
+    # Committing the purged upload brings nothing back
+    assert store.commit_upload("crashed", "a@example.com") == 0
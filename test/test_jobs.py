@@ -0,0 +1,79 @@
+from src.enums.jobs import JobLaneEnum, JobStageEnum
+from src.jobs import JobStore, SchedulingPolicy
+
+
+def submit(store: JobStore, user_email: str, cost: float = 1.0, lane: JobLaneEnum = JobLaneEnum.BULK) -> str:
+    return store.create({"user_email": user_email}, user_email=user_email, cost=cost, lane=lane)
+
+
+def test_flood_from_one_user_does_not_starve_another(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    flood = [submit(store, "flood@example.com") for _ in range(10)]
+    other = submit(store, "other@example.com")
+
+    claimed = [store.claim("default", "worker", 60) for _ in range(3)]
+
+    # Both users' first jobs share the smallest finish tag; the flood's later jobs queue behind them
+    assert claimed == [flood[0], other, flood[1]]
+
+
+def test_weight_gives_a_user_a_larger_share(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    heavy = [store.create({}, user_email="heavy@example.com", weight=2.0) for _ in range(4)]
+    light = [store.create({}, user_email="light@example.com") for _ in range(2)]
+
+    claimed = [store.claim("default", "worker", 60) for _ in range(6)]
+
+    assert claimed == [heavy[0], heavy[1], light[0], heavy[2], heavy[3], light[1]]
+
+
+def test_max_inflight_per_user_is_enforced_across_claims(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    first, second = submit(store, "a@example.com"), submit(store, "a@example.com")
+    other = submit(store, "b@example.com")
+
+    assert store.claim("default", "worker-1", 60, max_inflight_per_user=1) == first
+    assert store.claim("default", "worker-2", 60, max_inflight_per_user=1) == other
+    # a@example.com already has a job leased
+    assert store.claim("default", "worker-3", 60, max_inflight_per_user=1) is None
+
+    store.set_stage(first, JobStageEnum.COMPLETED)
+    assert store.claim("default", "worker-3", 60, max_inflight_per_user=1) == second
+
+
+def test_interactive_lane_only_takes_cheap_jobs(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    policy = SchedulingPolicy(interactive_max_cost=5.0)
+    large = submit(store, "a@example.com", cost=50.0, lane=policy.lane(50.0))
+    small = submit(store, "b@example.com", cost=2.0, lane=policy.lane(2.0))
+
+    assert store.get(small)["lane"] == JobLaneEnum.INTERACTIVE.value
+    assert store.claim("default", "interactive", 60, lane=JobLaneEnum.INTERACTIVE) == small
+    assert store.claim("default", "interactive", 60, lane=JobLaneEnum.INTERACTIVE) is None
+    assert store.claim("default", "any", 60) == large
+
+
+def test_expired_lease_is_reclaimed_and_the_first_worker_loses_it(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    job_id = submit(store, "a@example.com")
+
+    # A negative lease expires at once, as if the worker had stopped renewing it
+    assert store.claim("default", "host:1:default:0", -1) == job_id
+    assert store.claim("default", "host:1:default:1", 60) == job_id
+
+    assert not store.renew(job_id, "host:1:default:0", 60)
+    assert not store.set_stage(job_id, JobStageEnum.COMPLETED, worker="host:1:default:0", form_url="stale")
+    assert store.renew(job_id, "host:1:default:1", 60)
+    assert store.set_stage(job_id, JobStageEnum.COMPLETED, worker="host:1:default:1", form_url="fresh")
+    assert store.get(job_id)["form_url"] == "fresh"
+
+
+def test_held_lease_is_not_reclaimed_until_released(tmp_path):
+    store = JobStore(tmp_path / "jobs.sqlite3")
+    job_id = submit(store, "a@example.com")
+
+    assert store.claim("default", "worker-1", 60) == job_id
+    assert store.claim("default", "worker-2", 60) is None
+
+    store.release("worker-1")
+    assert store.claim("default", "worker-2", 60) == job_id
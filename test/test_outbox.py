@@ -0,0 +1,53 @@
+import json
+import sqlite3
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from src.email import GmailEmailSender
+from src.email.outbox import EmailOutbox
+
+
+def quota_error() -> HttpError:
+    content = json.dumps({"error": {
+        "code": 403,
+        "message": "User-rate limit exceeded.",
+        "errors": [{"domain": "usageLimits", "reason": "rateLimitExceeded", "message": "User-rate limit exceeded."}]
+    }}).encode()
+    return HttpError(httplib2.Response({"status": 403}), content)
+
+
+class FailingBatch:
+    def __init__(self, callback, error):
+        self.callback = callback
+        self.error = error
+        self.request_ids = []
+
+    def add(self, request, request_id):
+        self.request_ids.append(request_id)
+
+    def execute(self, http=None):
+        for request_id in self.request_ids:
+            self.callback(request_id, None, self.error)
+
+
+class QuotaLimitedSender(GmailEmailSender):
+    def new_batch(self, callback):
+        return FailingBatch(callback, quota_error())
+
+    def send_request(self, recipient, subject, body, sender_name=None):
+        return object()
+
+    def _http(self):
+        return None
+
+
+def test_quota_error_is_retried(tmp_path):
+    outbox = EmailOutbox(QuotaLimitedSender(), tmp_path / "outbox.sqlite3", base_delay=0.01)
+    outbox.enqueue("user@example.com", "Quiz", "Link")
+
+    assert outbox.deliver_due() == 1
+
+    with sqlite3.connect(tmp_path / "outbox.sqlite3") as db:
+        status, attempts = db.execute("SELECT status, attempts FROM outbox").fetchone()
+    assert (status, attempts) == ("pending", 1)
@@ -0,0 +1,96 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import httpx
+from openai import RateLimitError
+
+from src.agent import Agent, Conversation
+
+
+CONFIG = {
+    "models": [{"name": "primary", "base_url": "http://primary"}, {"name": "backup", "base_url": "http://backup"}],
+    "base_url": "http://primary",
+    "api_key": "key",
+    "stream_responses": False,
+    "hedging": {"min_samples": 3, "percentile": 0.9, "min_delay": 0.01, "initial_delay": 10.0}
+}
+
+
+def rate_limited(retry_after: str) -> RateLimitError:
+    response = httpx.Response(429, headers={"retry-after": retry_after}, request=httpx.Request("POST", "http://primary"))
+    return RateLimitError("Rate limit exceeded", response=response, body=None)
+
+
+class FakeClient:
+    """Answers with the model's name after `delay` seconds, or raises `error`."""
+
+    def __init__(self, name: str, delay: float = 0.0, error: Exception = None):
+        self.name = name
+        self.delay = delay
+        self.error = error
+        self.calls = 0
+        self.cancelled = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **args):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.error is not None:
+            raise self.error
+        message = SimpleNamespace(content=self.name)
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(message=message)])
+
+
+def agent_with(*clients: FakeClient) -> Agent:
+    agent = Agent(CONFIG)
+    for model, client in zip(agent.pool.models, clients):
+        agent._clients[(True, model.base_url, model.api_key)] = client
+    return agent
+
+
+def complete(agent: Agent) -> str:
+    return asyncio.run(agent.acomplete(Conversation([{"role": "user", "content": "Hello"}])))
+
+
+def test_hedge_fires_after_the_latency_percentile_and_cancels_the_loser():
+    primary, backup = FakeClient("primary", delay=2.0), FakeClient("backup")
+    agent = agent_with(primary, backup)
+    for _ in range(3):
+        agent.pool.record_success(agent.pool.models[0], 0.05)
+
+    start = time.perf_counter()
+    assert complete(agent) == "backup"
+
+    assert time.perf_counter() - start < 1.0
+    assert backup.calls == 1
+    assert primary.cancelled == 1
+    assert agent.pool.models[0].counts["cancelled"] == 1
+    assert agent.pool.models[1].counts["hedge_wins"] == 1
+
+
+def test_no_hedge_before_the_latency_percentile():
+    primary, backup = FakeClient("primary", delay=0.1), FakeClient("backup")
+    agent = agent_with(primary, backup)
+    for _ in range(3):
+        agent.pool.record_success(agent.pool.models[0], 1.0)
+
+    assert complete(agent) == "primary"
+    assert backup.calls == 0
+
+
+def test_rate_limited_model_falls_back_to_the_next():
+    primary, backup = FakeClient("primary", error=rate_limited("30")), FakeClient("backup")
+    agent = agent_with(primary, backup)
+
+    assert complete(agent) == "backup"
+
+    model = agent.pool.models[0]
+    assert model.counts["rate_limited"] == 1
+    assert model.cooldown_until > time.monotonic() + 20
+    # The rate-limited model is skipped for its Retry-After
+    assert [model.name for model in agent.pool.ranked()] == ["backup", "primary"]
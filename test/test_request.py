@@ -1,4 +1,5 @@
 import requests
+import time
 
 data = {
         "user_email": "...",
@@ -44,4 +45,13 @@ response = requests.post(
 )
 
 print(response.status_code)  # Should be 200
-print(response.json())       # {"status": "ok"}
\ No newline at end of file
+print(response.json())       # {"status": "queued", "job_id": "..."}
+
+job_id = response.json()["job_id"]
+while True:
+    job = requests.get(f"http://127.0.0.1:8000/jobs/{job_id}").json()
+    if job["stage"] in ("completed", "failed"):
+        break
+    time.sleep(1)
+
+print(job)                   # {"job_id": "...", "stage": "completed", "form_url": "...", ...}
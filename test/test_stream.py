@@ -0,0 +1,99 @@
+import pytest
+
+from src.agent.schema import strip_fences
+from src.agent.stream import StreamingTemplateChecker
+
+
+TEMPLATE = {"question": "", "options": [""], "answer": 0, "multiple": False}
+
+VALID = '{"question": "Who was the first emperor?", "options": ["Augustus", "Nero"], "answer": 0, "multiple": false}'
+
+
+def feed(checker: StreamingTemplateChecker, text: str, chunk: int = 3) -> bool:
+    """Feed `text` a few characters at a time, as a stream would."""
+    return all(checker.feed(text[i:i + chunk]) for i in range(0, len(text), chunk))
+
+
+@pytest.mark.parametrize("fence", ["", "```json\n", "```JSON\n", "```\n", "  \n```Json "])
+def test_accepts_fenced_and_bare_json(fence):
+    checker = StreamingTemplateChecker(TEMPLATE)
+
+    assert feed(checker, fence + VALID + "\n```")
+    assert checker.done and checker.error is None
+
+
+def test_strip_fences_matches_the_checker():
+    assert strip_fences("```JSON\n" + VALID + "\n```") == VALID
+
+
+def test_rejects_text_before_json():
+    checker = StreamingTemplateChecker(TEMPLATE)
+
+    assert not feed(checker, "Sure! Here is the question: " + VALID)
+    assert "unexpected text" in checker.error
+
+
+def test_escaped_quotes_stay_inside_the_string():
+    checker = StreamingTemplateChecker(TEMPLATE)
+    text = '{"question": "What does \\"veni, vidi\\" mean?", "options": ["\\\\", "b"], "answer": 1, "multiple": true}'
+
+    assert feed(checker, text)
+    assert checker.done and checker.error is None
+
+
+@pytest.mark.parametrize("text, key", [
+    ('{"question": 3', "question"),
+    ('{"question": "q", "options": "a"', "options"),
+    ('{"question": "q", "options": [], "answer": "0"', "answer"),
+    ('{"question": "q", "options": [], "answer": 0, "multiple": 1', "multiple"),
+])
+def test_rejects_wrong_type_values(text, key):
+    checker = StreamingTemplateChecker(TEMPLATE)
+
+    assert not feed(checker, text)
+    assert checker.error.startswith(f"wrong type for key {key!r}")
+
+
+def test_rejects_wrong_type_list_items():
+    checker = StreamingTemplateChecker(TEMPLATE)
+
+    assert not feed(checker, '{"question": "q", "options": ["a", 2]')
+    assert checker.error.startswith("wrong type for list item")
+
+
+def test_rejects_unexpected_and_repeated_keys():
+    unexpected = StreamingTemplateChecker(TEMPLATE)
+    repeated = StreamingTemplateChecker(TEMPLATE)
+
+    assert not feed(unexpected, '{"question": "q", "explanation": "')
+    assert unexpected.error == "unexpected key 'explanation'"
+    assert not feed(repeated, '{"question": "q", "question": "')
+    assert repeated.error == "repeated key 'question'"
+
+
+def test_rejects_missing_keys():
+    checker = StreamingTemplateChecker(TEMPLATE)
+
+    assert not feed(checker, '{"question": "q", "options": ["a"]}')
+    assert checker.error == "missing keys ['answer', 'multiple']"
+
+
+def test_many_accepts_a_list_of_objects():
+    checker = StreamingTemplateChecker(TEMPLATE, many=True)
+
+    assert feed(checker, "[" + VALID + ", " + VALID + "]")
+    assert checker.done and checker.error is None
+
+
+def test_many_checks_each_item():
+    checker = StreamingTemplateChecker(TEMPLATE, many=True)
+
+    assert not feed(checker, "[" + VALID + ', {"question": "q", "hint": ')
+    assert checker.error == "unexpected key 'hint'"
+
+
+def test_single_object_rejects_a_list():
+    checker = StreamingTemplateChecker(TEMPLATE)
+
+    assert not feed(checker, "[" + VALID + "]")
+    assert checker.error == "expected an object, got a list"